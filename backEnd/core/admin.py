@@ -1,10 +1,11 @@
 from django.contrib import admin
 from import_export.admin  import ImportExportModelAdmin
 from core.models import (
-    CustomUser, UserProfile, Product,
+    CustomUser, UserProfile, Product, ProductVariant,
     Cart, CartItem, Order, OrderItem, CardDetails
 )
 from core.forms import ProductAdminForm
+from core.search import search_terms, filter_matching
 
 
 # Register your models here.
@@ -18,12 +19,32 @@ class UserProfileAdmin(ImportExportModelAdmin):
     pass
 
 
+# Stock and price of each storage/color combination, the combinations come from the options
+class ProductVariantInline(admin.TabularInline):
+    model = ProductVariant
+    fields = ['storage', 'color', 'stock', 'price_delta']
+    readonly_fields = ['storage', 'color']
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class ProductAdmin(admin.ModelAdmin):
     form = ProductAdminForm
+    inlines = [ProductVariantInline]
     list_display = ['name', 'brand', 'price', 'stock', 'category']
     search_fields = ['name', 'brand']
     list_filter = ['category']
 
+    # Search through the full-text index instead of LIKE scans over the whole table
+    def get_search_results(self, request, queryset, search_term):
+        terms = search_terms(search_term)
+        if not terms:
+            return queryset, False
+        return filter_matching(queryset, terms), False
+
 
 class CartItemAdmin(ImportExportModelAdmin):
     pass
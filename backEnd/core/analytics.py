@@ -0,0 +1,173 @@
+from contextlib import nullcontext
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .cache import invalidate_namespace
+from .models import (
+    Product, Order, OrderItem, DailySales, DailyProductSales, DailyCategorySales, DailyBrandSales, SalesWatermark,
+)
+
+
+# Sales analytics served from daily rollup tables
+#
+# The rollups add up the order lines of each day (in the current timezone) by product, category
+# and brand. They are maintained incrementally: a watermark on Order.placed_at remembers up to
+# when the orders are counted, and a refresh recomputes the days from the one of the watermark
+# to now, a few statements per day instead of scanning the order history. Recomputing whole
+# days keeps refreshes idempotent. The watermark stays SALES_ROLLUP_LAG seconds behind now so
+# orders of checkouts still in their transaction are not skipped.
+
+WATERMARK = 'sales'
+
+# Rollup models and their dimensions, as {field: lookup from OrderItem}
+ROLLUPS = [
+    (DailySales, {}),
+    (DailyProductSales, {'product_id': 'product_id', 'category': 'product__category', 'brand': 'product__brand'}),
+    (DailyCategorySales, {'category': 'product__category'}),
+    (DailyBrandSales, {'brand': 'product__brand'}),
+]
+
+# What the dashboards can group by: the rollup model and the fields of a result
+GROUPS = {
+    'day': (DailySales, ['day']),
+    'product': (DailyProductSales, ['product_id']),
+    'category': (DailyCategorySales, ['category']),
+    'brand': (DailyBrandSales, ['brand']),
+}
+
+REVENUE = DecimalField(max_digits=14, decimal_places=2)
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+# The rollup rows of a model for the days from first to last (included)
+def rollup_rows(model, dimensions, first, last):
+    lines = OrderItem.objects.filter(order__placed_at__gte=day_start(first),
+                                     order__placed_at__lt=day_start(last + timedelta(days=1)))
+    rows = lines.annotate(day=TruncDate('order__placed_at')).values('day', *dimensions.values()).annotate(
+        revenue=Sum(F('quantity') * F('unit_price'), output_field=REVENUE),
+        units=Sum('quantity'),
+        orders=Count('order', distinct=True),
+    ).order_by()
+    for row in rows.iterator():
+        yield model(
+            day=row['day'], revenue=row['revenue'], units=row['units'], orders=row['orders'],
+            **{field: row[lookup] for field, lookup in dimensions.items()},
+        )
+
+
+# Replace the rollups of the days from first to last (included), returns the rows written
+def refresh_days(first, last, batch_size=2000):
+    written = 0
+    with transaction.atomic():
+        for model, dimensions in ROLLUPS:
+            model.objects.filter(day__gte=first, day__lte=last).delete()
+            rows = list(rollup_rows(model, dimensions, first, last))
+            model.objects.bulk_create(rows, batch_size=batch_size)
+            written += len(rows)
+    return written
+
+
+def default_until():
+    return timezone.now() - timedelta(seconds=settings.SALES_ROLLUP_LAG)
+
+
+# Count the orders placed since the watermark, up to until, and move the watermark there
+# Returns (first day, last day, rows written), or None when there was nothing to count
+def refresh_sales(until=None):
+    until = until or default_until()
+    refreshed = None
+    with transaction.atomic():
+        # Locked so concurrent refreshes take turns
+        watermark, _ = SalesWatermark.objects.select_for_update().get_or_create(name=WATERMARK)
+        since = watermark.placed_at or Order.objects.aggregate(first=Min('placed_at'))['first']
+        if since is not None and since < until:
+            first, last = timezone.localdate(since), timezone.localdate(until)
+            refreshed = first, last, refresh_days(first, last)
+        if watermark.placed_at is None or watermark.placed_at < until:
+            watermark.placed_at = until
+            watermark.save()
+    if refreshed:
+        invalidate_namespace('analytics')
+    return refreshed
+
+
+# Recompute the rollups from a day (the first order when not given, everything is dropped then)
+# up to until, chunk_days at a time, and move the watermark to until
+# report(first, last, rows) is called after every chunk
+def rebuild_sales(since=None, until=None, chunk_days=31, report=None):
+    until = until or default_until()
+    # Dropping everything and counting again is one transaction, so the dashboards keep the old
+    # rollups until the new ones are complete and a failure leaves them as they were
+    with transaction.atomic() if since is None else nullcontext():
+        if since is None:
+            for model, _ in ROLLUPS:
+                model.objects.all().delete()
+            first_order = Order.objects.aggregate(first=Min('placed_at'))['first']
+            since = first_order and timezone.localdate(first_order)
+
+        written = 0
+        if since is not None:
+            first, end = since, timezone.localdate(until)
+            while first <= end:
+                last = min(first + timedelta(days=chunk_days - 1), end)
+                rows = refresh_days(first, last)
+                written += rows
+                if report:
+                    report(first, last, rows)
+                first = last + timedelta(days=1)
+
+        SalesWatermark.objects.update_or_create(name=WATERMARK, defaults={'placed_at': until})
+    invalidate_namespace('analytics')
+    return written
+
+
+# Revenue, units and orders of the days from start to end (included), in total and grouped by
+# day (every day of the range with sales, in order) or by product, category or brand (the
+# limit best sellers by revenue)
+def sales_report(by, start, end, limit=20):
+    model, fields = GROUPS[by]
+    rollups = model.objects.filter(day__gte=start, day__lte=end)
+    totals = DailySales.objects.filter(day__gte=start, day__lte=end).aggregate(
+        revenue=Sum('revenue'), units=Sum('units'), orders=Sum('orders'),
+    )
+    groups = rollups.values(*fields).annotate(revenue=Sum('revenue'), units=Sum('units'), orders=Sum('orders'))
+    if by == 'day':
+        groups = groups.order_by('day')
+    else:
+        groups = groups.order_by('-revenue', *fields)[:limit]
+
+    results = [report_values(group) for group in groups]
+    if by == 'product':
+        # Grouped on the id alone, the names of the best sellers only are looked up
+        ids = [result['product_id'] for result in results]
+        products = Product.objects.only('name', 'category', 'brand').in_bulk(ids)
+        for result in results:
+            product = products.get(result['product_id'])
+            result.update(name=product and product.name, category=product and product.category,
+                          brand=product and product.brand)
+
+    watermark = SalesWatermark.objects.filter(name=WATERMARK).values_list('placed_at', flat=True).first()
+    return {
+        'by': by,
+        'start': start,
+        'end': end,
+        'refreshed_until': watermark,
+        'totals': report_values(totals),
+        'results': results,
+    }
+
+
+# Revenue as a string like the DecimalFields of the serializers, missing sums as zero
+def report_values(values):
+    values['revenue'] = f"{values['revenue'] or 0:.2f}"
+    values['units'] = values['units'] or 0
+    values['orders'] = values['orders'] or 0
+    return values
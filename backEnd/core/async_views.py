@@ -0,0 +1,125 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotAuthenticated, NotFound
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from .authentication import StatelessJWTAuthentication
+from .cache import response_cache_key, get_cached_response, cache_response
+from .conditional import async_conditional
+from .filters import filter_products
+from .pagination import OrderHistoryPagination, CatalogPagination
+from .serializers import ProductSerializer, ProductListSerializer, CartSerializer, OrderSerializer
+from .models import Product, Cart, Order
+from .views import catalog_validators, product_validators, cart_validators, order_history_validators
+
+
+# Async versions of the hot read endpoints, served under /api/async/ when the project
+# runs on an ASGI server. They answer exactly like their DRF counterparts in views.py
+# (same payloads, ETags, response cache and pagination), but wait on the database with
+# the async ORM instead of holding a worker thread for the whole request.
+
+jwt_authentication = StatelessJWTAuthentication()
+
+
+def render(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+
+# Same checks as StatelessJWTAuthentication.authenticate, the user lookup (a cache
+# read, or a query for older tokens) runs in a worker thread
+async def authenticate(request):
+    header = jwt_authentication.get_header(request)
+    raw_token = jwt_authentication.get_raw_token(header) if header else None
+    if raw_token is None:
+        raise NotAuthenticated()
+    token = jwt_authentication.get_validated_token(raw_token)
+    return await sync_to_async(jwt_authentication.get_user)(token)
+
+
+# Wraps an async GET view: authenticates the user, answers conditional requests
+# from the validator and turns API exceptions into DRF style error responses
+def async_api_view(validator):
+    def decorator(view):
+        conditional_view = async_conditional(validator)(view)
+
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return render({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+            try:
+                request.user = await authenticate(request)
+                return await conditional_view(request, *args, **kwargs)
+            except APIException as exc:
+                response = render(exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail},
+                                  status=exc.status_code)
+                if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+                    response['WWW-Authenticate'] = jwt_authentication.authenticate_header(request)
+                return response
+        return wrapper
+    return decorator
+
+
+@async_api_view(catalog_validators)
+async def product_list(request):
+    cache_key = await sync_to_async(response_cache_key)('products-list', 'catalog', request)
+    data = await sync_to_async(get_cached_response)('products-list', cache_key)
+    if data is not None:
+        return render(data)
+
+    queryset = filter_products(Product.objects.all(), request.GET)
+    paginator = CatalogPagination()
+    api_request = Request(request)
+    context = {'request': request}
+    if paginator.get_page_size(api_request):
+        page = await sync_to_async(paginator.paginate_queryset)(queryset, api_request)
+        data = paginator.get_paginated_response(ProductListSerializer(page, many=True, context=context).data).data
+    else:
+        products = [product async for product in queryset.prefetch_related('variants')]
+        data = ProductSerializer(products, many=True, context=context).data
+
+    await sync_to_async(cache_response)('products-list', cache_key, data)
+    return render(data)
+
+
+@async_api_view(product_validators)
+async def product_detail(request, pk):
+    cache_key = await sync_to_async(response_cache_key)('products-detail', 'catalog', request, pk)
+    data = await sync_to_async(get_cached_response)('products-detail', cache_key)
+    if data is None:
+        product = await Product.objects.prefetch_related('variants').filter(pk=pk).afirst()
+        if product is None:
+            raise NotFound('No Product matches the given query.')
+        data = ProductSerializer(product, context={'request': request}).data
+        await sync_to_async(cache_response)('products-detail', cache_key, data)
+    return render(data)
+
+
+@async_api_view(cart_validators)
+async def my_cart(request):
+    cart = await Cart.objects.with_items().filter(user=request.user).afirst()
+    if not cart:
+        return render({"detail": "No cart found for this user"}, status=404)
+    return render(CartSerializer(cart).data)
+
+
+@async_api_view(order_history_validators)
+async def my_orders(request):
+    cache_key = await sync_to_async(response_cache_key)('orders-history', f'orders:{request.user.pk}', request)
+    data = await sync_to_async(get_cached_response)('orders-history', cache_key)
+    if data is not None:
+        return render(data)
+
+    # The cursor pagination evaluates the page itself, so it runs in a worker thread
+    paginator = OrderHistoryPagination()
+    api_request = Request(request)
+    orders = Order.objects.with_items().filter(user=request.user)
+    page = await sync_to_async(paginator.paginate_queryset)(orders, api_request)
+    if not page and not api_request.query_params.get(paginator.cursor_query_param):
+        return render({"detail": "No orders found for this user"}, status=404)
+
+    data = paginator.get_paginated_response(OrderSerializer(page, many=True).data).data
+    await sync_to_async(cache_response)('orders-history', cache_key, data)
+    return render(data)
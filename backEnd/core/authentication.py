@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import CustomUser, ClaimsUser
+
+
+# Claims added to the tokens issued at login, see CustomTokenObtainPairSerializer.get_token
+USER_CLAIMS = ('is_active', 'is_staff', 'token_version')
+
+# Cached for users that no longer exist, so their tokens do not cost a query either
+MISSING_USER = -1
+
+
+def token_version_key(user_id):
+    return f'auth:token-version:{user_id}'
+
+
+# Current token version of a user from the cache, or from the database on a miss
+# Saving a user refreshes the cached version (see signals.py), the timeout is a safety net
+def current_token_version(user_id):
+    key = token_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = CustomUser.objects.filter(pk=user_id).values_list('token_version', flat=True).first()
+        version = MISSING_USER if version is None else version
+        cache.set(key, version, settings.AUTH_TOKEN_VERSION_CACHE_TIMEOUT)
+    return version
+
+
+# Build the user from the claims, every other field is deferred
+def user_from_claims(user_id, claims):
+    values = {'id': user_id, **{name: claims[name] for name in USER_CLAIMS}}
+    fields = [field.attname for field in ClaimsUser._meta.concrete_fields if field.attname in values]
+    return ClaimsUser.from_db(None, fields, [values[name] for name in fields])
+
+
+# JWT authentication trusting the claims of the token instead of loading the user
+#
+# The signature proves the claims were true when the token was issued. The token version
+# claim is compared with the user's current version, kept in the cache, so a password
+# change, a change of is_active / is_staff or an explicit revoke_tokens() rejects the
+# tokens issued before it. Tokens issued before the claims existed fall back to the
+# regular lookup.
+class StatelessJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if any(claim not in validated_token for claim in USER_CLAIMS):
+            return super().get_user(validated_token)
+
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise AuthenticationFailed('Token contained no recognizable user identification', code='token_not_valid')
+
+        version = current_token_version(user_id)
+        if version == MISSING_USER:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        if version != validated_token['token_version']:
+            raise AuthenticationFailed('Token has been revoked', code='token_revoked')
+        if not validated_token['is_active']:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return user_from_claims(user_id, validated_token)
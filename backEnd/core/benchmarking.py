@@ -0,0 +1,168 @@
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from .models import CustomUser, Product, ProductVariant, Cart, CartItem, Order, OrderItem
+
+
+# Helpers shared by the benchmark management commands
+
+BRANDS = ['Apple', 'Samsung', 'Google', 'Xiaomi', 'OnePlus', 'Sony', 'Anker', 'JBL', 'Huawei', 'Nokia']
+STORAGE_SIZES = ['64GB', '128GB', '256GB', '512GB', '1TB']
+COLORS = ['Black', 'White', 'Silver', 'Gold', 'Blue']
+
+
+# Run the benchmark against a throwaway copy of the database (the test database)
+# so seeding never touches real data, with the test environment set up so the
+# test client can make requests
+@contextmanager
+def benchmark_database(keepdb=False):
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb, serialize=False)
+    try:
+        yield
+    finally:
+        if not keepdb:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+# Insert rows in batches, calling report(done) after every batch
+def bulk_insert(model, rows, batch_size=5000, report=None):
+    batch, done = [], 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            model.objects.bulk_create(batch)
+            done += len(batch)
+            batch = []
+            if report:
+                report(done)
+    if batch:
+        model.objects.bulk_create(batch)
+        done += len(batch)
+        if report:
+            report(done)
+    return done
+
+
+def random_options(key, choices, rng):
+    return [{key: choice, 'in_stock': rng.random() > 0.3} for choice in rng.sample(choices, rng.randint(1, len(choices)))]
+
+
+def generate_products(count, rng):
+    categories = [choice for choice, _ in Product.CATEGORY_CHOICES]
+    for index in range(count):
+        category = rng.choice(categories)
+        brand = rng.choice(BRANDS)
+        yield Product(
+            name=f'{brand} {category} {index}',
+            brand=brand,
+            category=category,
+            description=f'{brand} {category.lower()} number {index} with a long enough description to look real.',
+            price=Decimal(rng.randint(500, 150000)) / 100,
+            stock=rng.choice([0, rng.randint(1, 500)]),
+            storage=random_options('size', STORAGE_SIZES, rng) if 'Phones' in category or category == 'Tablets' else [],
+            colors=random_options('color', COLORS, rng),
+        )
+
+
+# Create the variants of products inserted with bulk_create, which skips Product.save
+def sync_variants(product_ids, batch_size=5000, report=None):
+    for start in range(0, len(product_ids), batch_size):
+        batch = product_ids[start:start + batch_size]
+        ProductVariant.objects.sync_options(Product.objects.filter(id__in=batch).only('id', 'stock', 'storage', 'colors'))
+        if report:
+            report(start + len(batch))
+
+
+# Seed users, products, carts and order histories
+# Returns the ids of the seeded users and products
+def seed(products=1000, users=100, carts=100, orders=100, items_per_cart=3, items_per_order=3,
+         seed_value=42, batch_size=5000, report=None):
+    rng = random.Random(seed_value)
+    report = report or (lambda label, done: None)
+
+    bulk_insert(Product, generate_products(products, rng), batch_size, lambda done: report('products', done))
+    product_ids = list(Product.objects.values_list('id', flat=True))
+    sync_variants(product_ids, batch_size, lambda done: report('product variants', done))
+    prices = dict(Product.objects.values_list('id', 'price'))
+
+    password = make_password(None)  # unusable password, hashing is not what we measure
+    bulk_insert(CustomUser, (
+        CustomUser(username=f'bench{index}', email=f'bench{index}@example.com', password=password)
+        for index in range(max(users, carts))
+    ), batch_size, lambda done: report('users', done))
+    user_ids = list(CustomUser.objects.filter(username__startswith='bench').values_list('id', flat=True))
+
+    bulk_insert(Cart, (Cart(user_id=user_id) for user_id in user_ids[:carts]), batch_size,
+                lambda done: report('carts', done))
+    cart_ids = list(Cart.objects.values_list('id', flat=True))
+    bulk_insert(CartItem, (
+        CartItem(cart_id=cart_id, product_id=product_id, quantity=rng.randint(1, 3))
+        for cart_id in cart_ids
+        for product_id in rng.sample(product_ids, min(items_per_cart, len(product_ids)))
+    ), batch_size, lambda done: report('cart items', done))
+
+    bulk_insert(Order, (
+        Order(user_id=rng.choice(user_ids), shipping_address='1 Bench Street', billing_address='1 Bench Street',
+              payment_method='paypal')
+        for _ in range(orders)
+    ), batch_size, lambda done: report('orders', done))
+
+    def order_items():
+        for order_id in Order.objects.values_list('id', flat=True).iterator(chunk_size=batch_size):
+            for product_id in rng.sample(product_ids, min(items_per_order, len(product_ids))):
+                yield OrderItem(order_id=order_id, product_id=product_id, quantity=rng.randint(1, 3),
+                                unit_price=prices[product_id])
+
+    bulk_insert(OrderItem, order_items(), batch_size, lambda done: report('order items', done))
+    return user_ids, product_ids
+
+
+# Call func repeatedly and return the durations in milliseconds
+def measure(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def percentile(durations, fraction):
+    ordered = sorted(durations)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(durations):
+    return {
+        'p50': percentile(durations, 0.5),
+        'p95': percentile(durations, 0.95),
+        'p99': percentile(durations, 0.99),
+        'mean': statistics.fmean(durations),
+    }
+
+
+# Compare benchmark results with a baseline of the same shape
+# {label: {'p95': ms, 'queries': count, ...}}, returns a description of every regression:
+# a p95 latency more than threshold (a fraction) above the baseline, or any extra query
+def compare_to_baseline(results, baseline, threshold):
+    regressions = []
+    for label, expected in baseline.items():
+        actual = results.get(label)
+        if actual is None:
+            continue
+        if actual['queries'] > expected['queries']:
+            regressions.append(f"{label}: {actual['queries']} queries, baseline {expected['queries']}")
+        if actual['p95'] > expected['p95'] * (1 + threshold):
+            regressions.append(f"{label}: p95 {actual['p95']:.2f} ms, baseline {expected['p95']:.2f} ms "
+                               f"(+{(actual['p95'] / expected['p95'] - 1) * 100:.0f}%)")
+    return regressions
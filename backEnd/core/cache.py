@@ -0,0 +1,191 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .db_routers import pin_current_request
+
+
+# Two tier cache for the responses of the read endpoints
+#
+# Every process keeps a small LRU of recent responses in front of the shared cache
+# backend (Redis in production, an in-memory stand-in otherwise). Responses are stored
+# under keys that carry the version of a namespace ("catalog", "orders:<user id>").
+# Invalidating a namespace bumps its version in the shared backend, which makes every
+# cached response of the namespace unreachable at once, in all processes, without
+# having to find and delete them. Versions are always read from the shared backend.
+#
+# With read replicas, a replica may not have the change yet when the version is bumped:
+# for as long as a replica can lag behind, requests building responses of the namespace
+# read from the primary, so no response of the new version is built from old rows.
+
+
+# Per-process LRU with a bounded size and a time to live for each entry
+class LocalCache:
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    # Returns the number of entries evicted to make room
+    def set(self, key, value, timeout):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + timeout)
+            self.entries.move_to_end(key)
+            evicted = 0
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Hit, miss and eviction counters of this process, per policy,
+# and invalidation counters per kind of namespace
+class CacheStats:
+    FIELDS = ['local_hits', 'shared_hits', 'misses', 'sets', 'local_evictions']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def increment(self, policy, field, amount=1):
+        with self.lock:
+            counters = self.policies.setdefault(policy, dict.fromkeys(self.FIELDS, 0))
+            counters[field] += amount
+
+    def invalidated(self, namespace):
+        kind = namespace.split(':')[0]
+        with self.lock:
+            self.invalidations[kind] = self.invalidations.get(kind, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'policies': {policy: dict(counters) for policy, counters in self.policies.items()},
+                'invalidations': dict(self.invalidations),
+            }
+
+    def reset(self):
+        self.policies = {}
+        self.invalidations = {}
+
+
+local_cache = LocalCache(settings.RESPONSE_CACHE_LOCAL_MAX_ENTRIES)
+stats = CacheStats()
+
+
+def shared_cache():
+    return caches[settings.RESPONSE_CACHE_ALIAS]
+
+
+def get_policy(name):
+    return settings.RESPONSE_CACHE_POLICIES[name]
+
+
+def namespace_key(namespace):
+    return f'version:{namespace}'
+
+
+def recent_change_key(namespace):
+    return f'changed:{namespace}'
+
+
+# Versions start from the current time in milliseconds rather than from 1, so a version
+# lost with a flush of the shared cache never comes back with the same number while
+# local caches still hold responses stored under it
+def new_version():
+    return int(time.time() * 1000)
+
+
+def get_namespace_version(namespace):
+    cache = shared_cache()
+    version = cache.get(namespace_key(namespace))
+    if version is None:
+        cache.add(namespace_key(namespace), new_version(), timeout=None)
+        version = cache.get(namespace_key(namespace))
+    return version
+
+
+# Make every cached response of the namespace unreachable
+def invalidate_namespace(namespace):
+    cache = shared_cache()
+    try:
+        cache.incr(namespace_key(namespace))
+    except ValueError:
+        # The version is not in the cache yet
+        cache.add(namespace_key(namespace), new_version(), timeout=None)
+    if settings.DATABASE_REPLICAS:
+        lag_window = settings.DATABASE_REPLICA_MAX_LAG + settings.DATABASE_REPLICA_LAG_CHECK_SECONDS
+        cache.set(recent_change_key(namespace), True, math.ceil(lag_window))
+    stats.invalidated(namespace)
+
+
+# Build the cache key of a response
+# The host is part of the key because the responses contain absolute URLs. So are the
+# validators of conditional views (see conditional.py): they also change with things that
+# do not invalidate the namespace, e.g. the products shown in the order history, and a new
+# ETag must never be served with a body cached before the change
+def response_cache_key(policy, namespace, request, *parts):
+    if settings.DATABASE_REPLICAS and shared_cache().get(recent_change_key(namespace)):
+        pin_current_request()
+    params = sorted(request.GET.lists())
+    validators = getattr(request, 'resource_validators', None)
+    signature = hashlib.md5(repr((request.get_host(), params, parts, validators)).encode()).hexdigest()
+    return f'response:{policy}:{namespace}:{get_namespace_version(namespace)}:{signature}'
+
+
+def get_cached_response(policy, key):
+    data = local_cache.get(key)
+    if data is not None:
+        stats.increment(policy, 'local_hits')
+        return data
+
+    data = shared_cache().get(key)
+    if data is not None:
+        stats.increment(policy, 'shared_hits')
+        local_timeout = get_policy(policy)['local_timeout']
+        if local_timeout:
+            stats.increment(policy, 'local_evictions', local_cache.set(key, data, local_timeout))
+        return data
+
+    stats.increment(policy, 'misses')
+    return None
+
+
+def cache_response(policy, key, data):
+    timeouts = get_policy(policy)
+    shared_cache().set(key, data, timeouts['timeout'])
+    if timeouts['local_timeout']:
+        stats.increment(policy, 'local_evictions', local_cache.set(key, data, timeouts['local_timeout']))
+    stats.increment(policy, 'sets')
+
+
+def cache_stats():
+    return {
+        'local_entries': len(local_cache),
+        'local_max_entries': local_cache.max_entries,
+        **stats.snapshot(),
+    }
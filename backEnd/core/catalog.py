@@ -0,0 +1,141 @@
+import csv
+import json
+import resource
+import sys
+
+from django.core.exceptions import ValidationError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from .forms import clean_storage, clean_colors
+from .models import Product, ProductVariant
+
+
+# Streaming catalog import/export, used by the catalog_import and catalog_export commands
+#
+# Files are CSV (storage and colors as JSON text) or JSON lines, with the columns of
+# COLUMNS. Both directions work in fixed-size chunks so memory stays flat whatever the
+# size of the file: exports iterate over the table with a cursor, imports validate a
+# chunk of rows and upsert it with one INSERT ... ON CONFLICT (id) DO UPDATE.
+
+COLUMNS = ['id', 'name', 'brand', 'description', 'price', 'stock', 'category', 'image', 'storage', 'colors']
+FORMATS = ['csv', 'jsonl']
+# Checked with the rules of the model fields (required, max length, digits, choices, positive)
+CHECKED_FIELDS = ['name', 'brand', 'description', 'price', 'stock', 'category']
+# Columns overwritten when a row updates an existing product (created_at is kept)
+UPDATE_FIELDS = CHECKED_FIELDS + ['image', 'storage', 'colors', 'updated_at']
+
+
+# The format of a file from --format or from its extension
+def file_format(path, requested=None):
+    if requested:
+        return requested
+    for name in FORMATS:
+        if path.endswith(f'.{name}'):
+            return name
+    return 'csv'
+
+
+# Peak memory of the process in MB (ru_maxrss is in KB on Linux, bytes on macOS)
+def peak_memory_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+# Export
+
+def export_rows(queryset, chunk_size=2000):
+    return queryset.order_by('id').values_list(*COLUMNS).iterator(chunk_size=chunk_size)
+
+
+def write_csv(rows, output):
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    for count, row in enumerate(rows, 1):
+        row = list(row)
+        row[-2:] = [json.dumps(row[-2] or []), json.dumps(row[-1] or [])]
+        writer.writerow(row)
+        yield count
+
+
+def write_jsonl(rows, output):
+    for count, row in enumerate(rows, 1):
+        data = dict(zip(COLUMNS, row))
+        data['price'] = str(data['price'])
+        data['storage'] = data['storage'] or []
+        data['colors'] = data['colors'] or []
+        output.write(json.dumps(data) + '\n')
+        yield count
+
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+
+# Import
+
+def read_csv(file):
+    yield from csv.DictReader(file)
+
+
+def read_jsonl(file):
+    for line in file:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Reported as an invalid row instead of stopping the import
+            yield None
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+FIELDS = {name: Product._meta.get_field(name) for name in CHECKED_FIELDS}
+
+
+# An unsaved product from an imported row, raises a ValidationError with the problems of the row
+def product_from_row(row):
+    if not isinstance(row, dict):
+        raise ValidationError('Not a JSON object.')
+    values, errors = {}, []
+    for name, field in FIELDS.items():
+        try:
+            values[name] = field.clean(row.get(name), None)
+        except ValidationError as error:
+            errors.extend(f'{name}: {message}' for message in error.messages)
+    for name, clean in [('storage', clean_storage), ('colors', clean_colors)]:
+        try:
+            values[name] = clean(row.get(name) or [])
+        except ValidationError as error:
+            errors.extend(f'{name}: {message}' for message in error.messages)
+    try:
+        values['id'] = int(row['id']) if row.get('id') not in (None, '') else None
+    except (TypeError, ValueError):
+        errors.append(f"id: '{row.get('id')}' is not a number.")
+    if errors:
+        raise ValidationError(errors)
+    return Product(image=row.get('image') or '', **values)
+
+
+# Insert or update a chunk of valid products in one statement, then bring their variants
+# in line with their options and stock. Returns the number of products whose image changed, their renditions are
+# emptied for generate_image_renditions to make them again
+def upsert_products(products):
+    # A product listed twice in a chunk keeps its last row (an upsert cannot touch a row twice)
+    products = list({product.pk or -index: product for index, product in enumerate(products, 1)}.values())
+    ids = [product.pk for product in products if product.pk is not None]
+    with transaction.atomic():
+        images = dict(Product.objects.filter(pk__in=ids).values_list('id', 'image'))
+        Product.objects.bulk_create(products, update_conflicts=True, unique_fields=['id'], update_fields=UPDATE_FIELDS)
+        changed = [product.pk for product in products if product.pk in images and images[product.pk] != product.image.name]
+        if changed:
+            Product.objects.filter(pk__in=changed).update(image_renditions={})
+        ProductVariant.objects.sync_options(products, restock=True)
+    return len(changed) + sum(1 for product in products if product.pk not in images and product.image)
+
+
+# Rows imported with explicit ids leave the PostgreSQL sequence behind, move it past them
+def reset_product_sequence():
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Product]):
+            cursor.execute(sql)
@@ -0,0 +1,71 @@
+import hashlib
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+
+# Decorators adding conditional GET support (ETag / Last-Modified) to a view
+#
+# validator(view, request, *args, **kwargs) returns a tuple (parts, last_modified) computed
+# from cheap timestamps, or None to skip the conditional handling. The parts identify the
+# state of the resource and are hashed together with the request path into a weak ETag,
+# so a client polling an unchanged resource gets a 304 without the body being serialized.
+# The parts are kept on the request as resource_validators, the response cache adds them
+# to its keys so a cached body always matches the ETag it is served with.
+
+
+def resource_etag(request, validators):
+    parts, last_modified = validators
+    digest = hashlib.md5(repr((request.get_full_path(), parts)).encode()).hexdigest()
+    return f'W/"{digest}"', int(last_modified.timestamp()) if last_modified else None
+
+
+def add_validators(response, etag, last_modified):
+    if response.status_code == 200:
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        # Responses are per user, let the client keep them but revalidate every time
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+    return response
+
+
+# For viewset methods
+def conditional(validator):
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            validators = validator(self, request, *args, **kwargs)
+            if validators is None:
+                return method(self, request, *args, **kwargs)
+            request.resource_validators = validators[0]
+
+            etag, last_modified = resource_etag(request, validators)
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is not None:
+                return response
+            return add_validators(method(self, request, *args, **kwargs), etag, last_modified)
+        return wrapper
+    return decorator
+
+
+# For async function views, the validator runs in a worker thread like the rest of the ORM
+def async_conditional(validator):
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            validators = await sync_to_async(validator)(None, request, *args, **kwargs)
+            if validators is None:
+                return await view(request, *args, **kwargs)
+            request.resource_validators = validators[0]
+
+            etag, last_modified = resource_etag(request, validators)
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is not None:
+                return response
+            return add_validators(await view(request, *args, **kwargs), etag, last_modified)
+        return wrapper
+    return decorator
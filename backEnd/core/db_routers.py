@@ -0,0 +1,120 @@
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, DatabaseError
+from django.utils.functional import SimpleLazyObject
+
+
+# Request being handled by the current thread or task, set by ReplicaRoutingMiddleware
+current_request = ContextVar('current_request', default=None)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def pin_key(user_id):
+    return f'replica-pin:{user_id}'
+
+
+# Send reads to the primary for a while after a user writes, so they read their own writes
+def pin_to_primary(user_id):
+    cache.set(pin_key(user_id), True, settings.DATABASE_REPLICA_PIN_SECONDS)
+
+
+# Send the remaining reads of the current request to the primary, e.g. while the replicas
+# may not have a change yet
+def pin_current_request():
+    request = current_request.get()
+    if request is not None:
+        request._pinned_to_primary = True
+
+
+# The user of the request if it is already known, without loading it: reading the lazy
+# request.user of AuthenticationMiddleware queries the session and the user, and those
+# reads come back to the router. DRF sets the authenticated user on the request
+def known_user(request):
+    user = getattr(request, 'user', None)
+    if isinstance(user, SimpleLazyObject):
+        return getattr(request, '_cached_user', None)
+    return user
+
+
+# Whether the reads of the request must go to the primary: requests that write, requests
+# of users who wrote in the last few seconds, and the reads that look the user up
+def is_pinned(request):
+    if request.method not in SAFE_METHODS:
+        return True
+    pinned = getattr(request, '_pinned_to_primary', None)
+    if pinned is not None:
+        return pinned
+    user = known_user(request)
+    if user is None:
+        # Still being authenticated, decide again once we know the user
+        return True
+    if not user.is_authenticated:
+        return False
+    request._pinned_to_primary = bool(cache.get(pin_key(user.pk)))
+    return request._pinned_to_primary
+
+
+# Seconds the replica is behind the primary, None when it cannot be reached
+# The result is kept for a few seconds so the check does not cost a query per read
+_lag_checks = {}
+
+
+def replica_lag(alias):
+    checked_at, lag = _lag_checks.get(alias, (0, None))
+    if time.monotonic() - checked_at < settings.DATABASE_REPLICA_LAG_CHECK_SECONDS:
+        return lag
+    try:
+        connection = connections[alias]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # Time since the last replayed transaction, 0 on a server that is not in recovery
+                cursor.execute(
+                    "SELECT CASE WHEN pg_is_in_recovery() "
+                    "THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) "
+                    "ELSE 0 END"
+                )
+                lag = float(cursor.fetchone()[0])
+        else:
+            # No way to measure it, e.g. SQLite files standing in for replicas
+            lag = 0.0
+    except DatabaseError:
+        lag = None
+    _lag_checks[alias] = (time.monotonic(), lag)
+    return lag
+
+
+def healthy_replicas():
+    return [
+        alias for alias in settings.DATABASE_REPLICAS
+        if (lag := replica_lag(alias)) is not None and lag <= settings.DATABASE_REPLICA_MAX_LAG
+    ]
+
+
+# Routes the reads of safe requests to the replicas (DATABASE_REPLICAS) and everything
+# else to the primary. Falls back to the primary when a request is pinned, inside a
+# transaction on the primary, or when no replica is within DATABASE_REPLICA_MAX_LAG.
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS:
+            return 'default'
+        request = current_request.get()
+        if request is None or is_pinned(request) or connections['default'].in_atomic_block:
+            return 'default'
+        # The reads of a request stay on one replica, so they see the same point in time
+        replica = getattr(request, '_replica', None)
+        if replica is None:
+            replicas = healthy_replicas()
+            replica = request._replica = random.choice(replicas) if replicas else 'default'
+        return replica
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    # All aliases hold the same data
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
@@ -0,0 +1,100 @@
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from .filters import filter_orders
+from .models import Order, OrderItem
+
+
+# Streaming exports of the orders for reporting, used by the orders export endpoint and the
+# orders_export command
+#
+# Rows are read with a chunked iterator over one joined query (the values of the related
+# user, product and variant come with each row, as select_related would bring them) and
+# encoded a block at a time, so memory stays flat whatever the number of orders.
+
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+# (column, lookup) of an export row
+ORDER_COLUMNS = [
+    ('order_id', 'id'),
+    ('placed_at', 'placed_at'),
+    ('status', 'status'),
+    ('user_id', 'user_id'),
+    ('email', 'user__email'),
+    ('payment_method', 'payment_method'),
+    ('total', 'total'),
+]
+LINE_COLUMNS = [
+    ('order_id', 'order_id'),
+    ('placed_at', 'order__placed_at'),
+    ('order_status', 'order__status'),
+    ('email', 'order__user__email'),
+    ('line_id', 'id'),
+    ('status', 'status'),
+    ('product_id', 'product_id'),
+    ('product', 'product__name'),
+    ('brand', 'product__brand'),
+    ('category', 'product__category'),
+    ('variant_id', 'variant_id'),
+    ('size', 'size'),
+    ('color', 'color'),
+    ('quantity', 'quantity'),
+    ('unit_price', 'unit_price'),
+]
+
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+# (columns, rows) of the orders, or of their lines, matching the filters of filter_orders
+# Lines get their total (quantity x unit price) as the last column
+def order_rows(params, lines=False, chunk_size=2000):
+    if lines:
+        columns = LINE_COLUMNS
+        queryset = filter_orders(OrderItem.objects.all(), params, prefix='order__')
+        queryset = queryset.order_by('order__placed_at', 'order_id', 'id')
+    else:
+        columns = ORDER_COLUMNS
+        queryset = filter_orders(Order.objects.all(), params).order_by('placed_at', 'id')
+    names = [name for name, _ in columns]
+    rows = queryset.values_list(*[lookup for _, lookup in columns]).iterator(chunk_size=chunk_size)
+    if lines:
+        names.append('total')
+        rows = (row + (row[-2] * row[-1],) for row in rows)
+    return names, ([export_value(value) for value in row] for row in rows)
+
+
+# The rows as text blocks of chunk_size rows, for a StreamingHttpResponse or a file
+def encode_csv(columns, rows, chunk_size=2000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def encode_jsonl(columns, rows, chunk_size=2000):
+    block = []
+    for row in rows:
+        block.append(json.dumps(dict(zip(columns, row))))
+        if len(block) == chunk_size:
+            yield '\n'.join(block) + '\n'
+            block = []
+    if block:
+        yield '\n'.join(block) + '\n'
+
+
+ENCODERS = {'csv': encode_csv, 'jsonl': encode_jsonl}
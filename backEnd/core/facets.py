@@ -0,0 +1,69 @@
+from .search import read_connection, search_terms, filter_matching
+
+
+# Facet counts of the catalog for category pages: products per category, brand, price
+# bucket and per storage size / color with a variant in stock, over the products matching
+# the catalog filters (and the search query q, when given).
+#
+# Every facet is one GROUP BY over the same filtered products (or their variants) and they
+# are put together with UNION ALL, so the database computes all of them in a single query.
+
+# Upper bounds of the price buckets, the last bucket has no upper bound
+PRICE_BUCKETS = [50, 100, 250, 500, 1000]
+
+# Facet name and the column of the variants it counts
+OPTION_FACETS = [('storage', 'storage'), ('colors', 'color')]
+
+
+def price_bucket_labels():
+    bounds = [0] + PRICE_BUCKETS
+    return [f'{low}-{high}' for low, high in zip(bounds, PRICE_BUCKETS)] + [f'{PRICE_BUCKETS[-1]}+']
+
+
+def price_bucket_sql():
+    labels = price_bucket_labels()
+    cases = ' '.join(f"WHEN price < {bound} THEN '{label}'" for bound, label in zip(PRICE_BUCKETS, labels))
+    return f"CASE {cases} ELSE '{labels[-1]}' END"
+
+
+def facets_sql(queryset):
+    filtered_sql, params = queryset.order_by().values('id', 'category', 'brand', 'price').query.sql_with_params()
+    selects = [
+        "SELECT 'total', NULL, COUNT(*) FROM filtered",
+        "SELECT 'category', category, COUNT(*) FROM filtered GROUP BY category",
+        "SELECT 'brand', brand, COUNT(*) FROM filtered GROUP BY brand",
+        f"SELECT 'price', {price_bucket_sql()}, COUNT(*) FROM filtered GROUP BY 2",
+    ]
+    for name, column in OPTION_FACETS:
+        selects.append(
+            f"SELECT '{name}', {column}, COUNT(DISTINCT product_id) FROM core_productvariant "
+            f"WHERE stock > 0 AND {column} <> '' AND product_id IN (SELECT id FROM filtered) GROUP BY {column}"
+        )
+    # Not materialized: each facet reads the table itself and can use the covering
+    # indexes on category and brand instead of a temporary copy of the filtered products
+    sql = f'WITH filtered AS NOT MATERIALIZED ({filtered_sql}) ' + ' UNION ALL '.join(selects)
+    return sql, params
+
+
+# {"count": ..., "category": [{"value": ..., "count": ...}, ...], "brand": ..., "price": ...,
+# "storage": ..., "colors": ...}, the most common values first and the price buckets in order
+def product_facets(queryset, query=None):
+    terms = search_terms(query or '')
+    if terms:
+        queryset = filter_matching(queryset, terms)
+    sql, params = facets_sql(queryset)
+    with read_connection().cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    facets = {'count': 0, 'category': [], 'brand': [], 'price': [], 'storage': [], 'colors': []}
+    for facet, value, count in rows:
+        if facet == 'total':
+            facets['count'] = count
+        else:
+            facets[facet].append({'value': value, 'count': count})
+    for facet in ['category', 'brand', 'storage', 'colors']:
+        facets[facet].sort(key=lambda bucket: (-bucket['count'], str(bucket['value'])))
+    labels = price_bucket_labels()
+    facets['price'].sort(key=lambda bucket: labels.index(bucket['value']))
+    return facets
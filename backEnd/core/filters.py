@@ -0,0 +1,131 @@
+from datetime import datetime, time
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+from .models import ProductVariant
+
+
+# Orderings the catalog can be sorted by
+PRODUCT_ORDERINGS = {'name', '-name', 'price', '-price', 'created_at', '-created_at'}
+
+TRUE_VALUES = {'true', '1', 'yes'}
+FALSE_VALUES = {'false', '0', 'no'}
+
+
+# Split a comma separated query parameter into a list of values
+def split_param(params, name):
+    return [value.strip() for value in params.get(name, '').split(',') if value.strip()]
+
+
+def parse_price(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValidationError({name: 'Enter a valid price.'})
+
+
+# Apply the catalog filters from the query parameters to a product queryset
+# Supported parameters: category, brand, storage, color (comma separated), min_price,
+# max_price, in_stock (true/false) and ordering (one of PRODUCT_ORDERINGS)
+def filter_products(queryset, params):
+    categories = split_param(params, 'category')
+    if categories:
+        queryset = queryset.filter(category__in=categories)
+
+    brands = split_param(params, 'brand')
+    if brands:
+        queryset = queryset.filter(brand__in=brands)
+
+    # Products with a variant in stock in one of the storage sizes and colors, e.g. "256GB in Black"
+    storages = split_param(params, 'storage')
+    colors = split_param(params, 'color')
+    if storages or colors:
+        variants = ProductVariant.objects.filter(product=OuterRef('pk'), stock__gt=0)
+        if storages:
+            variants = variants.filter(storage__in=storages)
+        if colors:
+            variants = variants.filter(color__in=colors)
+        queryset = queryset.filter(Exists(variants))
+
+    min_price = parse_price(params, 'min_price')
+    if min_price is not None:
+        queryset = queryset.filter(price__gte=min_price)
+
+    max_price = parse_price(params, 'max_price')
+    if max_price is not None:
+        queryset = queryset.filter(price__lte=max_price)
+
+    in_stock = params.get('in_stock', '').lower()
+    if in_stock in TRUE_VALUES:
+        queryset = queryset.filter(stock__gt=0)
+    elif in_stock in FALSE_VALUES:
+        queryset = queryset.filter(stock=0)
+
+    ordering = params.get('ordering')
+    if ordering:
+        if ordering not in PRODUCT_ORDERINGS:
+            raise ValidationError({'ordering': f'Choose one of {sorted(PRODUCT_ORDERINGS)}.'})
+        queryset = queryset.order_by(ordering, 'id')
+    else:
+        queryset = queryset.order_by('id')
+
+    return queryset
+
+
+# A date (midnight in the current timezone) or a datetime from a query parameter
+def parse_moment(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            moment = day and datetime.combine(day, time.min)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise ValidationError({name: 'Enter a valid date or datetime (ISO 8601).'})
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+# A date from a query parameter
+def parse_day(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise ValidationError({name: 'Enter a valid date (YYYY-MM-DD).'})
+    return day
+
+
+# Apply the order export filters from the query parameters to an order queryset
+# Supported parameters: placed_after (included), placed_before (excluded) as ISO dates or
+# datetimes and status (comma separated), e.g. placed_after=2025-01-01&placed_before=2025-02-01
+def filter_orders(queryset, params, prefix=''):
+    placed_after = parse_moment(params, 'placed_after')
+    if placed_after is not None:
+        queryset = queryset.filter(**{f'{prefix}placed_at__gte': placed_after})
+
+    placed_before = parse_moment(params, 'placed_before')
+    if placed_before is not None:
+        queryset = queryset.filter(**{f'{prefix}placed_at__lt': placed_before})
+
+    statuses = split_param(params, 'status')
+    if statuses:
+        queryset = queryset.filter(**{f'{prefix}status__in': statuses})
+
+    return queryset
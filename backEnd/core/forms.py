@@ -2,9 +2,48 @@ from django import forms
 from .models import Product
 import json
 
+STORAGE_OPTIONS = {"64GB", "128GB", "256GB", "512GB", "1TB"}
+COLOR_OPTIONS = {"Black", "White", "Silver", "Gold", "Blue"}
+
+
+# Validation of the storage/colors JSON options, shared by the admin form and the catalog import
+# Takes the JSON text or the parsed list, returns the list or raises a ValidationError
+def clean_options(raw_value, key, allowed, label, example):
+    if isinstance(raw_value, str):
+        try:
+            value = json.loads(raw_value)
+        except Exception:
+            raise forms.ValidationError(f'Invalid JSON format. Example: {example}')
+    else:
+        value = raw_value
+
+    if not isinstance(value, list):
+        raise forms.ValidationError(f"{label} must be a list.")
+
+    for item in value:
+        if not isinstance(item, dict):
+            raise forms.ValidationError(f"Each item must be a dictionary with keys '{key}' and 'in_stock'.")
+        if key not in item or "in_stock" not in item:
+            raise forms.ValidationError(f"Missing '{key}' or 'in_stock' in one or more items.")
+        if item[key] not in allowed:
+            raise forms.ValidationError(f"Invalid {key}: '{item[key]}'. Allowed: {sorted(allowed)}")
+        if not isinstance(item["in_stock"], bool):
+            raise forms.ValidationError(f"'in_stock' must be true or false for {key} '{item[key]}'.")
+
+    return value
+
+
+def clean_storage(raw_value):
+    return clean_options(raw_value, 'size', STORAGE_OPTIONS, 'Storage', '[{"size": "128GB", "in_stock": true}]')
+
+
+def clean_colors(raw_value):
+    return clean_options(raw_value, 'color', COLOR_OPTIONS, 'Colors', '[{"color": "Black", "in_stock": true}]')
+
+
 class ProductAdminForm(forms.ModelForm):
-    STORAGE_OPTIONS = {"64GB", "128GB", "256GB", "512GB", "1TB"}
-    COLOR_OPTIONS = {"Black", "White", "Silver", "Gold", "Blue"}
+    STORAGE_OPTIONS = STORAGE_OPTIONS
+    COLOR_OPTIONS = COLOR_OPTIONS
 
     class Meta:
         model = Product
@@ -14,52 +53,15 @@ class ProductAdminForm(forms.ModelForm):
             'colors': 'Enter a JSON list like: [{"color": "Black", "in_stock": true}]. Allowed colors: Black, White, Silver, Gold, Blue',
         }
 
+    # Show the options with the availability of the variants, which checkouts keep current
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk and self.instance.variants.exists():
+            self.initial['storage'] = self.instance.storage_options()
+            self.initial['colors'] = self.instance.color_options()
+
     def clean_storage(self):
-        raw_value = self.cleaned_data.get('storage')
-        if isinstance(raw_value, str):
-            try:
-                value = json.loads(raw_value)
-            except Exception:
-                raise forms.ValidationError('Invalid JSON format. Example: [{"size": "128GB", "in_stock": true}]')
-        else:
-            value = raw_value
-
-        if not isinstance(value, list):
-            raise forms.ValidationError("Storage must be a list.")
-
-        for item in value:
-            if not isinstance(item, dict):
-                raise forms.ValidationError("Each item must be a dictionary with keys 'size' and 'in_stock'.")
-            if "size" not in item or "in_stock" not in item:
-                raise forms.ValidationError("Missing 'size' or 'in_stock' in one or more items.")
-            if item["size"] not in self.STORAGE_OPTIONS:
-                raise forms.ValidationError(f"Invalid size: '{item['size']}'. Allowed: {sorted(self.STORAGE_OPTIONS)}")
-            if not isinstance(item["in_stock"], bool):
-                raise forms.ValidationError(f"'in_stock' must be true or false for size '{item['size']}'.")
-
-        return value
+        return clean_storage(self.cleaned_data.get('storage'))
 
     def clean_colors(self):
-        raw_value = self.cleaned_data.get('colors')
-        if isinstance(raw_value, str):
-            try:
-                value = json.loads(raw_value)
-            except Exception:
-                raise forms.ValidationError('Invalid JSON format. Example: [{"color": "Black", "in_stock": true}]')
-        else:
-            value = raw_value
-
-        if not isinstance(value, list):
-            raise forms.ValidationError("Colors must be a list.")
-
-        for item in value:
-            if not isinstance(item, dict):
-                raise forms.ValidationError("Each item must be a dictionary with keys 'color' and 'in_stock'.")
-            if "color" not in item or "in_stock" not in item:
-                raise forms.ValidationError("Missing 'color' or 'in_stock' in one or more items.")
-            if item["color"] not in self.COLOR_OPTIONS:
-                raise forms.ValidationError(f"Invalid color: '{item['color']}'. Allowed: {sorted(self.COLOR_OPTIONS)}")
-            if not isinstance(item["in_stock"], bool):
-                raise forms.ValidationError(f"'in_stock' must be true or false for color '{item['color']}'.")
-
-        return value
+        return clean_colors(self.cleaned_data.get('colors'))
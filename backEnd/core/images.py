@@ -0,0 +1,123 @@
+import base64
+import hashlib
+import io
+import logging
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageFilter, ImageOps
+
+try:
+    # AVIF support for Pillow versions without it built in (pip install pillow-avif-plugin)
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+
+logger = logging.getLogger('core.images')
+
+
+# Responsive renditions of the product images
+#
+# Every uploaded image is resized to the widths of PRODUCT_IMAGE_WIDTHS (never upscaled)
+# in WebP, and in AVIF as well when Pillow can write it, next to a tiny blurred placeholder
+# inlined as a data URI. The files are named after a hash of the original, so identical
+# uploads share their renditions and the URLs can be cached forever.
+# Product.image_renditions holds what was generated:
+#   {"hash": ..., "width": ..., "height": ..., "placeholder": "data:image/webp;base64,...",
+#    "formats": {"avif": {"160": "<path>", ...}, "webp": {"160": "<path>", ...}}}
+
+RENDITIONS_DIR = 'product_images/renditions'
+PLACEHOLDER_WIDTH = 16
+
+
+# Best format first, as the browsers should pick them
+def output_formats():
+    Image.init()
+    return [name for name in ['avif', 'webp'] if name.upper() in Image.SAVE]
+
+
+def open_image(data):
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    return image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+
+def encode(image, image_format, quality):
+    output = io.BytesIO()
+    image.save(output, image_format.upper(), quality=quality)
+    return output.getvalue()
+
+
+def resize(image, width):
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def placeholder(image):
+    tiny = resize(image, min(PLACEHOLDER_WIDTH, image.width)).filter(ImageFilter.GaussianBlur(1))
+    return 'data:image/webp;base64,' + base64.b64encode(encode(tiny, 'webp', 30)).decode()
+
+
+# The renditions of an image as (renditions, {path: bytes}), without touching the storage
+def build_renditions(data):
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    image = open_image(data)
+    # Widths up to the one of the original, which stands in when it is smaller than all of them
+    widths = [width for width in settings.PRODUCT_IMAGE_WIDTHS if width <= image.width] or [image.width]
+
+    files, formats = {}, {}
+    for image_format in output_formats():
+        formats[image_format] = {}
+        for width in widths:
+            path = f'{RENDITIONS_DIR}/{digest}-{width}.{image_format}'
+            files[path] = encode(resize(image, width), image_format, settings.PRODUCT_IMAGE_QUALITY)
+            formats[image_format][str(width)] = path
+    renditions = {
+        'hash': digest,
+        'width': image.width,
+        'height': image.height,
+        'placeholder': placeholder(image),
+        'formats': formats,
+    }
+    return renditions, files
+
+
+# Generate and store the renditions of an image file of the storage, returns the renditions
+def generate_renditions(name):
+    with default_storage.open(name, 'rb') as original:
+        data = original.read()
+    renditions, files = build_renditions(data)
+    for path, content in files.items():
+        # Same hash, same content: a rendition stored before is reused
+        if not default_storage.exists(path):
+            default_storage.save(path, ContentFile(content))
+    return renditions
+
+
+# Renditions of a product image, empty when the image cannot be read (the backfill command retries those)
+def renditions_for(name):
+    if not name:
+        return {}
+    try:
+        return generate_renditions(name)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        logger.exception('Could not generate the renditions of %s', name)
+        return {}
+
+
+# {"placeholder": ..., "width": ..., "height": ..., "avif": "<url> 160w, ...", "webp": "<url> 160w, ..."}
+# for the srcset attributes of a <picture>, None without renditions
+def srcset(renditions, request=None):
+    if not renditions:
+        return None
+    data = {'placeholder': renditions['placeholder'], 'width': renditions['width'], 'height': renditions['height']}
+    for image_format, paths in renditions['formats'].items():
+        urls = []
+        for width, path in paths.items():
+            url = default_storage.url(path)
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            urls.append(f'{url} {width}w')
+        data[image_format] = ', '.join(urls)
+    return data
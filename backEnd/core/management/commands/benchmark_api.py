@@ -0,0 +1,254 @@
+import json
+import platform
+import statistics
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from core.analytics import rebuild_sales
+from core.benchmarking import benchmark_database, seed, summarize, compare_to_baseline
+from core.cache import local_cache
+from core.models import CustomUser, Product, Cart, CartItem, Order, OrderItem, UserProfile
+from core.routers import urlpatterns
+
+
+BENCHMARK_PASSWORD = 'benchmark-password'
+
+
+# One request of the benchmark: route is the URL name in core/routers.py (or 'auth-login'),
+# send(client, index, prepared) makes the request and prepare(index), when given,
+# does the untimed setup it needs (e.g. creating the cart item a DELETE removes)
+class Scenario:
+    def __init__(self, method, route, send, prepare=None, variant=''):
+        self.label = f'{method} {route}{variant}'
+        self.route = route
+        self.send = send
+        self.prepare = prepare
+
+
+# Counts the queries run on a connection, without keeping them like CaptureQueriesContext
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def url(route, *args, query=''):
+    return reverse(f'core:{route}', args=args) + query
+
+
+# Read a streamed response to the end, the time to stream it is part of the request
+def streamed(response):
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    return response
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark every route of the API (and auth/login/) in process against a seeded throwaway '
+        'database: latency percentiles, requests/s and queries per request. Compares the results with '
+        'a baseline file and fails on regressions, or saves a new baseline with --save-baseline.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=30, help='Timed requests per scenario.')
+        parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per scenario first.')
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--orders', type=int, default=500)
+        parser.add_argument('--cold', action='store_true', help='Clear the response cache before every request.')
+        parser.add_argument('--only', help='Only run the scenarios whose label contains this text.')
+        parser.add_argument('--baseline', default=str(Path(settings.BASE_DIR) / 'benchmarks' / 'baseline.json'))
+        parser.add_argument('--save-baseline', action='store_true', help='Write the results as the new baseline.')
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help='Allowed p95 slowdown against the baseline, as a fraction (0.25 = 25%%).')
+        parser.add_argument('--output', help='Also write the results to this JSON file.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the seeded database for the next run.')
+
+    def handle(self, *args, **options):
+        with benchmark_database(keepdb=options['keepdb']):
+            if not Product.objects.exists():
+                self.stdout.write('Seeding...')
+                seed(products=options['products'], users=options['users'], carts=options['users'],
+                     orders=options['orders'], items_per_order=3)
+                rebuild_sales(until=timezone.now())
+            Product.objects.update(stock=10**9)
+            user = self.benchmark_user()
+            client = APIClient()
+            response = client.post('/auth/login/', {'email': user.email, 'password': BENCHMARK_PASSWORD})
+            client.credentials(HTTP_AUTHORIZATION=f"JWT {response.data['access']}")
+
+            scenarios = self.scenarios(user)
+            missing = self.uncovered_routes(scenarios)
+            if missing:
+                self.stdout.write(self.style.WARNING(f'Routes without a scenario: {", ".join(missing)}'))
+            if options['only']:
+                scenarios = [scenario for scenario in scenarios if options['only'] in scenario.label]
+
+            results = {}
+            self.stdout.write(f'{"scenario":<46} {"p50":>8} {"p95":>8} {"p99":>8} {"req/s":>8} {"queries":>8}')
+            for scenario in scenarios:
+                results[scenario.label] = result = self.run_scenario(client, scenario, options)
+                self.stdout.write(
+                    f'{scenario.label:<46} {result["p50"]:8.2f} {result["p95"]:8.2f} {result["p99"]:8.2f} '
+                    f'{result["rps"]:8.1f} {result["queries"]:8d}'
+                    + (self.style.ERROR(f'  {result["errors"]} errors') if result['errors'] else '')
+                )
+
+        report = {
+            'meta': {
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'repeat': options['repeat'],
+                'cold': options['cold'],
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            },
+            'results': results,
+        }
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(report, indent=2) + '\n')
+
+        baseline_path = Path(options['baseline'])
+        if options['save_baseline']:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(report, indent=2) + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Baseline saved to {baseline_path}'))
+        elif baseline_path.exists():
+            baseline = json.loads(baseline_path.read_text())['results']
+            regressions = compare_to_baseline(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('Performance regressions against the baseline:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS(f'No regressions against {baseline_path}'))
+
+    # A seeded user with a cart, a profile and an order history, who can log in and see the cache stats
+    def benchmark_user(self):
+        user = CustomUser.objects.filter(cart__items__isnull=False, orders__isnull=False).distinct().first()
+        user.set_password(BENCHMARK_PASSWORD)
+        user.is_staff = True
+        user.save()
+        UserProfile.objects.get_or_create(user=user, defaults={
+            'first_name': 'Bench', 'last_name': 'Mark', 'shipping_address': '1 Bench Street',
+            'billing_address': '1 Bench Street', 'phone_number': '0000000000',
+        })
+        return user
+
+    def scenarios(self, user):
+        product_ids = list(Product.objects.values_list('id', flat=True)[:500])
+        product = lambda index: product_ids[index % len(product_ids)]
+        profile_id = UserProfile.objects.get(user=user).pk
+        cart = Cart.objects.get(user=user)
+        order = Order.objects.filter(user=user).first()
+        order_item_id = OrderItem.objects.filter(order=order).values_list('id', flat=True).first()
+        cart_item_id = lambda index: CartItem.objects.filter(cart=cart).values_list('id', flat=True).first()
+        new_cart_item = lambda index: CartItem.objects.create(cart=cart, product_id=product(index + 250)).pk
+
+        def refill_cart(index):
+            CartItem.objects.filter(cart=cart).delete()
+            CartItem.objects.bulk_create([CartItem(cart=cart, product_id=product(index + offset)) for offset in range(3)])
+
+        order_payload = lambda index: {
+            'shipping_address': '1 Bench Street', 'billing_address': '1 Bench Street', 'payment_method': 'paypal',
+            'items': [{'product': product(index + offset), 'quantity': 1} for offset in range(3)],
+        }
+        return [
+            Scenario('GET', 'api-root', lambda client, index, _: client.get(url('api-root'))),
+            Scenario('POST', 'auth-login', lambda client, index, _: APIClient().post(
+                '/auth/login/', {'email': user.email, 'password': BENCHMARK_PASSWORD})),
+            Scenario('GET', 'user-profile-list', lambda client, index, _: client.get(url('user-profile-list'))),
+            Scenario('GET', 'user-profile-detail', lambda client, index, _: client.get(url('user-profile-detail', profile_id))),
+            Scenario('PATCH', 'user-profile-detail', lambda client, index, _: client.patch(
+                url('user-profile-detail', profile_id), {'phone_number': f'{index:010d}'}, format='json')),
+            Scenario('GET', 'user-profile-get-my-profile', lambda client, index, _: client.get(url('user-profile-get-my-profile'))),
+            Scenario('GET', 'products-list', lambda client, index, _: client.get(url('products-list'))),
+            Scenario('GET', 'products-list', lambda client, index, _: client.get(
+                url('products-list', query=f'?limit=20&page={index % 10 + 1}')), variant=' ?limit=20'),
+            Scenario('GET', 'products-list', lambda client, index, _: client.get(
+                url('products-list', query='?category=Budget Phones&in_stock=true&ordering=-price&limit=20')),
+                variant=' filtered'),
+            Scenario('GET', 'products-detail', lambda client, index, _: client.get(url('products-detail', product(index)))),
+            Scenario('GET', 'products-search', lambda client, index, _: client.get(
+                url('products-search', query=f'?q={["sam", "phone", "apple pro", "black"][index % 4]}'))),
+            Scenario('GET', 'products-facets', lambda client, index, _: client.get(url('products-facets'))),
+            Scenario('GET', 'products-facets', lambda client, index, _: client.get(
+                url('products-facets', query='?category=Budget Phones&in_stock=true')), variant=' filtered'),
+            Scenario('GET', 'cart-list', lambda client, index, _: client.get(url('cart-list'))),
+            Scenario('GET', 'cart-detail', lambda client, index, _: client.get(url('cart-detail', cart.pk))),
+            Scenario('GET', 'cart-get-my-cart', lambda client, index, _: client.get(url('cart-get-my-cart'))),
+            Scenario('POST', 'cart-batch', lambda client, index, _: client.post(url('cart-batch'), {'operations': [
+                {'op': 'add', 'product': product(index + offset), 'quantity': 1} for offset in range(3)
+            ]}, format='json')),
+            Scenario('POST', 'cart-clear-cart', lambda client, index, _: client.post(url('cart-clear-cart')),
+                     prepare=refill_cart),
+            Scenario('GET', 'cart-item-list', lambda client, index, _: client.get(url('cart-item-list'))),
+            Scenario('POST', 'cart-item-list', lambda client, index, _: client.post(
+                url('cart-item-list'), {'productId': product(index)}, format='json')),
+            Scenario('GET', 'cart-item-detail', lambda client, index, item_id: client.get(url('cart-item-detail', item_id)),
+                     prepare=cart_item_id),
+            Scenario('PATCH', 'cart-item-detail', lambda client, index, item_id: client.patch(
+                url('cart-item-detail', item_id), {'action': 'increment'}, format='json'), prepare=cart_item_id),
+            Scenario('DELETE', 'cart-item-detail', lambda client, index, item_id: client.delete(
+                url('cart-item-detail', item_id)), prepare=new_cart_item),
+            Scenario('GET', 'order-list', lambda client, index, _: client.get(url('order-list'))),
+            Scenario('POST', 'order-list', lambda client, index, _: client.post(
+                url('order-list'), order_payload(index), format='json')),
+            Scenario('GET', 'order-detail', lambda client, index, _: client.get(url('order-detail', order.pk))),
+            Scenario('GET', 'order-get-my-orders', lambda client, index, _: client.get(url('order-get-my-orders'))),
+            Scenario('GET', 'order-export', lambda client, index, _: streamed(client.get(url('order-export')))),
+            Scenario('GET', 'order-export', lambda client, index, _: streamed(client.get(
+                url('order-export', query='?lines=true&output=jsonl'))), variant=' lines'),
+            Scenario('GET', 'order-item-list', lambda client, index, _: client.get(url('order-item-list'))),
+            Scenario('GET', 'order-item-detail', lambda client, index, _: client.get(url('order-item-detail', order_item_id))),
+            Scenario('GET', 'sales-analytics', lambda client, index, _: client.get(url('sales-analytics'))),
+            Scenario('GET', 'sales-analytics', lambda client, index, _: client.get(
+                url('sales-analytics', query='?by=product&limit=20')), variant=' by product'),
+            Scenario('GET', 'cache-stats', lambda client, index, _: client.get(url('cache-stats'))),
+            Scenario('GET', 'async-products-list', lambda client, index, _: client.get(
+                url('async-products-list', query=f'?limit=20&page={index % 10 + 1}'))),
+            Scenario('GET', 'async-products-detail', lambda client, index, _: client.get(
+                url('async-products-detail', product(index)))),
+            Scenario('GET', 'async-cart-me', lambda client, index, _: client.get(url('async-cart-me'))),
+            Scenario('GET', 'async-orders-me', lambda client, index, _: client.get(url('async-orders-me'))),
+        ]
+
+    # Names of the routes in core/routers.py no scenario exercises
+    @staticmethod
+    def uncovered_routes(scenarios):
+        covered = {scenario.route for scenario in scenarios}
+        return sorted({pattern.name for pattern in urlpatterns} - covered)
+
+    def run_scenario(self, client, scenario, options):
+        durations, queries, errors = [], [], 0
+        for index in range(options['warmup'] + options['repeat']):
+            prepared = scenario.prepare(index) if scenario.prepare else None
+            if options['cold']:
+                cache.clear()
+                local_cache.clear()
+            counter = QueryCounter()
+            with connection.execute_wrapper(counter):
+                start = time.perf_counter()
+                response = scenario.send(client, index, prepared)
+                elapsed = (time.perf_counter() - start) * 1000
+            if index < options['warmup']:
+                continue
+            durations.append(elapsed)
+            queries.append(counter.count)
+            errors += response.status_code >= 400
+        result = summarize(durations)
+        result['rps'] = 1000 / result['mean']
+        # Queries of a typical request, stable across runs unlike the occasional cache miss
+        result['queries'] = statistics.median_low(queries)
+        result['errors'] = errors
+        return {key: round(value, 3) for key, value in result.items()}
@@ -0,0 +1,92 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+
+from core.benchmarking import benchmark_database, seed, measure, summarize
+from core.models import Product, CartItem, Order
+
+
+class Command(BaseCommand):
+    help = 'Seed a throwaway database and compare query plans and latency of the hot lookups with and without their indexes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1_000_000)
+        parser.add_argument('--carts', type=int, default=100_000)
+        parser.add_argument('--orders', type=int, default=100_000)
+        parser.add_argument('--repeat', type=int, default=50, help='Runs of each query per measurement.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the seeded database for the next run.')
+
+    def handle(self, *args, **options):
+        with benchmark_database(keepdb=options['keepdb']):
+            if not Product.objects.exists():
+                self.stdout.write('Seeding...')
+                seed(
+                    products=options['products'], users=options['carts'], carts=options['carts'],
+                    orders=options['orders'], report=self.report,
+                )
+
+            queries = self.queries()
+            indexes = [
+                (Product, index) for index in Product._meta.indexes
+            ] + [
+                (Order, index) for index in Order._meta.indexes
+            ] + [
+                (CartItem, constraint) for constraint in CartItem._meta.constraints
+            ]
+
+            # Measure without the indexes first, then put them back and measure again
+            with connection.schema_editor() as editor:
+                for model, index in indexes:
+                    self.remove(editor, model, index)
+            before = self.run_queries(queries, options['repeat'], 'Before')
+
+            with connection.schema_editor() as editor:
+                for model, index in indexes:
+                    self.add(editor, model, index)
+            after = self.run_queries(queries, options['repeat'], 'After')
+
+            self.stdout.write('\nSummary (p50 / p95 in ms)')
+            for name in queries:
+                self.stdout.write(
+                    f'  {name:<28} {before[name]["p50"]:8.2f} / {before[name]["p95"]:8.2f}'
+                    f'  ->  {after[name]["p50"]:8.2f} / {after[name]["p95"]:8.2f}'
+                )
+
+    # The lookups made by the catalog, cart and order history endpoints
+    def queries(self):
+        product = Product.objects.order_by('?').values('category', 'brand').first()
+        cart_item = CartItem.objects.order_by('?').values('cart_id', 'product_id').first()
+        user_id = Order.objects.order_by('?').values_list('user_id', flat=True).first()
+        return {
+            'catalog by category': Product.objects.filter(category=product['category']).order_by('price')[:20],
+            'catalog price range': Product.objects.filter(
+                category=product['category'], price__gte=100, price__lte=300
+            ).order_by('price')[:20],
+            'catalog by brand': Product.objects.filter(brand=product['brand'])[:20],
+            'existing cart item': CartItem.objects.filter(
+                cart_id=cart_item['cart_id'], product_id=cart_item['product_id'], color=None, size=None
+            )[:1],
+            'order history page': Order.objects.filter(user_id=user_id).order_by('-placed_at', '-id')[:20],
+        }
+
+    def run_queries(self, queries, repeat, label):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n{label}'))
+        results = {}
+        for name, queryset in queries.items():
+            self.stdout.write(f'{name}: {queryset.explain()}')
+            results[name] = summarize(measure(lambda: list(queryset.all()), repeat))
+        return results
+
+    def remove(self, editor, model, index):
+        if isinstance(index, models.Index):
+            editor.remove_index(model, index)
+        else:
+            editor.remove_constraint(model, index)
+
+    def add(self, editor, model, index):
+        if isinstance(index, models.Index):
+            editor.add_index(model, index)
+        else:
+            editor.add_constraint(model, index)
+
+    def report(self, label, done):
+        self.stdout.write(f'  {label}: {done}')
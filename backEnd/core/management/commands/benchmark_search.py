@@ -0,0 +1,63 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.benchmarking import benchmark_database, bulk_insert, generate_products, measure, summarize
+from core.models import Product
+from core.search import SearchResults, FallbackSearch
+
+
+# Typed queries, from the first letters of a word to several full words
+QUERIES = ['sa', 'sams', 'samsung', 'apple tab', 'google flagship phones', 'number 4242', 'anker acc']
+
+# Statements rebuilding the search index from scratch
+REBUILD_INDEX = {
+    'sqlite': ["INSERT INTO core_product_fts(core_product_fts) VALUES ('rebuild')"],
+    'postgresql': ['REINDEX INDEX core_product_search_idx'],
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a throwaway database with products and compare the full-text search of /api/products/search/ '
+        'with LIKE scans (icontains) for typical queries, and time the build of the search index.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1_000_000)
+        parser.add_argument('--repeat', type=int, default=20, help='Runs of each query per measurement.')
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--keepdb', action='store_true', help='Keep the seeded database for the next run.')
+
+    def handle(self, *args, **options):
+        with benchmark_database(keepdb=options['keepdb']):
+            if not Product.objects.exists():
+                self.stdout.write('Seeding...')
+                bulk_insert(Product, generate_products(options['products'], random.Random(42)),
+                            report=lambda done: self.stdout.write(f'  products: {done}'))
+            self.stdout.write(f'{Product.objects.count()} products on {connection.vendor}')
+
+            statements = REBUILD_INDEX.get(connection.vendor)
+            if statements:
+                start = time.perf_counter()
+                with connection.cursor() as cursor:
+                    for statement in statements:
+                        cursor.execute(statement)
+                self.stdout.write(f'Index build: {time.perf_counter() - start:.2f} s\n')
+
+            size = options['page_size']
+            self.stdout.write(
+                f'{"query":<26} {"matches":>8}  {"index p50":>10} {"p95":>8}  {"icontains p50":>14} {"p95":>8}'
+            )
+            for query in QUERIES:
+                # A search request: the count for the paginator and the first page
+                indexed = SearchResults(query)
+                scan = SearchResults(query, search_backend=FallbackSearch())
+                index_timing = summarize(measure(lambda: (indexed.count(), indexed[0:size]), options['repeat']))
+                scan_timing = summarize(measure(lambda: (scan.count(), scan[0:size]), options['repeat']))
+                self.stdout.write(
+                    f'{query:<26} {indexed.count():>8}  {index_timing["p50"]:10.2f} {index_timing["p95"]:8.2f}'
+                    f'  {scan_timing["p50"]:14.2f} {scan_timing["p95"]:8.2f}'
+                )
@@ -0,0 +1,141 @@
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.benchmarking import benchmark_database, seed, summarize
+from core.models import CustomUser, Product
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the read endpoints served by gunicorn (WSGI, DRF views) and uvicorn (ASGI, async views) '
+        'under high concurrency: requests/s and latency percentiles, using a throwaway copy of the database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=64, help='Concurrent clients.')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to run each endpoint.')
+        parser.add_argument('--workers', type=int, default=4, help='Server worker processes.')
+        parser.add_argument('--threads', type=int, default=4, help='Threads per gunicorn worker.')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--products', type=int, default=5000)
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--bypass-cache', action='store_true',
+                            help='Make every request miss the response cache, to measure the database path.')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the seeded database for the next run.')
+
+    def handle(self, *args, **options):
+        servers = {
+            'gunicorn (WSGI)': ('/api/', [
+                sys.executable, '-m', 'gunicorn', 'superlian.wsgi:application',
+                '--workers', str(options['workers']), '--threads', str(options['threads']),
+                '--bind', f'127.0.0.1:{options["port"]}',
+            ]),
+            'uvicorn (ASGI)': ('/api/async/', [
+                sys.executable, '-m', 'uvicorn', 'superlian.asgi:application',
+                '--workers', str(options['workers']), '--port', str(options['port']), '--no-access-log',
+            ]),
+        }
+        for name, module in (('gunicorn (WSGI)', 'gunicorn'), ('uvicorn (ASGI)', 'uvicorn')):
+            if importlib.util.find_spec(module) is None:
+                self.stdout.write(self.style.WARNING(f'{module} is not installed (pip install {module}), skipping {name}'))
+                del servers[name]
+
+        with benchmark_database(keepdb=options['keepdb']):
+            if not Product.objects.exists():
+                seed(products=options['products'], users=options['users'], carts=options['users'],
+                     orders=options['users'] * 5)
+            users = list(CustomUser.objects.filter(cart__isnull=False, orders__isnull=False).distinct())
+            tokens = [str(AccessToken.for_user(user)) for user in users]
+            product_ids = list(Product.objects.values_list('id', flat=True)[:1000])
+            pages = max(1, min(50, Product.objects.count() // 20))
+            endpoints = {
+                'products?limit=20': lambda index: f'products/?limit=20&page={index % pages + 1}',
+                'products/<id>': lambda index: f'products/{product_ids[index % len(product_ids)]}/',
+                'cart/me': lambda index: 'cart/me/',
+                'orders/me': lambda index: 'orders/me/',
+            }
+
+            # The servers run in their own processes against the seeded copy of the database
+            environment = {
+                **os.environ,
+                'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'superlian.settings'),
+                'DB_NAME': str(connection.settings_dict['NAME']),
+                'DJANGO_DEBUG': 'False',
+                'DJANGO_ALLOWED_HOSTS': '127.0.0.1,localhost',
+            }
+            for server, (prefix, command) in servers.items():
+                self.stdout.write(self.style.MIGRATE_HEADING(f'\n{server}: {" ".join(command[1:])}'))
+                process = subprocess.Popen(command, cwd=settings.BASE_DIR, env=environment,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    if not self.wait_for_port(options['port'], process):
+                        self.stdout.write(self.style.ERROR('  the server did not start'))
+                        continue
+                    base_url = f'http://127.0.0.1:{options["port"]}{prefix}'
+                    for endpoint, path in endpoints.items():
+                        self.run_endpoint(endpoint, base_url, path, tokens, options)
+                finally:
+                    process.terminate()
+                    process.wait()
+
+    def wait_for_port(self, port, process, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and process.poll() is None:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return True
+            except OSError:
+                time.sleep(0.2)
+        return False
+
+    # Every client is a different user sending requests back to back until the time is up
+    def run_endpoint(self, name, base_url, path, tokens, options):
+        concurrency = options['concurrency']
+        deadline = time.perf_counter() + options['duration']
+        lock = threading.Lock()
+        durations, errors = [], []
+
+        def client_loop(client_index):
+            session = requests.Session()
+            session.headers['Authorization'] = f'JWT {tokens[client_index % len(tokens)]}'
+            index = client_index
+            while time.perf_counter() < deadline:
+                url = base_url + path(index)
+                if options['bypass_cache']:
+                    url += ('&' if '?' in url else '?') + f'nocache={client_index}-{index}'
+                start = time.perf_counter()
+                try:
+                    failed = session.get(url, timeout=30).status_code >= 400
+                except requests.RequestException:
+                    failed = True
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    (errors if failed else durations).append(elapsed)
+                index += concurrency
+            session.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(client_loop, range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+        if not durations:
+            self.stdout.write(self.style.ERROR(f'  {name:<20} all {len(errors)} requests failed'))
+            return
+        latency = summarize(durations)
+        self.stdout.write(
+            f'  {name:<20} {len(durations) / elapsed:8.1f} req/s, {len(errors)} failed, '
+            f'p50 {latency["p50"]:.1f} ms, p99 {latency["p99"]:.1f} ms'
+        )
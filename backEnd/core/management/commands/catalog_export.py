@@ -0,0 +1,51 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.catalog import FORMATS, WRITERS, export_rows, file_format, peak_memory_mb
+from core.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        'Export the products to CSV or JSON lines, reading the table in chunks so memory stays flat. '
+        'The file can be loaded again with catalog_import.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to write, - for the standard output.')
+        parser.add_argument('--format', choices=FORMATS, help='File format, taken from the extension by default.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched from the database at a time.')
+        parser.add_argument('--category', help='Only export the products of this category.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+        products = Product.objects.all()
+        if options['category']:
+            products = products.filter(category=options['category'])
+        writer = WRITERS[file_format(path, options['format'])]
+        # With the data going to the standard output the progress goes to stderr
+        log = self.stderr if path == '-' else self.stdout
+
+        start = time.perf_counter()
+        count = 0
+        try:
+            output = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+        except OSError as error:
+            raise CommandError(f'Cannot write {path}: {error.strerror}')
+        try:
+            for count in writer(export_rows(products, options['chunk_size']), output):
+                if count % 100000 == 0:
+                    log.write(f'  {count} rows ({count / (time.perf_counter() - start):.0f} rows/s, {peak_memory_mb():.0f} MB)')
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        elapsed = time.perf_counter() - start
+        log.write(self.style.SUCCESS(
+            f'{count} products exported in {elapsed:.1f} s ({count / elapsed:.0f} rows/s, '
+            f'peak memory {peak_memory_mb():.0f} MB)'
+        ))
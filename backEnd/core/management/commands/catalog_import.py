@@ -0,0 +1,74 @@
+import sys
+import time
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries
+
+from core.cache import invalidate_namespace
+from core.catalog import (
+    FORMATS, READERS, file_format, peak_memory_mb, product_from_row, reset_product_sequence, upsert_products,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Import products from CSV or JSON lines in chunks: rows with the id of a product update it, the others '
+        'are created. Invalid rows are reported and skipped. Memory stays flat whatever the size of the file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to read, - for the standard input.')
+        parser.add_argument('--format', choices=FORMATS, help='File format, taken from the extension by default.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per statement.')
+        parser.add_argument('--max-errors', type=int, default=20, help='Invalid rows printed, the others are counted.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        reader = READERS[file_format(path, options['format'])]
+        try:
+            file = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except OSError as error:
+            raise CommandError(f'Cannot read {path}: {error.strerror}')
+
+        start = time.perf_counter()
+        done, invalid, images = 0, 0, 0
+        try:
+            rows = enumerate(reader(file), 1)
+            while chunk := list(islice(rows, options['batch_size'])):
+                products = []
+                for number, row in chunk:
+                    try:
+                        products.append(product_from_row(row))
+                    except ValidationError as error:
+                        invalid += 1
+                        if invalid <= options['max_errors']:
+                            self.stderr.write(f'  row {number}: {"; ".join(error.messages)}')
+                if products:
+                    images += upsert_products(products)
+                    # With DEBUG on every statement is kept in the query log, which would grow with the file
+                    if settings.DEBUG:
+                        reset_queries()
+                    previous, done = done, done + len(products)
+                    if done // 100000 > previous // 100000:
+                        self.stdout.write(f'  {done} rows ({done / (time.perf_counter() - start):.0f} rows/s, {peak_memory_mb():.0f} MB)')
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+        # Bulk statements skip the signals: the catalog cache is dropped here
+        if done:
+            reset_product_sequence()
+            invalidate_namespace('catalog')
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'{done} products imported in {elapsed:.1f} s ({done / elapsed:.0f} rows/s, '
+            f'peak memory {peak_memory_mb():.0f} MB), {invalid} invalid rows skipped'
+        ))
+        if images:
+            self.stdout.write(f'{images} images need renditions, run generate_image_renditions.')
@@ -0,0 +1,70 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.cache import invalidate_namespace
+from core.images import generate_renditions
+from core.models import Product
+
+
+# Runs in the worker processes, which only read and write image files: the renditions
+# go back to the main process, the only one writing to the database
+def setup_worker():
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate the responsive renditions (WebP/AVIF and placeholder) of the product images that have '
+        'none yet, or of all of them with --force, resizing in parallel in a pool of processes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes resizing images.')
+        parser.add_argument('--batch-size', type=int, default=200, help='Products written per query.')
+        parser.add_argument('--force', action='store_true', help='Regenerate the renditions of every image.')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['force']:
+            products = products.filter(image_renditions={})
+        pending = list(products.values_list('id', 'image'))
+        if not pending:
+            self.stdout.write('No images to process.')
+            return
+        self.stdout.write(f'Processing {len(pending)} images with {options["workers"]} workers...')
+
+        start = time.perf_counter()
+        done, failed, batch = 0, 0, []
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=setup_worker) as pool:
+            futures = {pool.submit(generate_renditions, name): (pk, name) for pk, name in pending}
+            for future in as_completed(futures):
+                pk, name = futures[future]
+                try:
+                    renditions = future.result()
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write(f'  {name}: {error}')
+                    continue
+                batch.append(Product(pk=pk, image_renditions=renditions, updated_at=timezone.now()))
+                if len(batch) >= options['batch_size']:
+                    done += self.write(batch)
+                    batch = []
+                    self.stdout.write(f'  {done}/{len(pending)} ({done / (time.perf_counter() - start):.1f} images/s)')
+        done += self.write(batch)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'{done} images processed in {elapsed:.1f} s ({done / elapsed:.1f} images/s), {failed} failed'
+        ))
+
+    # bulk_update skips the signals: the timestamp moves the catalog ETags and the cache is dropped here
+    def write(self, batch):
+        if batch:
+            Product.objects.bulk_update(batch, ['image_renditions', 'updated_at'])
+            invalidate_namespace('catalog')
+        return len(batch)
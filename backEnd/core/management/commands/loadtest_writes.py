@@ -0,0 +1,90 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIClient
+
+from core.benchmarking import benchmark_database, seed, summarize
+from core.models import CustomUser, Product
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the write throughput of the cart and order endpoints with concurrent clients '
+        'against the configured database (DB_ENGINE=sqlite or postgresql), using a throwaway copy of it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Concurrent clients.')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to run each scenario.')
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--keepdb', action='store_true', help='Keep the seeded database for the next run.')
+
+    def handle(self, *args, **options):
+        database = connection.settings_dict
+        self.stdout.write(f"Backend: {connection.vendor}, CONN_MAX_AGE={database['CONN_MAX_AGE']}, "
+                          f"options={database['OPTIONS']}")
+
+        with benchmark_database(keepdb=options['keepdb']):
+            if not Product.objects.exists():
+                seed(products=options['products'], users=options['users'], carts=0, orders=0)
+            Product.objects.update(stock=10**9)
+            user_ids = list(CustomUser.objects.values_list('id', flat=True))
+            product_ids = list(Product.objects.values_list('id', flat=True))
+
+            scenarios = {
+                'cart add (POST /api/cart-item/)': lambda client, index: client.post(
+                    '/api/cart-item/', {'productId': product_ids[index % len(product_ids)]}, format='json'
+                ),
+                'order (POST /api/orders/)': lambda client, index: client.post('/api/orders/', {
+                    'shipping_address': '1 Load Street', 'billing_address': '1 Load Street',
+                    'payment_method': 'paypal',
+                    'items': [{'product': product_ids[(index + offset) % len(product_ids)], 'quantity': 1}
+                              for offset in range(3)],
+                }, format='json'),
+            }
+            for name, request in scenarios.items():
+                self.run_scenario(name, request, user_ids, options['threads'], options['duration'])
+
+    # Every thread acts as a different user and sends requests back to back until the time is up
+    def run_scenario(self, name, request, user_ids, threads, duration):
+        deadline = time.perf_counter() + duration
+        lock = threading.Lock()
+        durations, errors = [], []
+
+        def client_loop(thread_index):
+            client = APIClient()
+            client.force_authenticate(CustomUser.objects.get(pk=user_ids[thread_index % len(user_ids)]))
+            index = thread_index
+            try:
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    try:
+                        response = request(client, index)
+                        failed = response.status_code >= 400
+                    except Exception:
+                        failed = True
+                    elapsed = (time.perf_counter() - start) * 1000
+                    with lock:
+                        (errors if failed else durations).append(elapsed)
+                    index += threads
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(client_loop, range(threads)))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n{name}'))
+        if not durations:
+            self.stdout.write(self.style.ERROR(f'  all {len(errors)} requests failed'))
+            return
+        latency = summarize(durations)
+        self.stdout.write(
+            f'  {len(durations) / elapsed:.1f} writes/s, {len(durations)} ok, {len(errors)} failed, '
+            f'p50 {latency["p50"]:.1f} ms, p95 {latency["p95"]:.1f} ms, p99 {latency["p99"]:.1f} ms'
+        )
@@ -0,0 +1,55 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from core.catalog import file_format, peak_memory_mb
+from core.exports import ENCODERS, FORMATS, order_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Export the orders, or their lines with --lines, to CSV or JSON lines for reporting, streaming them '
+        'from the database so memory stays flat. Reports the throughput and the peak memory.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to write, - for the standard output.')
+        parser.add_argument('--format', choices=sorted(FORMATS), help='File format, taken from the extension by default.')
+        parser.add_argument('--lines', action='store_true', help='One row per order line instead of per order.')
+        parser.add_argument('--placed-after', help='First date or datetime included (ISO 8601).')
+        parser.add_argument('--placed-before', help='Date or datetime excluded (ISO 8601).')
+        parser.add_argument('--status', help='Comma separated order statuses.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched and written at a time.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        params = {name: options[name] for name in ['placed_after', 'placed_before', 'status'] if options[name]}
+        try:
+            columns, rows = order_rows(params, lines=options['lines'], chunk_size=options['chunk_size'])
+        except ValidationError as error:
+            raise CommandError(f'Invalid filter: {error.detail}')
+        encode = ENCODERS[file_format(path, options['format'])]
+        # With the data going to the standard output the report goes to stderr
+        log = self.stderr if path == '-' else self.stdout
+
+        start = time.perf_counter()
+        output = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+        try:
+            for block in encode(columns, self.counted(rows), options['chunk_size']):
+                output.write(block)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        elapsed = time.perf_counter() - start
+        log.write(self.style.SUCCESS(
+            f"{self.count} {'order lines' if options['lines'] else 'orders'} exported in {elapsed:.1f} s "
+            f'({self.count / elapsed if elapsed else 0:.0f} rows/s, peak memory {peak_memory_mb():.0f} MB)'
+        ))
+
+    def counted(self, rows):
+        self.count = 0
+        for self.count, row in enumerate(rows, 1):
+            yield row
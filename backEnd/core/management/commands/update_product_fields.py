@@ -1,40 +1,123 @@
-from django.core.management.base import BaseCommand
-from core.models import Product  # Import your Product model
+import time
+from decimal import Decimal, InvalidOperation
+from urllib.parse import parse_qsl
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import DecimalField, F
+from django.db.models.functions import Round
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError as FilterError
+
+from core.cache import invalidate_namespace
+from core.filters import filter_products
+from core.forms import clean_storage, clean_colors
+from core.models import Product, ProductVariant
+
 
 class Command(BaseCommand):
-    help = 'Programmatically update storage and colors for phones, tablets, and iPads.'
-
-    def handle(self, *args, **kwargs):
-        # Define lists of storage sizes and colors
-        storage_sizes = [
-            {"size": "64GB", "in_stock": True},
-            {"size": "128GB", "in_stock": True},
-            {"size": "256GB", "in_stock": False},
-            {"size": "512GB", "in_stock": True},
-            {"size": "1TB", "in_stock": False}
-        ]
-
-        colors_list = [
-            {"color": "Black", "in_stock": True},
-            {"color": "White", "in_stock": False},
-            {"color": "Silver", "in_stock": True},
-            {"color": "Gold", "in_stock": True},
-            {"color": "Blue", "in_stock": True}
-        ]
-
-        # Loop through all products and add storage/colors if the product is a phone, tablet, or iPad
-        updated_count = 0
-
-        # Update phones, tablets, and iPads (skip others)
-        for product in Product.objects.all():
-            # Check if the product is a phone, tablet, or iPad based on category
-            print(product.category.id)
-            if product.category.id in [1, 2, 3, 4]:  # Assuming these categories are for phones, tablets, and iPads
-                # Add storage and colors if the product doesn't already have them
-                product.storage = storage_sizes  # Assigning first three sizes for all phones/tablets
-                product.colors = colors_list  # Assigning first three colors for all phones/tablets
-                
-                product.save()
-                updated_count += 1
-
-        self.stdout.write(self.style.SUCCESS(f'Successfully updated {updated_count} phones, tablets, and iPads.'))
+    help = (
+        'Update the storage, colors, stock or price of the selected products in bulk, one UPDATE per batch. '
+        'Select them with --category, --brand and --filter (the catalog filters as a query string, e.g. '
+        '"min_price=500&in_stock=true&color=Black"), all products when none is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--category', help='Comma separated categories.')
+        parser.add_argument('--brand', help='Comma separated brands.')
+        parser.add_argument('--filter', default='', help='Catalog filters as a query string.')
+        parser.add_argument('--storage', help='Storage options as JSON, e.g. \'[{"size": "128GB", "in_stock": true}]\'.')
+        parser.add_argument('--colors', help='Color options as JSON, e.g. \'[{"color": "Black", "in_stock": true}]\'.')
+        parser.add_argument('--stock', type=int, help='New stock.')
+        parser.add_argument('--price', help='New price.')
+        parser.add_argument('--price-percent', help='Change the prices by this percentage, e.g. -15.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Products updated per statement.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the products that would change.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        products = self.select(options)
+        changes = self.changes(options)
+        if not changes:
+            raise CommandError('Nothing to update, give --storage, --colors, --stock, --price or --price-percent.')
+
+        total = products.count()
+        described = ', '.join(
+            f'{name}={options[name]}' for name in ['storage', 'colors', 'stock', 'price', 'price_percent']
+            if options[name] is not None
+        )
+        if options['dry_run']:
+            self.stdout.write(f'Would update {total} products: {described}')
+            return
+        self.stdout.write(f'Updating {total} products: {described}')
+
+        start = time.perf_counter()
+        done, last = 0, 0
+        # New options make or delete variants and a new stock resets them, the JSON fields
+        # are only read back for that
+        restock = 'stock' in changes
+        sync_variants = restock or 'storage' in changes or 'colors' in changes
+        # Walk the selection in id order: with offsets, rows the update takes out of the
+        # selection (e.g. --filter in_stock=false --stock 10) would make the next batches skip others
+        while ids := list(products.filter(pk__gt=last).values_list('pk', flat=True)[:options['batch_size']]):
+            with transaction.atomic():
+                Product.objects.filter(pk__in=ids).update(**changes, updated_at=timezone.now())
+                if sync_variants:
+                    ProductVariant.objects.sync_options(
+                        Product.objects.filter(pk__in=ids).only('id', 'stock', 'storage', 'colors'), restock=restock
+                    )
+            done, last = done + len(ids), ids[-1]
+            self.stdout.write(f'  {done}/{total} ({done / (time.perf_counter() - start):.0f} products/s)')
+
+        # Bulk updates skip the signals: the catalog cache is dropped here
+        if done:
+            invalidate_namespace('catalog')
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated {done} products in {elapsed:.2f} s ({done / elapsed if elapsed else 0:.0f} products/s)'
+        ))
+
+    def select(self, options):
+        params = dict(parse_qsl(options['filter']))
+        for name in ['category', 'brand']:
+            if options[name]:
+                params[name] = options[name]
+        try:
+            return filter_products(Product.objects.all(), params).order_by('pk')
+        except FilterError as error:
+            raise CommandError(f'Invalid filter: {error.detail}')
+
+    # The new values as constants or expressions of the row, for QuerySet.update
+    def changes(self, options):
+        changes = {}
+        try:
+            if options['storage'] is not None:
+                changes['storage'] = clean_storage(options['storage'])
+            if options['colors'] is not None:
+                changes['colors'] = clean_colors(options['colors'])
+        except ValidationError as error:
+            raise CommandError('; '.join(error.messages))
+        if options['stock'] is not None:
+            if options['stock'] < 0:
+                raise CommandError('The stock cannot be negative.')
+            changes['stock'] = options['stock']
+        if options['price'] is not None and options['price_percent'] is not None:
+            raise CommandError('Give either --price or --price-percent.')
+        if options['price'] is not None:
+            changes['price'] = self.decimal(options['price'], '--price')
+            if changes['price'] < 0:
+                raise CommandError('The price cannot be negative.')
+        if options['price_percent'] is not None:
+            factor = 1 + self.decimal(options['price_percent'], '--price-percent') / 100
+            if factor < 0:
+                raise CommandError('The prices cannot go below zero.')
+            changes['price'] = Round(F('price') * factor, 2, output_field=DecimalField(max_digits=10, decimal_places=2))
+        return changes
+
+    def decimal(self, value, name):
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            raise CommandError(f'{name} must be a number.')
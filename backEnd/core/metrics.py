@@ -0,0 +1,135 @@
+import threading
+
+from .cache import cache_stats
+
+
+# In-process metrics of the API, exposed in the Prometheus text format on /metrics
+#
+# Every worker process keeps its own histograms, Prometheus scrapes each worker
+# (or sums them) the same way it would with any multi-process exporter.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def format_labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, description, label_names, buckets):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    # Bucket counts are stored per bucket and added up when rendered
+    def observe(self, labels, value):
+        key = tuple(labels)
+        with self.lock:
+            series = self.series.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0})
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                labels = list(zip(self.label_names, key))
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['buckets']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{format_labels(labels + [("le", bound)])}}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{format_labels(labels + [("le", "+Inf")])}}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{format_labels(labels)}}} {format_value(series["sum"])}')
+                lines.append(f'{self.name}_count{{{format_labels(labels)}}} {series["count"]}')
+        return lines
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+
+request_duration = Histogram(
+    'superlian_request_duration_seconds', 'Wall time of the requests.',
+    ('view', 'method', 'status'), DURATION_BUCKETS,
+)
+request_queries = Histogram(
+    'superlian_request_db_queries', 'Database queries per request.', ('view', 'method'), QUERY_BUCKETS,
+)
+request_db_duration = Histogram(
+    'superlian_request_db_duration_seconds', 'Time spent in the database per request.',
+    ('view', 'method'), DURATION_BUCKETS,
+)
+request_serialize_duration = Histogram(
+    'superlian_request_serialize_duration_seconds', 'Time spent in the serializers per request, without their queries.',
+    ('view', 'method'), DURATION_BUCKETS,
+)
+request_render_duration = Histogram(
+    'superlian_request_render_duration_seconds', 'Time spent rendering the response body per request.',
+    ('view', 'method'), DURATION_BUCKETS,
+)
+response_size = Histogram(
+    'superlian_response_size_bytes', 'Size of the response bodies.', ('view', 'method'), SIZE_BUCKETS,
+)
+HISTOGRAMS = [
+    request_duration, request_queries, request_db_duration, request_serialize_duration, request_render_duration,
+    response_size,
+]
+
+
+def observe_request(metrics):
+    view, method = metrics.view, metrics.method
+    request_duration.observe((view, method, f'{metrics.status // 100}xx'), metrics.duration)
+    request_queries.observe((view, method), metrics.queries)
+    request_db_duration.observe((view, method), metrics.db_duration)
+    request_serialize_duration.observe((view, method), metrics.serialize_duration)
+    request_render_duration.observe((view, method), metrics.render_duration)
+    if metrics.size is not None:
+        response_size.observe((view, method), metrics.size)
+
+
+# Counters of the response cache (see cache.py) in the same format
+def render_cache_stats():
+    stats = cache_stats()
+    lines = [
+        '# HELP superlian_response_cache_local_entries Entries in the local tier of the response cache.',
+        '# TYPE superlian_response_cache_local_entries gauge',
+        f'superlian_response_cache_local_entries {stats["local_entries"]}',
+        '# HELP superlian_response_cache_events_total Hits, misses, sets and evictions of the response cache.',
+        '# TYPE superlian_response_cache_events_total counter',
+    ]
+    for policy, counters in sorted(stats['policies'].items()):
+        for event, count in counters.items():
+            lines.append(f'superlian_response_cache_events_total{{{format_labels([("policy", policy), ("event", event)])}}} {count}')
+    lines += [
+        '# HELP superlian_response_cache_invalidations_total Namespace invalidations of the response cache.',
+        '# TYPE superlian_response_cache_invalidations_total counter',
+    ]
+    for kind, count in sorted(stats['invalidations'].items()):
+        lines.append(f'superlian_response_cache_invalidations_total{{{format_labels([("namespace", kind)])}}} {count}')
+    return lines
+
+
+def render_metrics():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    lines += render_cache_stats()
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics():
+    for histogram in HISTOGRAMS:
+        histogram.reset()
@@ -0,0 +1,229 @@
+import json
+import logging
+import time
+from contextlib import contextmanager, ExitStack
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from .db_routers import current_request, pin_to_primary, SAFE_METHODS
+from .metrics import observe_request
+from .nplusone import QueryCollector, install, report
+
+
+logger = logging.getLogger('core.performance')
+
+# Metrics of the request being handled by the current thread or task, set by PerformanceMiddleware
+current_metrics = ContextVar('current_metrics', default=None)
+
+
+# Makes the request available to the database router, and pins the user to the
+# primary database for a few seconds after a successful write (read-your-writes)
+# Runs natively under both WSGI and ASGI, so async views keep the request in their context
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = current_request.set(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        if self.should_pin(request, response):
+            pin_to_primary(request.user.pk)
+        return response
+
+    async def __acall__(self, request):
+        token = current_request.set(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        if self.should_pin(request, response):
+            await sync_to_async(pin_to_primary)(request.user.pk)
+        return response
+
+    def should_pin(self, request, response):
+        if not settings.DATABASE_REPLICAS or request.method in SAFE_METHODS or response.status_code >= 400:
+            return False
+        user = getattr(request, 'user', None)
+        return bool(user and user.is_authenticated)
+
+
+# Name of the view a request was routed to: "<ViewSet>.<action>" for DRF views
+# (e.g. CartItemViewSet.partial_update), "<module>.<function>" for function views
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    func = match.func
+    cls = getattr(func, 'cls', None)
+    if cls is not None:
+        actions = getattr(func, 'actions', None) or {}
+        return f'{cls.__name__}.{actions.get(request.method.lower(), request.method.lower())}'
+    return f"{func.__module__.rsplit('.', 1)[-1]}.{getattr(func, '__name__', type(func).__name__)}"
+
+
+# What one request cost. Installed as an execute wrapper on every database connection
+# to count the queries and their time, the serializers and the renderer add their time
+# (see TimedSerializerMixin and renderers.py)
+class RequestMetrics:
+    def __init__(self, request):
+        self.method = request.method
+        self.started = time.perf_counter()
+        self.view = 'unresolved'
+        self.status = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_duration = 0.0
+        self.serialize_duration = 0.0
+        self.render_duration = 0.0
+        self.size = None
+        self.serializing = False
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_duration += time.perf_counter() - start
+
+    # Time spent in a serializer, without the queries it runs (they count as db time)
+    # Serializers nested in the one being timed are part of its time
+    @contextmanager
+    def serialization(self):
+        if self.serializing:
+            yield
+            return
+        self.serializing = True
+        start, db_start = time.perf_counter(), self.db_duration
+        try:
+            yield
+        finally:
+            self.serializing = False
+            self.serialize_duration += time.perf_counter() - start - (self.db_duration - db_start)
+
+    def finish(self, request, response):
+        self.duration = time.perf_counter() - self.started
+        self.view = view_name(request)
+        self.status = response.status_code
+        if not response.streaming:
+            self.size = len(response.content)
+
+    def server_timing(self):
+        app = max(0.0, self.duration - self.db_duration - self.serialize_duration - self.render_duration)
+        return (
+            f'db;dur={self.db_duration * 1000:.2f};desc="{self.queries} queries", '
+            f'serialize;dur={self.serialize_duration * 1000:.2f}, '
+            f'render;dur={self.render_duration * 1000:.2f}, app;dur={app * 1000:.2f}, '
+            f'total;dur={self.duration * 1000:.2f}'
+        )
+
+    def as_log(self, request):
+        return {
+            'view': self.view, 'method': self.method, 'path': request.path, 'status': self.status,
+            'duration_ms': round(self.duration * 1000, 2), 'queries': self.queries,
+            'db_ms': round(self.db_duration * 1000, 2), 'serialize_ms': round(self.serialize_duration * 1000, 2),
+            'render_ms': round(self.render_duration * 1000, 2),
+            'size': self.size,
+        }
+
+
+# Measures every request: wall time, database queries and time, serialization and render time
+# and response size, tagged with the view that handled it. Adds a Server-Timing header, logs
+# one JSON line per request to the core.performance logger (a warning when slower than
+# PERFORMANCE_SLOW_REQUEST_MS) and feeds the histograms served on /metrics
+class PerformanceMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = request.performance = RequestMetrics(request)
+        token = current_metrics.set(metrics)
+        try:
+            with self.instrument(metrics):
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        return self.record(request, response, metrics)
+
+    # Connections belong to the thread running the queries, so under ASGI the wrappers
+    # are installed from the thread the request's sync_to_async calls run in
+    async def __acall__(self, request):
+        metrics = request.performance = RequestMetrics(request)
+        token = current_metrics.set(metrics)
+        stack = await sync_to_async(self.instrument)(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+            current_metrics.reset(token)
+        return self.record(request, response, metrics)
+
+    def instrument(self, metrics):
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(metrics))
+        return stack
+
+    def record(self, request, response, metrics):
+        metrics.finish(request, response)
+        observe_request(metrics)
+        if settings.PERFORMANCE_SERVER_TIMING:
+            response['Server-Timing'] = metrics.server_timing()
+        slow = metrics.duration * 1000 >= settings.PERFORMANCE_SLOW_REQUEST_MS
+        logger.log(logging.WARNING if slow else logging.INFO, json.dumps(metrics.as_log(request)))
+        return response
+
+
+# Looks for N+1 queries in the serializers of every request (see nplusone.py),
+# raising or logging them according to NPLUSONE_MODE
+class NPlusOneMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if settings.NPLUSONE_MODE == 'off':
+            return self.get_response(request)
+        collector = QueryCollector()
+        with install(collector):
+            response = self.get_response(request)
+        report(collector, f'{request.method} {request.path}')
+        return response
+
+    async def __acall__(self, request):
+        if settings.NPLUSONE_MODE == 'off':
+            return await self.get_response(request)
+        collector = QueryCollector()
+        stack = await sync_to_async(install)(collector)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        report(collector, f'{request.method} {request.path}')
+        return response
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.6 on 2026-10-18 02:27
+
+from django.db import migrations, models
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+# Backfill the prices of existing orders from the current product prices,
+# the closest we can get to the prices they were placed at
+def backfill_prices(apps, schema_editor):
+    Product = apps.get_model('core', 'Product')
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    db_alias = schema_editor.connection.alias
+
+    OrderItem.objects.using(db_alias).update(
+        unit_price=Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')[:1])
+    )
+    order_totals = OrderItem.objects.filter(order=OuterRef('pk')).values('order').annotate(
+        total=Sum(F('quantity') * F('unit_price'), output_field=DecimalField(max_digits=12, decimal_places=2))
+    ).values('total')
+    Order.objects.using(db_alias).update(
+        total=Coalesce(Subquery(order_totals[:1]), Value(0), output_field=DecimalField(max_digits=12, decimal_places=2))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_alter_product_brand_alter_product_category_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.RunPython(backfill_prices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1.6 on 2026-10-18 02:29
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+# Merge duplicate cart rows into one before the unique constraint is added,
+# keeping the oldest row with the summed quantity
+def merge_duplicate_cart_items(apps, schema_editor):
+    CartItem = apps.get_model('core', 'CartItem')
+    db_alias = schema_editor.connection.alias
+    items = CartItem.objects.using(db_alias).annotate(
+        color_key=Coalesce('color', Value('')), size_key=Coalesce('size', Value(''))
+    )
+    duplicates = items.values('cart', 'product', 'color_key', 'size_key').annotate(
+        rows=Count('id'), keep_id=Min('id'), total_quantity=Sum('quantity')
+    ).filter(rows__gt=1)
+    for duplicate in duplicates:
+        CartItem.objects.using(db_alias).filter(pk=duplicate['keep_id']).update(quantity=duplicate['total_quantity'])
+        items.filter(
+            cart=duplicate['cart'], product=duplicate['product'],
+            color_key=duplicate['color_key'], size_key=duplicate['size_key']
+        ).exclude(pk=duplicate['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_orderitem_unit_price_order_total'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', '-placed_at'], name='order_user_placed_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'price'], name='product_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['brand'], name='product_brand_idx'),
+        ),
+        migrations.RunPython(merge_duplicate_cart_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(models.F('cart'), models.F('product'), django.db.models.functions.comparison.Coalesce('color', models.Value('')), django.db.models.functions.comparison.Coalesce('size', models.Value('')), name='unique_cart_item_variant'),
+        ),
+    ]
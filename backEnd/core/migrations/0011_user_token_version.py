@@ -0,0 +1,29 @@
+# Generated by Django 5.1.6 on 2026-10-18 02:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_updated_at_timestamps'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClaimsUser',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('core.customuser',),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='token_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,87 @@
+from django.db import migrations
+
+
+# Full-text index over the name, brand, category and description of the products,
+# built by the database itself so every write (save, delete, bulk_create, update) keeps it in sync
+#
+# SQLite: an FTS5 table over core_product (external content, no copy of the text) kept
+# up to date by triggers. The update trigger only fires for the indexed columns, so stock
+# updates at checkout do not touch the index.
+# PostgreSQL: a stored generated tsvector column with a GIN index, names and brands weigh most.
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE core_product_fts USING fts5(
+        name, brand, category, description,
+        content='core_product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER core_product_fts_insert AFTER INSERT ON core_product BEGIN
+        INSERT INTO core_product_fts(rowid, name, brand, category, description)
+        VALUES (new.id, new.name, new.brand, new.category, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_delete AFTER DELETE ON core_product BEGIN
+        INSERT INTO core_product_fts(core_product_fts, rowid, name, brand, category, description)
+        VALUES ('delete', old.id, old.name, old.brand, old.category, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER core_product_fts_update AFTER UPDATE OF name, brand, category, description ON core_product BEGIN
+        INSERT INTO core_product_fts(core_product_fts, rowid, name, brand, category, description)
+        VALUES ('delete', old.id, old.name, old.brand, old.category, old.description);
+        INSERT INTO core_product_fts(rowid, name, brand, category, description)
+        VALUES (new.id, new.name, new.brand, new.category, new.description);
+    END
+    """,
+    # Index the existing products
+    "INSERT INTO core_product_fts(core_product_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS core_product_fts_insert',
+    'DROP TRIGGER IF EXISTS core_product_fts_delete',
+    'DROP TRIGGER IF EXISTS core_product_fts_update',
+    'DROP TABLE IF EXISTS core_product_fts',
+]
+
+POSTGRESQL_FORWARD = [
+    """
+    ALTER TABLE core_product ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(brand, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(category, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+    ) STORED
+    """,
+    'CREATE INDEX core_product_search_idx ON core_product USING GIN (search_vector)',
+]
+
+POSTGRESQL_BACKWARD = [
+    'DROP INDEX IF EXISTS core_product_search_idx',
+    'ALTER TABLE core_product DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_user_token_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRESQL_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,94 @@
+# Generated by Django 5.1.6 on 2026-10-18 03:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+# Variants of a product from its JSON options, as in core.models.options_to_variants
+def options_to_variants(storage, colors):
+    sizes = [(item['size'], item['in_stock']) for item in storage or [] if isinstance(item, dict) and item.get('size')]
+    shades = [(item['color'], item['in_stock']) for item in colors or [] if isinstance(item, dict) and item.get('color')]
+    if not sizes and not shades:
+        return {}
+    variants = {}
+    for size, size_in_stock in sizes or [('', True)]:
+        for color, color_in_stock in shades or [('', True)]:
+            variants[size, color] = bool(size_in_stock and color_in_stock)
+    return variants
+
+
+# Create a variant per storage/color combination of the existing products. The JSON only
+# says whether an option is available, so available variants start with the stock of their
+# product, then point the cart and order lines at the variant of their color and size
+def convert_options_to_variants(apps, schema_editor):
+    Product = apps.get_model('core', 'Product')
+    ProductVariant = apps.get_model('core', 'ProductVariant')
+    CartItem = apps.get_model('core', 'CartItem')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    db_alias = schema_editor.connection.alias
+
+    batch = []
+    for product in Product.objects.using(db_alias).only('id', 'stock', 'storage', 'colors').iterator(chunk_size=2000):
+        for (storage, color), in_stock in options_to_variants(product.storage, product.colors).items():
+            batch.append(ProductVariant(
+                product_id=product.id, storage=storage, color=color, stock=product.stock if in_stock else 0,
+            ))
+        if len(batch) >= 5000:
+            ProductVariant.objects.using(db_alias).bulk_create(batch)
+            batch = []
+    ProductVariant.objects.using(db_alias).bulk_create(batch)
+
+    for model in [CartItem, OrderItem]:
+        model.objects.using(db_alias).update(variant=Subquery(
+            ProductVariant.objects.using(db_alias).filter(
+                product=OuterRef('product'),
+                storage=Coalesce(OuterRef('size'), Value('')),
+                color=Coalesce(OuterRef('color'), Value('')),
+            ).values('id')[:1]
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_product_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('storage', models.CharField(blank=True, default='', max_length=50)),
+                ('color', models.CharField(blank=True, default='', max_length=50)),
+                ('stock', models.PositiveIntegerField(default=0)),
+                ('price_delta', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='core.product')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='cartitem',
+            name='variant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.productvariant'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='variant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.productvariant'),
+        ),
+        migrations.AddIndex(
+            model_name='productvariant',
+            index=models.Index(condition=models.Q(('stock__gt', 0)), fields=['storage', 'color', 'product'], name='variant_in_stock_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productvariant',
+            index=models.Index(condition=models.Q(('stock__gt', 0)), fields=['color', 'product'], name='variant_color_in_stock_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='productvariant',
+            constraint=models.UniqueConstraint(fields=('product', 'storage', 'color'), name='unique_product_variant'),
+        ),
+        migrations.RunPython(convert_options_to_variants, migrations.RunPython.noop),
+    ]
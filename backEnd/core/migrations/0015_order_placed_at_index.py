@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-18 04:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_product_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['placed_at'], name='order_placed_at_idx'),
+        ),
+    ]
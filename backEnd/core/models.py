@@ -1,7 +1,12 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 
+from .images import renditions_for
+
 # Create your models here.
 
 class UserManager(BaseUserManager):
@@ -35,15 +40,69 @@ class CustomUser(AbstractUser):
     is_staff = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Access tokens carry the version they were issued with and stop working once it changes
+    token_version = models.PositiveIntegerField(default=0)
     
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
     
     objects = UserManager()
     
+    # Fields that access tokens make claims about, or that grant access
+    TOKEN_FIELDS = ('is_active', 'is_staff', 'is_superuser')
+
     def __str__(self):
         return self.email
 
+    # Remember the token related fields as loaded, to notice when they change
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_token_fields = instance.token_fields()
+        instance._loaded_token_version = instance.__dict__.get('token_version')
+        return instance
+
+    def token_fields(self):
+        loaded = self.__dict__
+        return {name: loaded[name] for name in self.TOKEN_FIELDS if name in loaded}
+
+    # A new password, or a change of what the tokens claim, revokes every token issued so far
+    def set_password(self, raw_password):
+        super().set_password(raw_password)
+        self.token_version += 1
+
+    def revoke_tokens(self):
+        self.token_version += 1
+        self.save(update_fields=['token_version'])
+
+    def save(self, *args, **kwargs):
+        loaded = getattr(self, '_loaded_token_fields', None)
+        current = self.token_fields()
+        if loaded is not None and any(current[name] != loaded[name] for name in loaded.keys() & current.keys()):
+            self.token_version += 1
+        # Saving some fields only, a version changed since loaded goes with them: set_password
+        # bumps it, and the hash upgrade of check_password saves the password alone
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and self.token_version != getattr(self, '_loaded_token_version', self.token_version):
+            kwargs['update_fields'] = {*update_fields, 'token_version'}
+        super().save(*args, **kwargs)
+        self._loaded_token_fields = current
+        self._loaded_token_version = self.token_version
+
+
+# A user rebuilt from the claims of an access token without querying the database
+# The fields the token does not carry are deferred, and are loaded together
+# the first time a view reads one of them
+class ClaimsUser(CustomUser):
+    class Meta:
+        proxy = True
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        deferred = self.get_deferred_fields()
+        if fields is not None and deferred and set(fields) <= deferred:
+            fields = deferred
+        super().refresh_from_db(using, fields, from_queryset)
+
 
 # User profile model that extends the CustomUser model
 # This allows us to store additional user information
@@ -54,6 +113,7 @@ class UserProfile(models.Model):
     shipping_address = models.CharField(max_length=255)
     billing_address = models.CharField(max_length=255)
     phone_number = models.CharField(max_length=20)
+    updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
         return self.user.email
@@ -85,6 +145,8 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField()
     image = models.ImageField(upload_to='product_images/', blank=True, null=True)
+    # Resized WebP/AVIF versions of the image and its placeholder (see core/images.py)
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
     storage = models.JSONField(default=default_list, blank=True, null=True)
     colors = models.JSONField(default=default_list, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -92,9 +154,167 @@ class Product(models.Model):
     category = models.CharField(max_length=50, choices=CATEGORY_CHOICES)
     brand = models.CharField(max_length=100)
 
+    class Meta:
+        indexes = [
+            # Catalog pages filter by category and sort or range over the price
+            models.Index(fields=['category', 'price'], name='product_category_price_idx'),
+            models.Index(fields=['brand'], name='product_brand_idx'),
+            # Conditional catalog requests look up the latest change
+            models.Index(fields=['updated_at'], name='product_updated_at_idx'),
+        ]
+
+    # Remember the options, the stock and the image as loaded, to notice when they change
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_options = instance.option_fields()
+        instance._loaded_stock = instance.__dict__.get('stock')
+        instance._loaded_image = instance.image_name()
+        return instance
+
+    def option_fields(self):
+        loaded = self.__dict__
+        return {name: loaded[name] for name in ('storage', 'colors') if name in loaded}
+
+    def image_name(self):
+        image = self.__dict__.get('image')
+        return getattr(image, 'name', image) or ''
+
+    # New products, changed storage/color options and a new stock update the variant rows,
+    # a new image gets its renditions
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        if 'image' in self.__dict__ and self.image_name() != getattr(self, '_loaded_image', ''):
+            # Store the upload first so the renditions are made from the stored file
+            if self.image and not self.image._committed:
+                self.image.save(self.image.name, self.image.file, save=False)
+            self.image_renditions = renditions_for(self.image_name())
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'image_renditions'}
+        super().save(*args, **kwargs)
+        self._loaded_image = self.image_name()
+
+        current = self.option_fields()
+        restock = 'stock' in self.__dict__ and self.stock != getattr(self, '_loaded_stock', self.stock)
+        if adding or restock or current != getattr(self, '_loaded_options', current):
+            ProductVariant.objects.sync_options([self], restock=restock)
+        self._loaded_options = current
+        self._loaded_stock = self.__dict__.get('stock')
+
     def __str__(self):
         return self.name
 
+    # The options in the legacy JSON shape, [{"size": ..., "in_stock": ...}] and
+    # [{"color": ..., "in_stock": ...}], from the variants (prefetch them for lists)
+    def storage_options(self):
+        return self.variant_options('storage', 'size')
+
+    def color_options(self):
+        return self.variant_options('color', 'color')
+
+    def variant_options(self, field, key):
+        in_stock = {}
+        for variant in self.variants.all():
+            value = getattr(variant, field)
+            if value:
+                in_stock[value] = in_stock.get(value, False) or variant.stock > 0
+        return [{key: value, 'in_stock': available} for value, available in in_stock.items()]
+
+
+# The variants of a product as {(storage, color): in_stock} from its JSON options: every
+# storage size with every color, available when both are. A product with only one kind of
+# option has a variant per option (the other one empty), and none without options
+def options_to_variants(storage, colors):
+    sizes = [(item['size'], item['in_stock']) for item in storage or [] if isinstance(item, dict) and item.get('size')]
+    shades = [(item['color'], item['in_stock']) for item in colors or [] if isinstance(item, dict) and item.get('color')]
+    if not sizes and not shades:
+        return {}
+    variants = {}
+    for size, size_in_stock in sizes or [('', True)]:
+        for color, color_in_stock in shades or [('', True)]:
+            variants[size, color] = bool(size_in_stock and color_in_stock)
+    return variants
+
+
+class ProductVariantManager(models.Manager):
+    # Bring the variants of the products in line with their JSON options, in a few bulk
+    # statements: missing variants are created with the stock of their product (or none
+    # when unavailable), options marked out of stock empty their variants and removed
+    # options delete them. The stock of the other variants is left alone, unless restock
+    # is given (the stock of the products changed): it is then reset to the product stock
+    def sync_options(self, products, restock=False):
+        products = {product.pk: product for product in products}
+        existing = {}
+        for variant in self.filter(product_id__in=products.keys()):
+            existing[variant.product_id, variant.storage, variant.color] = variant
+
+        create, empty, wanted = [], [], set()
+        # Variants to reset, by their new stock
+        restocked = {}
+        for product in products.values():
+            for (storage, color), in_stock in options_to_variants(product.storage, product.colors).items():
+                wanted.add((product.pk, storage, color))
+                variant = existing.get((product.pk, storage, color))
+                if variant is None:
+                    create.append(ProductVariant(
+                        product=product, storage=storage, color=color, stock=product.stock if in_stock else 0,
+                    ))
+                elif not in_stock and variant.stock:
+                    empty.append(variant.pk)
+                elif in_stock and restock and variant.stock != product.stock:
+                    restocked.setdefault(product.stock, []).append(variant.pk)
+        delete = [variant.pk for key, variant in existing.items() if key not in wanted]
+
+        self.bulk_create(create)
+        self.filter(pk__in=empty).update(stock=0)
+        for stock, ids in restocked.items():
+            self.filter(pk__in=ids).update(stock=stock)
+        self.filter(pk__in=delete).delete()
+
+
+# A storage/color combination of a product with its own stock and price
+class ProductVariant(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='variants')
+    storage = models.CharField(max_length=50, blank=True, default='')
+    color = models.CharField(max_length=50, blank=True, default='')
+    stock = models.PositiveIntegerField(default=0)
+    # Added to the price of the product
+    price_delta = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    objects = ProductVariantManager()
+
+    class Meta:
+        constraints = [
+            # Also the index for the variants of a product
+            models.UniqueConstraint(fields=['product', 'storage', 'color'], name='unique_product_variant'),
+        ]
+        indexes = [
+            # Catalog filters on the options in stock ("256GB in Black")
+            models.Index(fields=['storage', 'color', 'product'], condition=Q(stock__gt=0), name='variant_in_stock_idx'),
+            models.Index(fields=['color', 'product'], condition=Q(stock__gt=0), name='variant_color_in_stock_idx'),
+        ]
+
+    def __str__(self):
+        return ' / '.join(part for part in [self.product.name, self.storage, self.color] if part)
+
+    @property
+    def price(self):
+        return self.product.price + self.price_delta
+
+
+# Custom cart manager for loading carts together with their items
+class CartManager(models.Manager):
+    # Prefetch the items and their products so serializing a cart and computing
+    # its totals costs a fixed number of queries regardless of the cart size
+    def with_items(self):
+        return self.get_queryset().prefetch_related(
+            models.Prefetch('items', queryset=CartItem.objects.select_related('product', 'variant'))
+        )
+
+    # Mark the carts of a user as changed, cart items are changed with bulk
+    # statements which do not update the timestamp of their cart by themselves
+    def touch(self, user):
+        return self.filter(user=user).update(updated_at=timezone.now())
 
 
 class Cart(models.Model):
@@ -102,6 +322,8 @@ class Cart(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True) 
     
+    objects = CartManager()
+    
     def __str__(self):
         return f"{self.user.username}'s cart"
     
@@ -114,19 +336,88 @@ class Cart(models.Model):
         return sum(item.get_total_price() for item in self.get_items())
 
 
+# Match a product variant, a missing color or size equals an empty one
+# just like in the unique constraint of CartItem
+def variant_filter(color=None, size=None):
+    color_filter = Q(color=color) if color else Q(color__isnull=True) | Q(color='')
+    size_filter = Q(size=size) if size else Q(size__isnull=True) | Q(size='')
+    return color_filter & size_filter
+
+
+# Custom cart item queryset where every change to the cart is a single atomic statement,
+# so concurrent requests never lose an update
+class CartItemQuerySet(models.QuerySet):
+    # Add units of a product variant to a cart, creating its row on the first add
+    # Raises Product.DoesNotExist when there is no row yet and the product does not exist
+    def add_to_cart(self, cart, product_id, color=None, size=None, quantity=1):
+        items = self.filter(cart=cart, product_id=product_id).filter(variant_filter(color, size))
+        if items.update(quantity=F('quantity') + quantity):
+            return
+        if not Product.objects.filter(pk=product_id).exists():
+            raise Product.DoesNotExist(f'Product {product_id} does not exist.')
+        # The variant is looked up by the insert itself
+        variant = ProductVariant.objects.filter(product_id=product_id, storage=size or '', color=color or '')
+        try:
+            with transaction.atomic():
+                self.create(cart=cart, product_id=product_id, variant_id=Subquery(variant.values('id')[:1]),
+                            color=color or None, size=size or None, quantity=quantity)
+        except IntegrityError:
+            # Another request created the row in the meantime, add to it instead
+            items.update(quantity=F('quantity') + quantity)
+
+    # Returns the number of items changed
+    def increment(self):
+        return self.update(quantity=F('quantity') + 1)
+
+    # Take one unit off, deleting the items that reach zero
+    # The update locks the rows until the delete commits, so concurrent decrements wait
+    # for each other instead of both missing the item (a delete, then an update, would not)
+    # Returns the number of items changed
+    def decrement(self):
+        with transaction.atomic():
+            changed = self.filter(quantity__gte=1).update(quantity=F('quantity') - 1)
+            self.filter(quantity=0).delete()
+        return changed
+
+    # Set the quantity, deleting the items when it is zero
+    # Returns the number of items changed
+    def set_quantity(self, quantity):
+        if quantity <= 0:
+            deleted, _ = self.delete()
+            return deleted
+        return self.update(quantity=quantity)
+
+
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    # The variant matching the color and size, if the product has it
+    variant = models.ForeignKey(ProductVariant, on_delete=models.SET_NULL, blank=True, null=True)
     quantity = models.PositiveIntegerField(default=1)
     color = models.CharField(max_length=50, blank=True, null=True)
     size = models.CharField(max_length=50, blank=True, null=True)
     
+    objects = CartItemQuerySet.as_manager()
+    
+    class Meta:
+        constraints = [
+            # A cart holds one row per product variant, missing color/size count as
+            # equal so adding the same product twice can never create a duplicate row
+            models.UniqueConstraint(
+                F('cart'), F('product'), Coalesce('color', Value('')), Coalesce('size', Value('')),
+                name='unique_cart_item_variant',
+            ),
+        ]
+    
     def __str__(self):
         return f"{self.cart.user.username}'s cartitem ({self.quantity} {self.product.name})"
     
-    # Get the total price of cart items
+    # Get the total price of cart items, with the price of their variant
     def get_total_price(self):
-        return self.quantity * self.product.price
+        price = self.product.price
+        if self.variant_id:
+            price += self.variant.price_delta
+        return self.quantity * price
 
 
 # In a real-world application, i would use a more secure way for managing payment details
@@ -135,6 +426,16 @@ class CardDetails(models.Model):
     expiry = models.CharField(max_length=5)
     cvv = models.CharField(max_length=4)
 
+# Custom order manager for loading orders together with their items
+class OrderManager(models.Manager):
+    # Load the card with a join and prefetch the items with their products
+    # so a page of orders costs a fixed number of queries
+    def with_items(self):
+        return self.get_queryset().select_related('card').prefetch_related(
+            models.Prefetch('items', queryset=OrderItem.objects.select_related('product'))
+        )
+
+
 class Order(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='orders')
     shipping_address = models.TextField()
@@ -143,13 +444,30 @@ class Order(models.Model):
     card = models.OneToOneField(CardDetails, on_delete=models.CASCADE, blank=True, null=True)
     status = models.CharField(max_length=50, default='Order placed')
     placed_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Total of the order at the time it was placed
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    
+    objects = OrderManager()
+    
+    class Meta:
+        indexes = [
+            # Order history lists the orders of a user, newest first
+            models.Index(fields=['user', '-placed_at'], name='order_user_placed_at_idx'),
+            # Reporting exports read the orders of a date range in order
+            models.Index(fields=['placed_at'], name='order_placed_at_idx'),
+        ]
     
      # Get all order items related to the user through the order
     def get_items(self):
         return self.items.all()
     
-    # Get the total price of the order
+    # Get the total price of the order, as stored when it was placed
     def get_total_price(self):
+        return self.total
+    
+    # Recalculate the total from the stored line prices
+    def calculate_total(self):
         return sum(item.get_total_price() for item in self.get_items())
     
     # def __str__(self):
@@ -160,12 +478,76 @@ class Order(models.Model):
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    variant = models.ForeignKey(ProductVariant, on_delete=models.SET_NULL, blank=True, null=True)
     status = models.CharField(max_length=50, default='Order placed')
     quantity = models.PositiveIntegerField()
+    # Price of a single unit at the time the order was placed
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     color = models.CharField(max_length=50, blank=True, null=True)
     size = models.CharField(max_length=50, blank=True, null=True)
     
     def get_total_price(self):
-        return self.quantity * self.product.price
+        return self.quantity * self.unit_price
+
+
+
 
+# Daily sales rollups for the reporting dashboards, refreshed from the orders by core/analytics.py
+# Revenue adds up quantity x unit price of the order lines, orders counts distinct orders
+class SalesRollup(models.Model):
+    day = models.DateField()
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        abstract = True
+
+
+# All the sales of a day
+class DailySales(SalesRollup):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day'], name='unique_daily_sales'),
+        ]
+
+
+# Sales of a product in a day, with its category and brand when the rollup was made
+class DailyProductSales(SalesRollup):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    category = models.CharField(max_length=50)
+    brand = models.CharField(max_length=100)
+
+    class Meta:
+        constraints = [
+            # Also the index for the products sold over a range of days
+            models.UniqueConstraint(fields=['day', 'product'], name='unique_daily_product_sales'),
+        ]
+
+
+class DailyCategorySales(SalesRollup):
+    category = models.CharField(max_length=50)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'category'], name='unique_daily_category_sales'),
+        ]
+
+
+class DailyBrandSales(SalesRollup):
+    brand = models.CharField(max_length=100)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'brand'], name='unique_daily_brand_sales'),
+        ]
+
+
+# How far the rollups have been refreshed: every order placed before placed_at is counted
+class SalesWatermark(models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    placed_at = models.DateTimeField(blank=True, null=True)
+    refreshed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.name} up to {self.placed_at}'
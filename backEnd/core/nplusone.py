@@ -0,0 +1,87 @@
+import json
+import logging
+import re
+import sys
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.serializers import BaseSerializer
+
+
+logger = logging.getLogger('core.nplusone')
+
+
+# N+1 query detection
+#
+# Every query run while a serializer renders is attributed to the serializer field being
+# read, found by walking up the stack to the Serializer.to_representation frame. The same
+# field running the same query (same SQL, parameters left out) NPLUSONE_THRESHOLD times
+# or more is a query per row: a missing select_related / prefetch_related.
+# NPLUSONE_MODE decides what happens then: "raise" (the test suite), "log" (staging) or "off".
+
+
+class NPlusOneQueries(Exception):
+    pass
+
+
+# Lists of placeholders (IN clauses) of any length have the same shape
+PLACEHOLDER_LISTS = re.compile(r'%s(?:\s*,\s*%s)*')
+
+
+def fingerprint(sql):
+    return PLACEHOLDER_LISTS.sub('?', sql)
+
+
+# "<Serializer>.<field>" of the innermost field being rendered, None outside of serializers
+def serializer_field(frame):
+    while frame is not None:
+        if frame.f_code.co_name == 'to_representation':
+            serializer, field = frame.f_locals.get('self'), frame.f_locals.get('field')
+            if isinstance(serializer, BaseSerializer) and hasattr(field, 'field_name'):
+                return f'{type(serializer).__name__}.{field.field_name}'
+        frame = frame.f_back
+    return None
+
+
+# Execute wrapper counting the queries of each serializer field by shape
+class QueryCollector:
+    def __init__(self):
+        self.counts = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        origin = serializer_field(sys._getframe(1))
+        if origin is not None:
+            self.counts[origin, fingerprint(sql)] += 1
+        return execute(sql, params, many, context)
+
+    def repeated(self, threshold):
+        return [(origin, sql, count) for (origin, sql), count in self.counts.items() if count >= threshold]
+
+
+def report(collector, context=''):
+    repeated = collector.repeated(settings.NPLUSONE_THRESHOLD)
+    if not repeated:
+        return
+    if settings.NPLUSONE_MODE == 'raise':
+        details = '\n'.join(f'  {origin} ran {count} times: {sql}' for origin, sql, count in repeated)
+        raise NPlusOneQueries(f'N+1 queries{f" in {context}" if context else ""}:\n{details}')
+    for origin, sql, count in repeated:
+        logger.warning(json.dumps({'context': context, 'field': origin, 'count': count, 'sql': sql}))
+
+
+def install(collector):
+    stack = ExitStack()
+    for alias in connections:
+        stack.enter_context(connections[alias].execute_wrapper(collector))
+    return stack
+
+
+# Detect N+1 queries in a block of code, e.g. a serializer used outside of a request
+@contextmanager
+def detect_nplusone(context=''):
+    collector = QueryCollector()
+    with install(collector):
+        yield collector
+    report(collector, context)
@@ -0,0 +1,27 @@
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+# Cursor pagination for a user's order history
+# Newest orders come first and a page never holds more than max_page_size orders
+class OrderHistoryPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-placed_at', '-id')
+
+
+# Page number pagination for the product catalog
+# Only used when the client asks for it with ?limit= (and optionally ?page=),
+# requests without it keep getting the whole catalog
+class CatalogPagination(PageNumberPagination):
+    page_size = None
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
+# Page number pagination for the search results, always paginated
+# as a search can match most of the catalog
+class SearchPagination(PageNumberPagination):
+    page_size = 20
+    page_size_query_param = 'limit'
+    max_page_size = 100
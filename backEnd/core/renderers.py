@@ -0,0 +1,16 @@
+import time
+
+from rest_framework.renderers import JSONRenderer
+
+
+# JSON renderer recording how long the body took to render on the request,
+# for PerformanceMiddleware
+class TimedJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        start = time.perf_counter()
+        content = super().render(data, accepted_media_type, renderer_context)
+        request = (renderer_context or {}).get('request')
+        metrics = getattr(request, 'performance', None) if request is not None else None
+        if metrics is not None:
+            metrics.render_duration += time.perf_counter() - start
+        return content
@@ -1,8 +1,10 @@
+from django.urls import path
 from rest_framework import routers
 
+from . import async_views
 from .views import (
     UserProfileViewSet, ProductViewSet, CartViewSet,
-    CartItemViewSet, OrderViewSet, OrderItemViewSet
+    CartItemViewSet, OrderViewSet, OrderItemViewSet, CacheStatsView, SalesAnalyticsView
 )
 
 
@@ -20,5 +22,12 @@ routes.register(r'order-item', OrderItemViewSet, basename='order-item')
 
 
 urlpatterns = [
-    *routes.urls
+    *routes.urls,
+    path('cache/stats/', CacheStatsView.as_view(), name='cache-stats'),
+    path('analytics/sales/', SalesAnalyticsView.as_view(), name='sales-analytics'),
+    # Async versions of the hot read endpoints, for ASGI deployments
+    path('async/products/', async_views.product_list, name='async-products-list'),
+    path('async/products/<int:pk>/', async_views.product_detail, name='async-products-detail'),
+    path('async/cart/me/', async_views.my_cart, name='async-cart-me'),
+    path('async/orders/me/', async_views.my_orders, name='async-orders-me'),
 ]
\ No newline at end of file
@@ -0,0 +1,208 @@
+import re
+
+from django.db import connections, router
+from django.db.models import Q
+
+from .models import Product
+
+
+# Full-text search over the products, backed by the index of migration 0012:
+# FTS5 on SQLite, a tsvector column with a GIN index on PostgreSQL, and plain
+# icontains lookups on any other database.
+#
+# Every term of the query matches as a prefix, so "sams gal" finds "Samsung Galaxy"
+# while the user is still typing. Results come best match first.
+
+# Letters and digits, the same way the index splits the text
+TERMS = re.compile(r'\w+', re.UNICODE)
+MAX_TERMS = 8
+
+
+def search_terms(query):
+    return TERMS.findall(query.lower())[:MAX_TERMS]
+
+
+# Ids of the products matching the terms as (sql, params), for filtering a queryset
+# (e.g. in the admin) without ranking
+def matching_ids_sql(terms):
+    return backend().matching_ids_sql(terms)
+
+
+# Only the products of the queryset matching the terms, unranked
+def filter_matching(queryset, terms):
+    sql, params = matching_ids_sql(terms)
+    return queryset.extra(where=[f'{queryset.model._meta.db_table}.id IN ({sql})'], params=params)
+
+
+# SQL and params of the ids of a product queryset, to restrict a search to it
+def queryset_ids_sql(queryset):
+    return queryset.order_by().values('id').query.sql_with_params()
+
+
+# SQL condition restricting the column to the ids of the queryset, nothing for the whole catalog
+def within_sql(column, queryset):
+    if not queryset.query.where:
+        return '', []
+    sql, params = queryset_ids_sql(queryset)
+    return f' AND {column} IN ({sql})', list(params)
+
+
+class SQLiteSearch:
+    # Name, brand, category and description, in the order of the FTS5 columns
+    WEIGHTS = (10.0, 6.0, 3.0, 1.0)
+
+    def match(self, terms):
+        # Quoted so the terms are never read as FTS5 operators
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    def matching_ids_sql(self, terms):
+        return 'SELECT rowid FROM core_product_fts WHERE core_product_fts MATCH %s', [self.match(terms)]
+
+    # "+rowid" keeps the IN out of the index lookup: SQLite would otherwise look up every
+    # product of the subquery in the FTS table one by one instead of running the MATCH once
+    def count(self, terms, within):
+        condition, within_params = within_sql('+rowid', within)
+        sql = f'SELECT COUNT(*) FROM core_product_fts WHERE core_product_fts MATCH %s{condition}'
+        with read_connection().cursor() as cursor:
+            cursor.execute(sql, [self.match(terms), *within_params])
+            return cursor.fetchone()[0]
+
+    def ranked_ids(self, terms, within, offset, limit):
+        condition, within_params = within_sql('+rowid', within)
+        weights = ', '.join(str(weight) for weight in self.WEIGHTS)
+        sql = (
+            f'SELECT rowid FROM core_product_fts WHERE core_product_fts MATCH %s{condition} '
+            f'ORDER BY bm25(core_product_fts, {weights}), rowid LIMIT %s OFFSET %s'
+        )
+        with read_connection().cursor() as cursor:
+            cursor.execute(sql, [self.match(terms), *within_params, limit, offset])
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgreSQLSearch:
+    def query(self, terms):
+        return ' & '.join(f'{term}:*' for term in terms)
+
+    def matching_ids_sql(self, terms):
+        return "SELECT id FROM core_product WHERE search_vector @@ to_tsquery('simple', %s)", [self.query(terms)]
+
+    def count(self, terms, within):
+        condition, within_params = within_sql('id', within)
+        sql = f"SELECT COUNT(*) FROM core_product WHERE search_vector @@ to_tsquery('simple', %s){condition}"
+        with read_connection().cursor() as cursor:
+            cursor.execute(sql, [self.query(terms), *within_params])
+            return cursor.fetchone()[0]
+
+    def ranked_ids(self, terms, within, offset, limit):
+        condition, within_params = within_sql('id', within)
+        sql = (
+            "SELECT id FROM core_product, to_tsquery('simple', %s) query "
+            f"WHERE search_vector @@ query{condition} "
+            "ORDER BY ts_rank(search_vector, query) DESC, id LIMIT %s OFFSET %s"
+        )
+        with read_connection().cursor() as cursor:
+            cursor.execute(sql, [self.query(terms), *within_params, limit, offset])
+            return [row[0] for row in cursor.fetchall()]
+
+
+# Table scans, for databases without a search index
+class FallbackSearch:
+    FIELDS = ['name', 'brand', 'category', 'description']
+
+    def filter(self, terms):
+        condition = Q()
+        for term in terms:
+            condition &= Q(*[Q(**{f'{field}__icontains': term}) for field in self.FIELDS], _connector=Q.OR)
+        return condition
+
+    def matching_ids_sql(self, terms):
+        return queryset_ids_sql(Product.objects.filter(self.filter(terms)))
+
+    def count(self, terms, within):
+        return within.filter(self.filter(terms)).count()
+
+    def ranked_ids(self, terms, within, offset, limit):
+        return list(within.filter(self.filter(terms)).order_by('name', 'id').values_list('id', flat=True)[offset:offset + limit])
+
+
+BACKENDS = {'sqlite': SQLiteSearch, 'postgresql': PostgreSQLSearch}
+
+
+# The connection the products are read from, a replica when the router picks one (see db_routers.py)
+def read_connection():
+    return connections[router.db_for_read(Product)]
+
+
+def backend():
+    return BACKENDS.get(read_connection().vendor, FallbackSearch)()
+
+
+# Search results of a query within a product queryset, in rank order
+# Supports count() and slicing, so Django's Paginator (and DRF's pagination) pages
+# through it, and only the products of the requested page are loaded
+class SearchResults:
+    def __init__(self, query, within=None, search_backend=None):
+        self.terms = search_terms(query)
+        self.within = Product.objects.all() if within is None else within
+        self.backend = search_backend or backend()
+
+    def count(self):
+        if not self.terms:
+            return 0
+        return self.backend.count(self.terms, self.within)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        if not self.terms:
+            return []
+        offset = index.start or 0
+        ids = self.backend.ranked_ids(self.terms, self.within, offset, index.stop - offset)
+        products = Product.objects.in_bulk(ids)
+        return [products[pk] for pk in ids if pk in products]
+
+
+SQLITE_TRIGGERS = {
+    'core_product_fts_insert': """
+        CREATE TRIGGER IF NOT EXISTS core_product_fts_insert AFTER INSERT ON core_product BEGIN
+            INSERT INTO core_product_fts(rowid, name, brand, category, description)
+            VALUES (new.id, new.name, new.brand, new.category, new.description);
+        END
+    """,
+    'core_product_fts_delete': """
+        CREATE TRIGGER IF NOT EXISTS core_product_fts_delete AFTER DELETE ON core_product BEGIN
+            INSERT INTO core_product_fts(core_product_fts, rowid, name, brand, category, description)
+            VALUES ('delete', old.id, old.name, old.brand, old.category, old.description);
+        END
+    """,
+    'core_product_fts_update': """
+        CREATE TRIGGER IF NOT EXISTS core_product_fts_update
+        AFTER UPDATE OF name, brand, category, description ON core_product BEGIN
+            INSERT INTO core_product_fts(core_product_fts, rowid, name, brand, category, description)
+            VALUES ('delete', old.id, old.name, old.brand, old.category, old.description);
+            INSERT INTO core_product_fts(rowid, name, brand, category, description)
+            VALUES (new.id, new.name, new.brand, new.category, new.description);
+        END
+    """,
+}
+
+
+# SQLite rebuilds a table when a migration alters it and its triggers go with the old table.
+# Runs after migrate: puts back any missing trigger and reindexes, as writes made
+# without the triggers are not in the index
+def ensure_search_index(using='default'):
+    db = connections[using]
+    if db.vendor != 'sqlite':
+        return
+    with db.cursor() as cursor:
+        names = ['core_product_fts', *SQLITE_TRIGGERS]
+        cursor.execute(f"SELECT name FROM sqlite_master WHERE name IN ({', '.join(['%s'] * len(names))})", names)
+        existing = {row[0] for row in cursor.fetchall()}
+        if 'core_product_fts' not in existing or existing.issuperset(SQLITE_TRIGGERS):
+            return
+        for statement in SQLITE_TRIGGERS.values():
+            cursor.execute(statement)
+        cursor.execute("INSERT INTO core_product_fts(core_product_fts) VALUES ('rebuild')")
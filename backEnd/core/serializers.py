@@ -3,20 +3,35 @@ from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.utils.formats import date_format
 
+from .authentication import USER_CLAIMS
+from .images import srcset
+from .middleware import current_metrics
 from .models import (
-    UserProfile, Product, Cart, CartItem, Order,
+    UserProfile, Product, ProductVariant, Cart, CartItem, Order,
     OrderItem, CardDetails
 )
 
 # Serializers for the models in the application
 
-class UserProfileSerializer(serializers.ModelSerializer):
+
+# Adds the time the serializer takes to the metrics of the request (see PerformanceMiddleware)
+# Lists time each of their items, the queries the serializer runs are left out
+class TimedSerializerMixin:
+    def to_representation(self, instance):
+        metrics = current_metrics.get()
+        if metrics is None:
+            return super().to_representation(instance)
+        with metrics.serialization():
+            return super().to_representation(instance)
+
+
+class UserProfileSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = UserProfile
         fields = "__all__"
         read_only_fields = ['created_at', 'updated_at']
 
-class UserSerializer(BaseUserSerializer):
+class UserSerializer(TimedSerializerMixin, BaseUserSerializer):
     class Meta(BaseUserSerializer.Meta):
         fields = ['id', 'username', 'email', 'is_active', 'created_at', 'updated_at']
         read_only_fields = ['is_active', 'created_at', 'updated_at']
@@ -25,6 +40,14 @@ class UserSerializer(BaseUserSerializer):
         
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+    # Add the claims StatelessJWTAuthentication trusts instead of loading the user
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        for claim in USER_CLAIMS:
+            token[claim] = getattr(user, claim)
+        return token
+
     # Custom serializer to include user data in the token response
     def validate(self, attrs):
         data = super().validate(attrs)
@@ -32,14 +55,54 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         return data
     
 
-class ProductSerializer(serializers.ModelSerializer):
+# The renditions of a product image as srcset strings per format, with the placeholder
+class ImageSrcsetField(serializers.Field):
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return srcset(value, self.context.get('request'))
+
+
+class ProductVariantSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = ProductVariant
+        fields = ['id', 'storage', 'color', 'stock', 'price_delta', 'price']
+        read_only_fields = fields
+
+
+class ProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    variants = ProductVariantSerializer(many=True, read_only=True)
+    image_srcset = ImageSrcsetField(source='image_renditions')
+
     class Meta:
         model = Product
-        fields = "__all__"
+        exclude = ['image_renditions']
         read_only_fields = ['created_at', 'updated_at']
 
+    # The storage and color options keep their JSON shape, with the availability of the variants
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['storage'] = instance.storage_options()
+        data['colors'] = instance.color_options()
+        return data
+
+
+# Slim representation of a product for catalog listings
+# Leaves out the description and the storage/color options, which only the product page needs
+class ProductListSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    image_srcset = ImageSrcsetField(source='image_renditions')
+
+    class Meta:
+        model = Product
+        fields = ['id', 'name', 'brand', 'category', 'price', 'stock', 'image', 'image_srcset']
+        read_only_fields = fields
+
         
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     # Get the product name and id
     product_name = serializers.CharField(source='product.name', read_only=True)
     product_id = serializers.IntegerField(source='product.id', read_only=True)
@@ -50,14 +113,14 @@ class CartItemSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = CartItem
-        fields = ['id', 'product_name', 'product_id', 'quantity', 'total_price', 'color', 'size']
-        read_only_fields = ['id', 'product_name', 'product_id', 'quantity', 'color', 'size']
+        fields = ['id', 'product_name', 'product_id', 'variant', 'quantity', 'total_price', 'color', 'size']
+        read_only_fields = ['id', 'product_name', 'product_id', 'variant', 'quantity', 'color', 'size']
         
     # Method to calculate the total price of the cart item
     def get_total_price(self, obj):
         return obj.get_total_price()
         
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     # Serialize the related CartItems
     items = CartItemSerializer(many=True, read_only=True)
     total_price = serializers.SerializerMethodField()
@@ -71,34 +134,64 @@ class CartSerializer(serializers.ModelSerializer):
     def get_total_price(self, obj):
         return obj.get_total_price()
 
+
+
+# A single change to a cart, the product variant is identified by product, color and size
+class CartOperationSerializer(serializers.Serializer):
+    OPERATIONS = ['add', 'set', 'remove']
+
+    op = serializers.ChoiceField(choices=OPERATIONS)
+    product = serializers.IntegerField()
+    color = serializers.CharField(required=False, allow_null=True, allow_blank=True, default=None)
+    size = serializers.CharField(required=False, allow_null=True, allow_blank=True, default=None)
+    quantity = serializers.IntegerField(required=False, min_value=0)
+
+    def validate(self, attrs):
+        if attrs['op'] == 'set' and 'quantity' not in attrs:
+            raise serializers.ValidationError({'quantity': 'This field is required to set a quantity.'})
+        if attrs['op'] == 'add':
+            attrs.setdefault('quantity', 1)
+            if attrs['quantity'] < 1:
+                raise serializers.ValidationError({'quantity': 'Ensure this value is greater than or equal to 1.'})
+        return attrs
+
+
+# A list of cart changes applied together
+class CartBatchSerializer(serializers.Serializer):
+    operations = serializers.ListField(child=CartOperationSerializer(), min_length=1, max_length=100)
         
         
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     # Use a SerializerMethodField to get the product name
     product_name = serializers.CharField(source='product.name', read_only=True)
     # Use a SerializerMethodField to get the product image
     product_image = serializers.ImageField(source='product.image', read_only=True)
-    # Use a SerializerMethodField to get the product price
+    # Resized versions of the product image for the order history
+    product_image_srcset = ImageSrcsetField(source='product.image_renditions')
+    # Use a SerializerMethodField to get the line total
     total_price = serializers.SerializerMethodField()
     
     
     class Meta:
         model = OrderItem
-        fields = ['id', 'product_name', 'product_image', 'status', 'quantity', 'total_price', 'color', 'size']
-        read_only_fields = ['id', 'product_name', 'product_image', 'quantity', 'color', 'size']
+        fields = [
+            'id', 'product_name', 'product_image', 'product_image_srcset', 'variant', 'status', 'quantity',
+            'unit_price', 'total_price', 'color', 'size',
+        ]
+        read_only_fields = ['id', 'product_name', 'product_image', 'product_image_srcset', 'variant', 'quantity', 'unit_price', 'color', 'size']
         
-    # Method to calculate the total price of the order item
+    # Method to calculate the total price of the order item from its stored unit price
     def get_total_price(self, obj):
         return obj.get_total_price()
     
     
-class CardDetailsSerializer(serializers.ModelSerializer):
+class CardDetailsSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = CardDetails
         fields = ['card_number', 'expiry', 'cvv']
         read_only_fields = ['card_number', 'expiry', 'cvv']
     
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(TimedSerializerMixin, serializers.ModelSerializer):
       # Serialize the related OrderItems
     items = OrderItemSerializer(many=True, read_only=True)
     card = CardDetailsSerializer(read_only=True)
@@ -121,7 +214,7 @@ class OrderSerializer(serializers.ModelSerializer):
         ]
         
 
-    # Method to calculate the total price of the order
+    # Method to get the total price of the order as stored when it was placed
     def get_total_price(self, obj):
         return obj.get_total_price()
     
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .authentication import token_version_key, MISSING_USER
+from .cache import invalidate_namespace
+from .models import CustomUser, ClaimsUser, Product, ProductVariant, Order, OrderItem
+from .search import ensure_search_index
+
+
+# Keep the cached token version of a user current, so revoked tokens stop working at once
+@receiver(post_save, sender=CustomUser)
+@receiver(post_save, sender=ClaimsUser)
+def cache_token_version(sender, instance, **kwargs):
+    cache.set(token_version_key(instance.pk), instance.token_version, settings.AUTH_TOKEN_VERSION_CACHE_TIMEOUT)
+
+
+@receiver(post_delete, sender=CustomUser)
+@receiver(post_delete, sender=ClaimsUser)
+def forget_token_version(sender, instance, **kwargs):
+    cache.set(token_version_key(instance.pk), MISSING_USER, settings.AUTH_TOKEN_VERSION_CACHE_TIMEOUT)
+
+
+# The namespaces are invalidated once the change is committed: bumped before, a concurrent
+# request could still read the old rows and cache them under the new version
+
+# Invalidate the cached catalog responses whenever a product changes
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductVariant)
+def invalidate_catalog_cache(sender, **kwargs):
+    transaction.on_commit(lambda: invalidate_namespace('catalog'))
+
+
+# Invalidate the cached order history of the user whenever one of their orders changes
+@receiver([post_save, post_delete], sender=Order)
+def invalidate_order_history_cache(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_namespace(f'orders:{user_id}'))
+
+
+# A changed order line (e.g. its status) changes the order it belongs to
+@receiver([post_save, post_delete], sender=OrderItem)
+def touch_order(sender, instance, **kwargs):
+    Order.objects.filter(pk=instance.order_id).update(updated_at=timezone.now())
+    user_id = Order.objects.filter(pk=instance.order_id).values_list('user_id', flat=True).first()
+    if user_id is not None:
+        transaction.on_commit(lambda: invalidate_namespace(f'orders:{user_id}'))
+
+
+# Put back the search index triggers when a migration rebuilt the product table (SQLite)
+@receiver(post_migrate)
+def repair_search_index(sender, using, **kwargs):
+    if sender.name == 'core':
+        ensure_search_index(using)
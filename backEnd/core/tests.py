@@ -1,3 +1,1530 @@
-from django.test import TestCase
+from datetime import date
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import csv
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from asgiref.sync import sync_to_async
+from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import connection, connections, transaction
+from django.utils.dateparse import parse_datetime
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.authentication import user_from_claims
+from core.benchmarking import seed, compare_to_baseline
+from core.cache import LocalCache, get_namespace_version, invalidate_namespace, local_cache, stats
+from core.metrics import reset_metrics
+from core.nplusone import NPlusOneQueries, detect_nplusone
+from core.search import SearchResults, FallbackSearch, ensure_search_index
+from core.images import output_formats
+from core.analytics import refresh_sales, rebuild_sales
+from core.serializers import CartSerializer
+from core.db_routers import PrimaryReplicaRouter, current_request, pin_key, _lag_checks
+from core.management.commands.benchmark_api import Command as BenchmarkApiCommand
+from core.models import (
+    CustomUser, UserProfile, Product, ProductVariant, Cart, CartItem, Order, OrderItem, CardDetails, options_to_variants,
+    DailySales, DailyProductSales, DailyCategorySales, DailyBrandSales, SalesWatermark,
+)
 
 # Create your tests here.
+
+
+# The response cache outlives the rolled back test transactions, start every test with it empty
+def clear_caches():
+    cache.clear()
+    local_cache.clear()
+    stats.reset()
+
+
+# Helper for creating products in tests
+def make_product(**overrides):
+    fields = {
+        'name': 'Test Phone',
+        'brand': 'Acme',
+        'description': 'A test product',
+        'price': Decimal('100.00'),
+        'stock': 10,
+        'category': 'Budget Phones',
+    }
+    fields.update(overrides)
+    return Product.objects.create(**fields)
+
+
+class CartReadQueriesTest(TestCase):
+    # Reading a cart must cost the same number of queries whatever its size
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+
+    def fill_cart(self, count):
+        for index in range(count):
+            product = make_product(name=f'Phone {index}', price=Decimal('10.00') * (index + 1))
+            CartItem.objects.create(cart=self.cart, product=product, quantity=2)
+
+    def test_get_my_cart_uses_constant_queries(self):
+        for count in (1, 10):
+            CartItem.objects.all().delete()
+            self.fill_cart(count)
+            # 1 for the ETag, 2 for the cart and its items
+            with self.assertNumQueries(3):
+                response = self.client.get('/api/cart/me/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['items']), count)
+
+    def test_cart_total_is_computed_from_items(self):
+        self.fill_cart(3)
+        response = self.client.get('/api/cart/me/')
+        # 2 * (10 + 20 + 30)
+        self.assertEqual(response.data['total_price'], Decimal('120.00'))
+        self.assertEqual(response.data['items'][0]['total_price'], Decimal('20.00'))
+
+    def test_cart_mutation_returns_full_cart_with_constant_queries(self):
+        self.fill_cart(5)
+        item = self.cart.items.first()
+        # 1 update, 1 to touch the cart, 2 for reading the cart back
+        with self.assertNumQueries(4):
+            response = self.client.patch(f'/api/cart-item/{item.id}/', {'action': 'increment'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['items']), 5)
+
+    def test_clear_cart_removes_all_items(self):
+        self.fill_cart(3)
+        response = self.client.post('/api/cart/clear/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(CartItem.objects.filter(cart=self.cart).exists())
+
+
+class OrderHistoryQueriesTest(TestCase):
+    # The order history must be served in a fixed number of queries, one page at a time
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('buyer', 'buyer@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = make_product(price=Decimal('25.00'))
+
+    def place_orders(self, count, items_per_order=3):
+        for _ in range(count):
+            card = CardDetails.objects.create(card_number='4242424242424242', expiry='12/30', cvv='123')
+            order = Order.objects.create(
+                user=self.user, shipping_address='Street 1', billing_address='Street 1',
+                payment_method='card', card=card, total=self.product.price * 2 * items_per_order
+            )
+            for _ in range(items_per_order):
+                OrderItem.objects.create(order=order, product=self.product, quantity=2, unit_price=self.product.price)
+
+    def test_get_my_orders_uses_constant_queries(self):
+        for count in (1, 8):
+            with self.captureOnCommitCallbacks(execute=True):
+                Order.objects.all().delete()
+                self.place_orders(count)
+            # 1 for the ETag, 2 for the orders and their items
+            with self.assertNumQueries(3):
+                response = self.client.get('/api/orders/me/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['results']), count)
+
+    def test_order_totals_use_prices_at_placement(self):
+        self.place_orders(1)
+        # Changing the price afterwards must not rewrite the order history
+        Product.objects.filter(pk=self.product.pk).update(price=Decimal('99.00'))
+        response = self.client.get('/api/orders/me/')
+        order = response.data['results'][0]
+        # 3 items * 2 * 25
+        self.assertEqual(order['total_price'], Decimal('150.00'))
+        self.assertEqual(order['items'][0]['unit_price'], '25.00')
+        self.assertEqual(order['items'][0]['total_price'], Decimal('50.00'))
+        self.assertEqual(order['card']['expiry'], '12/30')
+
+    def test_get_my_orders_is_paginated(self):
+        self.place_orders(3, items_per_order=1)
+        response = self.client.get('/api/orders/me/', {'page_size': 2})
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNotNone(response.data['next'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
+
+    def test_get_my_orders_without_orders_returns_404(self):
+        response = self.client.get('/api/orders/me/')
+        self.assertEqual(response.status_code, 404)
+
+
+# Payload of a card order for the given items
+def order_payload(items):
+    return {
+        'shipping_address': 'Street 1',
+        'billing_address': 'Street 1',
+        'payment_method': 'card',
+        'card': {'cardNumber': '4242424242424242', 'expiry': '12/30', 'cvv': '123'},
+        'items': items,
+    }
+
+
+class OrderPlacementTest(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('buyer', 'buyer@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.phone = make_product(name='Phone', price=Decimal('300.00'), stock=5)
+        self.case = make_product(name='Case', price=Decimal('20.00'), stock=50)
+
+    def test_create_order_reserves_stock(self):
+        items = [
+            {'product': self.phone.id, 'quantity': 2, 'color': 'Black', 'size': '128GB'},
+            {'product': self.case.id, 'quantity': 3},
+        ]
+        response = self.client.post('/api/orders/', order_payload(items), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data['items']), 2)
+        self.assertEqual(response.data['total_price'], Decimal('660.00'))
+        self.phone.refresh_from_db()
+        self.case.refresh_from_db()
+        self.assertEqual((self.phone.stock, self.case.stock), (3, 47))
+        order = Order.objects.get()
+        self.assertEqual(order.total, Decimal('660.00'))
+        self.assertEqual(order.calculate_total(), order.total)
+
+    def test_create_order_queries_grow_only_with_distinct_products(self):
+        products = [make_product(name=f'Item {index}', stock=10) for index in range(10)]
+        # 1 product fetch, 1 stock update per distinct product, card, order, item insert,
+        # 2 to read the order back and the savepoint handling of the transaction
+        cases = [
+            (9, [products[0]]),
+            # More lines of the same product cost nothing more
+            (9, [products[1]] * 5),
+            (18, products),
+        ]
+        for queries, lines in cases:
+            items = [{'product': product.id, 'quantity': 1} for product in lines]
+            with self.subTest(lines=len(lines)), self.assertNumQueries(queries):
+                response = self.client.post('/api/orders/', order_payload(items), format='json')
+            self.assertEqual(response.status_code, 201)
+
+    def test_insufficient_stock_fails_whole_order(self):
+        items = [
+            {'product': self.case.id, 'quantity': 1},
+            {'product': self.phone.id, 'quantity': 6},
+        ]
+        response = self.client.post('/api/orders/', order_payload(items), format='json')
+        self.assertEqual(response.status_code, 409)
+        self.case.refresh_from_db()
+        self.assertEqual(self.case.stock, 50)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(CardDetails.objects.exists())
+
+    def test_unknown_product_is_rejected(self):
+        response = self.client.post('/api/orders/', order_payload([{'product': 999, 'quantity': 1}]), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+
+class ConcurrentCheckoutTest(TransactionTestCase):
+    # Many buyers racing for the last units of a product must never oversell it
+
+    def test_parallel_checkouts_do_not_oversell(self):
+        stock, buyers = 3, 12
+        product = make_product(stock=stock)
+        users = [
+            CustomUser.objects.create_user(f'buyer{index}', f'buyer{index}@example.com', 'password')
+            for index in range(buyers)
+        ]
+        barrier = threading.Barrier(buyers)
+
+        def checkout(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            barrier.wait()
+            try:
+                response = client.post('/api/orders/', order_payload([{'product': product.id, 'quantity': 1}]), format='json')
+                return response.status_code
+            except Exception:
+                # A busy database counts as a failed checkout, never as a sale
+                return None
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=buyers) as pool:
+            results = list(pool.map(checkout, users))
+
+        product.refresh_from_db()
+        sold = results.count(201)
+        self.assertEqual(sold, stock)
+        self.assertEqual(results.count(409), buyers - stock)
+        self.assertEqual(product.stock, stock - sold)
+        self.assertEqual(OrderItem.objects.count(), sold)
+
+
+class ProductCatalogTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.budget = make_product(name='Budget', brand='Acme', category='Budget Phones', price=Decimal('150.00'))
+        self.flagship = make_product(name='Flagship', brand='Zenith', category='Flagship Phones', price=Decimal('999.00'))
+        self.sold_out = make_product(name='Sold out', brand='Acme', category='Tablets', price=Decimal('400.00'), stock=0)
+
+    def ids(self, response):
+        results = response.data['results'] if 'results' in response.data else response.data
+        return [product['id'] for product in results]
+
+    def test_unpaginated_list_keeps_full_representation(self):
+        response = self.client.get('/api/products/')
+        self.assertEqual(len(response.data), 3)
+        self.assertIn('description', response.data[0])
+
+    def test_paginated_list_uses_slim_representation(self):
+        response = self.client.get('/api/products/', {'limit': 2})
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertNotIn('description', response.data['results'][0])
+        self.assertNotIn('storage', response.data['results'][0])
+        response = self.client.get('/api/products/', {'limit': 2, 'page': 2})
+        self.assertEqual(self.ids(response), [self.sold_out.id])
+
+    def test_filters_and_ordering(self):
+        response = self.client.get('/api/products/', {'brand': 'Acme', 'limit': 10})
+        self.assertEqual(self.ids(response), [self.budget.id, self.sold_out.id])
+        response = self.client.get('/api/products/', {'category': 'Budget Phones,Flagship Phones', 'ordering': '-price'})
+        self.assertEqual(self.ids(response), [self.flagship.id, self.budget.id])
+        response = self.client.get('/api/products/', {'min_price': '200', 'max_price': '500'})
+        self.assertEqual(self.ids(response), [self.sold_out.id])
+        response = self.client.get('/api/products/', {'in_stock': 'true', 'ordering': 'price'})
+        self.assertEqual(self.ids(response), [self.budget.id, self.flagship.id])
+
+    def test_invalid_filters_are_rejected(self):
+        self.assertEqual(self.client.get('/api/products/', {'ordering': 'stock'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/products/', {'min_price': 'cheap'}).status_code, 400)
+
+    def test_repeated_reads_are_served_from_cache(self):
+        self.client.get('/api/products/', {'limit': 2})
+        self.client.get(f'/api/products/{self.budget.id}/')
+        # Only the ETag lookups hit the database
+        with self.assertNumQueries(2):
+            self.client.get('/api/products/', {'limit': 2})
+            response = self.client.get(f'/api/products/{self.budget.id}/')
+        self.assertEqual(response.data['name'], 'Budget')
+
+    def test_saving_a_product_invalidates_cache(self):
+        self.client.get(f'/api/products/{self.budget.id}/')
+        self.budget.name = 'Budget 2'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.budget.save()
+        response = self.client.get(f'/api/products/{self.budget.id}/')
+        self.assertEqual(response.data['name'], 'Budget 2')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sold_out.delete()
+        self.assertEqual(len(self.client.get('/api/products/').data), 2)
+
+
+class ProductSearchTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.galaxy = make_product(name='Galaxy S24', brand='Samsung', category='Flagship Phones',
+                                   description='Samsung flagship with a great camera')
+        self.case = make_product(name='Phone case', brand='Acme', category='Accessories',
+                                 description='Fits the Galaxy S24 and the Samsung Galaxy S23')
+        self.pixel = make_product(name='Pixel 8', brand='Google', category='Flagship Phones',
+                                  description='Clean Android', stock=0)
+
+    def ids(self, response):
+        return [product['id'] for product in response.data['results']]
+
+    def test_matches_in_the_name_rank_first(self):
+        response = self.client.get('/api/products/search/', {'q': 'galaxy'})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(self.ids(response), [self.galaxy.id, self.case.id])
+        self.assertNotIn('description', response.data['results'][0])
+
+    def test_every_word_matches_as_a_prefix(self):
+        self.assertEqual(self.ids(self.client.get('/api/products/search/', {'q': 'sams gal'})), [self.galaxy.id, self.case.id])
+        self.assertEqual(self.ids(self.client.get('/api/products/search/', {'q': 'pix andr'})), [self.pixel.id])
+        self.assertEqual(self.ids(self.client.get('/api/products/search/', {'q': 'galaxy android'})), [])
+        # Punctuation is not read as search syntax
+        self.assertEqual(self.ids(self.client.get('/api/products/search/', {'q': '"pixel" (*: -'})), [self.pixel.id])
+
+    def test_filters_and_pagination(self):
+        response = self.client.get('/api/products/search/', {'q': 'samsung', 'category': 'Accessories'})
+        self.assertEqual(self.ids(response), [self.case.id])
+        response = self.client.get('/api/products/search/', {'q': 'flagship', 'in_stock': 'false'})
+        self.assertEqual(self.ids(response), [self.pixel.id])
+        response = self.client.get('/api/products/search/', {'q': 'galaxy', 'limit': 1, 'page': 2})
+        self.assertEqual((response.data['count'], self.ids(response)), (2, [self.case.id]))
+
+    def test_index_follows_saves_and_deletes(self):
+        self.pixel.name = 'Nexus 8'
+        self.pixel.save()
+        self.assertEqual(self.ids(self.client.get('/api/products/search/', {'q': 'nexus'})), [self.pixel.id])
+        self.assertEqual(self.ids(self.client.get('/api/products/search/', {'q': 'pixel'})), [])
+        Product.objects.filter(pk=self.galaxy.pk).update(brand='Samsung Electronics')
+        self.assertEqual(SearchResults('electronics').count(), 1)
+        self.galaxy.delete()
+        self.assertEqual(self.ids(self.client.get('/api/products/search/', {'q': 'galaxy'})), [self.case.id])
+
+    def test_search_term_is_required(self):
+        response = self.client.get('/api/products/search/', {'q': '  '})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('q', response.data)
+        self.assertEqual(SearchResults('!!').count(), 0)
+
+    def test_fallback_backend_matches_the_same_products(self):
+        results = SearchResults('sams gal', search_backend=FallbackSearch())
+        self.assertEqual(results.count(), 2)
+        self.assertEqual(results[0:10], [self.galaxy, self.case])
+
+    def test_missing_triggers_are_recreated(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('The triggers only exist on SQLite')
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER core_product_fts_update')
+        self.case.name = 'Tablet sleeve'
+        self.case.save()
+        ensure_search_index()
+        self.assertEqual(SearchResults('sleeve')[0:10], [self.case])
+
+
+class ProductFacetsTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        make_product(name='Galaxy A15', brand='Samsung', category='Budget Phones', price=Decimal('180.00'),
+                     storage=[{'size': '64GB', 'in_stock': True}, {'size': '128GB', 'in_stock': False}],
+                     colors=[{'color': 'Black', 'in_stock': True}, {'color': 'Blue', 'in_stock': True}])
+        make_product(name='Redmi 13', brand='Xiaomi', category='Budget Phones', price=Decimal('149.99'),
+                     storage=[{'size': '128GB', 'in_stock': True}], colors=[{'color': 'Black', 'in_stock': True}])
+        make_product(name='Galaxy S24', brand='Samsung', category='Flagship Phones', price=Decimal('1099.00'),
+                     storage=[{'size': '256GB', 'in_stock': True}], colors=[], stock=0)
+        make_product(name='Buds', brand='Samsung', category='Wireless Earbuds', price=Decimal('49.00'),
+                     storage=None, colors=[{'color': 'White', 'in_stock': False}])
+
+    def test_counts_every_facet_in_one_query(self):
+        with self.assertNumQueries(2):  # the ETag lookup and the facets
+            response = self.client.get('/api/products/facets/')
+        data = response.data
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(data['category'][0], {'value': 'Budget Phones', 'count': 2})
+        self.assertEqual(data['brand'], [{'value': 'Samsung', 'count': 3}, {'value': 'Xiaomi', 'count': 1}])
+        self.assertEqual(data['price'], [
+            {'value': '0-50', 'count': 1}, {'value': '100-250', 'count': 2}, {'value': '1000+', 'count': 1},
+        ])
+        # Only the variants in stock count, the Galaxy S24 has none left
+        self.assertEqual(data['storage'], [{'value': '128GB', 'count': 1}, {'value': '64GB', 'count': 1}])
+        self.assertEqual(data['colors'], [{'value': 'Black', 'count': 2}, {'value': 'Blue', 'count': 1}])
+
+    def test_facets_follow_the_filters_and_search(self):
+        data = self.client.get('/api/products/facets/', {'in_stock': 'true', 'brand': 'Samsung'}).data
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['storage'], [{'value': '64GB', 'count': 1}])
+        data = self.client.get('/api/products/facets/', {'q': 'galaxy'}).data
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['category'], [{'value': 'Budget Phones', 'count': 1}, {'value': 'Flagship Phones', 'count': 1}])
+
+    def test_cached_until_a_product_changes(self):
+        self.client.get('/api/products/facets/')
+        with self.assertNumQueries(1):
+            self.client.get('/api/products/facets/')
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(name='Pixel 8a', brand='Google', category='Budget Phones', price=Decimal('499.00'))
+        self.assertEqual(self.client.get('/api/products/facets/').data['count'], 5)
+
+    def test_variant_filters(self):
+        data = self.client.get('/api/products/facets/', {'storage': '128GB'}).data
+        self.assertEqual((data['count'], data['brand']), (1, [{'value': 'Xiaomi', 'count': 1}]))
+        data = self.client.get('/api/products/facets/', {'storage': '64GB,128GB', 'color': 'Blue'}).data
+        self.assertEqual((data['count'], data['colors']), (1, [{'value': 'Black', 'count': 1}, {'value': 'Blue', 'count': 1}]))
+        response = self.client.get('/api/products/', {'storage': '256GB'})
+        self.assertEqual(response.data, [])
+
+
+class ProductVariantTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.phone = make_product(name='Galaxy A15', stock=5,
+                                  storage=[{'size': '64GB', 'in_stock': True}, {'size': '128GB', 'in_stock': False}],
+                                  colors=[{'color': 'Black', 'in_stock': True}, {'color': 'Blue', 'in_stock': True}])
+
+    def variants(self):
+        return dict(((variant.storage, variant.color), variant.stock) for variant in self.phone.variants.all())
+
+    def test_variants_follow_the_options(self):
+        self.assertEqual(self.variants(), {
+            ('64GB', 'Black'): 5, ('64GB', 'Blue'): 5, ('128GB', 'Black'): 0, ('128GB', 'Blue'): 0,
+        })
+        self.phone.colors = [{'color': 'Black', 'in_stock': False}]
+        self.phone.save()
+        self.assertEqual(self.variants(), {('64GB', 'Black'): 0, ('128GB', 'Black'): 0})
+        # Saves that leave the options alone do not touch the variants
+        ProductVariant.objects.filter(product=self.phone, storage='64GB').update(stock=3)
+        self.phone = Product.objects.get(pk=self.phone.pk)
+        self.phone.name = 'Galaxy A16'
+        self.phone.save()
+        self.assertEqual(self.variants()['64GB', 'Black'], 3)
+
+    def test_restocking_the_product_restocks_its_variants(self):
+        product = make_product(name='Galaxy A05', stock=0, colors=[{'color': 'Green', 'in_stock': True}])
+        self.assertEqual(self.client.get('/api/products/', {'color': 'Green'}).data, [])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f'/api/products/{product.id}/', {'stock': 50}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['name'] for item in self.client.get('/api/products/', {'color': 'Green'}).data], ['Galaxy A05'])
+        response = self.client.post('/api/orders/', order_payload([
+            {'product': product.id, 'quantity': 2, 'color': 'Green'},
+        ]), format='json')
+        self.assertEqual(response.status_code, 201)
+        # Unavailable options stay empty
+        self.phone.stock = 8
+        self.phone.save()
+        self.assertEqual(self.variants(), {
+            ('64GB', 'Black'): 8, ('64GB', 'Blue'): 8, ('128GB', 'Black'): 0, ('128GB', 'Blue'): 0,
+        })
+
+    def test_options_keep_their_json_shape(self):
+        ProductVariant.objects.filter(product=self.phone, color='Blue').update(stock=0)
+        data = self.client.get(f'/api/products/{self.phone.id}/').data
+        self.assertEqual(data['storage'], [{'size': '64GB', 'in_stock': True}, {'size': '128GB', 'in_stock': False}])
+        self.assertEqual(data['colors'], [{'color': 'Black', 'in_stock': True}, {'color': 'Blue', 'in_stock': False}])
+        self.assertEqual(len(data['variants']), 4)
+        with self.assertNumQueries(3):  # the ETag lookup, the products and their variants
+            self.client.get('/api/products/')
+
+    def test_cart_and_order_lines_reference_their_variant(self):
+        variant = ProductVariant.objects.get(product=self.phone, storage='64GB', color='Blue')
+        variant.price_delta = Decimal('20.00')
+        variant.save()
+        response = self.client.post('/api/cart-item/', {'productId': self.phone.id, 'size': '64GB', 'color': 'Blue'},
+                                    format='json')
+        self.assertEqual(response.data['items'][0]['variant'], variant.id)
+        self.assertEqual(response.data['total_price'], Decimal('120.00'))
+
+        response = self.client.post('/api/orders/', order_payload([
+            {'product': self.phone.id, 'quantity': 2, 'size': '64GB', 'color': 'Blue'},
+        ]), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['items'][0]['variant'], response.data['total_price']), (variant.id, Decimal('240.00')))
+        variant.refresh_from_db()
+        self.assertEqual(variant.stock, 3)
+
+    def test_sold_out_variant_rejects_the_order(self):
+        response = self.client.post('/api/orders/', order_payload([
+            {'product': self.phone.id, 'quantity': 1, 'size': '128GB', 'color': 'Black'},
+        ]), format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('128GB / Black', response.data['detail'])
+        # Nothing was reserved
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.stock, 5)
+
+    def test_options_to_variants(self):
+        self.assertEqual(options_to_variants(None, []), {})
+        self.assertEqual(options_to_variants([], [{'color': 'Red', 'in_stock': True}]), {('', 'Red'): True})
+        self.assertEqual(options_to_variants([{'size': '1TB', 'in_stock': False}], None), {('1TB', ''): False})
+
+
+def make_image(width=800, height=600, name='phone.png', color=(200, 30, 30)):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(output, 'PNG')
+    return SimpleUploadedFile(name, output.getvalue(), content_type='image/png')
+
+
+class ProductImageTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings = override_settings(MEDIA_ROOT=self.media_root, PRODUCT_IMAGE_WIDTHS=[160, 320, 640, 1280])
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_uploads_get_renditions_named_after_their_content(self):
+        product = make_product(image=make_image())
+        renditions = product.image_renditions
+        self.assertEqual((renditions['width'], renditions['height']), (800, 600))
+        self.assertTrue(renditions['placeholder'].startswith('data:image/webp;base64,'))
+        self.assertEqual(list(renditions['formats']), output_formats())
+        # Never upscaled
+        self.assertEqual(list(renditions['formats']['webp']), ['160', '320', '640'])
+        path = renditions['formats']['webp']['320']
+        self.assertRegex(path, r'^product_images/renditions/[0-9a-f]{16}-320\.webp$')
+        with Image.open(os.path.join(self.media_root, path)) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (320, 240)))
+        # The same picture uploaded again reuses the files
+        self.assertEqual(make_product(image=make_image(name='copy.png')).image_renditions, renditions)
+
+    def test_a_new_image_replaces_the_renditions(self):
+        product = make_product(image=make_image())
+        old_hash = product.image_renditions['hash']
+        product.name = 'Renamed'
+        product.save()
+        self.assertEqual(product.image_renditions['hash'], old_hash)
+        product.image = make_image(100, 100, color=(0, 0, 255))
+        product.save()
+        product.refresh_from_db()
+        self.assertNotEqual(product.image_renditions['hash'], old_hash)
+        self.assertEqual(list(product.image_renditions['formats']['webp']), ['100'])
+
+    def test_serializers_expose_the_srcset(self):
+        product = make_product(image=make_image())
+        data = self.client.get('/api/products/', {'limit': 10}).data['results'][0]
+        srcset = data['image_srcset']
+        self.assertTrue(srcset['webp'].startswith('http://testserver/media/product_images/renditions/'))
+        self.assertTrue(srcset['webp'].endswith(' 640w'))
+        self.assertEqual(srcset['webp'].count('w, '), 2)
+        self.assertNotIn('image_renditions', self.client.get(f'/api/products/{product.id}/').data)
+        response = self.client.post('/api/orders/', order_payload([{'product': product.id, 'quantity': 1}]), format='json')
+        self.assertEqual(response.data['items'][0]['product_image_srcset']['placeholder'], product.image_renditions['placeholder'])
+        self.assertIsNone(self.client.get(f'/api/products/{make_product().id}/').data['image_srcset'])
+
+    def test_backfill_command(self):
+        products = [make_product(name=f'Phone {index}', image=make_image(color=(index, 0, 0))) for index in range(3)]
+        Product.objects.update(image_renditions={})
+        out = io.StringIO()
+        call_command('generate_image_renditions', workers=2, batch_size=2, stdout=out)
+        self.assertIn('3 images processed', out.getvalue())
+        for product in products:
+            product.refresh_from_db()
+            self.assertEqual(list(product.image_renditions['formats']['webp']), ['160', '320', '640'])
+        call_command('generate_image_renditions', stdout=out)
+        self.assertIn('No images to process', out.getvalue())
+
+
+class CatalogImportExportTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def path(self, name, content=None):
+        path = os.path.join(self.directory, name)
+        if content is not None:
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(content)
+        return path
+
+    def test_export_and_import_round_trip(self):
+        storage = [{'size': '128GB', 'in_stock': True}, {'size': '256GB', 'in_stock': False}]
+        colors = [{'color': 'Black', 'in_stock': True}]
+        phone = make_product(name='Pixel', price=Decimal('499.50'), storage=storage, colors=colors)
+        case = make_product(name='Case', category='Phone Cases')
+        for name in ['products.csv', 'products.jsonl']:
+            call_command('catalog_export', self.path(name), chunk_size=1, stdout=io.StringIO())
+            Product.objects.all().delete()
+            out = io.StringIO()
+            call_command('catalog_import', self.path(name), batch_size=1, stdout=out, stderr=io.StringIO())
+            self.assertIn('2 products imported', out.getvalue())
+            imported = Product.objects.get(pk=phone.pk)
+            self.assertEqual((imported.name, imported.price, imported.storage, imported.colors),
+                             ('Pixel', Decimal('499.50'), storage, colors))
+            self.assertEqual(Product.objects.get(pk=case.pk).category, 'Phone Cases')
+            self.assertEqual(
+                set(imported.variants.values_list('storage', 'color', 'stock')),
+                {('128GB', 'Black', 10), ('256GB', 'Black', 0)},
+            )
+
+    def test_import_upserts_and_skips_invalid_rows(self):
+        phone = make_product(name='Pixel', storage=[{'size': '128GB', 'in_stock': True}])
+        rows = [
+            {'id': phone.pk, 'name': 'Pixel 9', 'brand': 'Google', 'description': 'New', 'price': '599',
+             'stock': 3, 'category': 'Flagship Phones', 'storage': [{'size': '256GB', 'in_stock': True}]},
+            {'name': 'Buds', 'brand': 'Acme', 'description': 'Earbuds', 'price': '49.99', 'stock': 5,
+             'category': 'Wireless Earbuds'},
+            {'name': 'Bad', 'brand': 'Acme', 'description': 'x', 'price': 'free', 'stock': -1, 'category': 'Toys'},
+            {'name': 'Bad options', 'brand': 'Acme', 'description': 'x', 'price': '1', 'stock': 1,
+             'category': 'Tablets', 'colors': [{'color': 'Pink', 'in_stock': True}]},
+        ]
+        content = '\n'.join(json.dumps(row) for row in rows) + '\nnot json\n'
+        out, err = io.StringIO(), io.StringIO()
+        # One chunk: the existing images, the upsert and the variant sync, whatever the number of rows
+        with self.assertNumQueries(11):
+            call_command('catalog_import', self.path('products.jsonl', content), stdout=out, stderr=err)
+        self.assertIn('2 products imported', out.getvalue())
+        self.assertIn('3 invalid rows skipped', out.getvalue())
+        self.assertIn('row 3: price:', err.getvalue())
+        self.assertIn("row 4: colors: Invalid color: 'Pink'", err.getvalue())
+        self.assertIn('row 5: Not a JSON object.', err.getvalue())
+
+        phone.refresh_from_db()
+        self.assertEqual((phone.name, phone.price, phone.stock), ('Pixel 9', Decimal('599'), 3))
+        self.assertEqual(list(phone.variants.values_list('storage', flat=True)), ['256GB'])
+        self.assertEqual(Product.objects.get(name='Buds').price, Decimal('49.99'))
+        # New products keep getting ids after the imported ones
+        self.assertGreater(make_product().pk, Product.objects.get(name='Buds').pk)
+
+    def test_invalid_arguments(self):
+        content = self.path('products.jsonl', '')
+        for command, path, options in [
+            ('catalog_import', content, {'batch_size': 0}),
+            ('catalog_import', self.path('missing.jsonl'), {}),
+            ('catalog_export', self.path('products.csv'), {'chunk_size': -1}),
+            ('catalog_export', self.path('missing/products.csv'), {}),
+        ]:
+            with self.subTest(command=command, options=options), self.assertRaises(CommandError):
+                call_command(command, path, stdout=io.StringIO(), **options)
+
+
+class UpdateProductFieldsTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.phones = [make_product(name=f'Phone {index}', brand='Acme', price=Decimal('100.00')) for index in range(5)]
+        self.case = make_product(name='Case', brand='Acme', category='Phone Cases', price=Decimal('10.00'))
+        self.other = make_product(name='Other', brand='Zeta', price=Decimal('100.00'))
+
+    def update(self, *args, **options):
+        out = io.StringIO()
+        call_command('update_product_fields', *args, stdout=out, **options)
+        return out.getvalue()
+
+    def test_updates_the_selection_in_batches(self):
+        storage = '[{"size": "128GB", "in_stock": true}, {"size": "1TB", "in_stock": false}]'
+        # The count, then per batch of 2 in a savepoint: the ids, the update, the products and variants
+        # for the sync and the variants insert, and the empty last batch
+        with self.assertNumQueries(1 + 3 * 7 + 1):
+            out = self.update(category='Budget Phones', brand='Acme', storage=storage, stock=4, batch_size=2)
+        self.assertIn('Updated 5 products', out)
+        self.assertIn('5/5', out)
+        for phone in self.phones:
+            phone.refresh_from_db()
+            self.assertEqual(phone.stock, 4)
+            self.assertEqual(phone.storage, json.loads(storage))
+            self.assertEqual(set(phone.variants.values_list('storage', 'stock')), {('128GB', 4), ('1TB', 0)})
+        self.assertEqual(Product.objects.get(pk=self.other.pk).stock, 10)
+        self.assertEqual(Product.objects.get(pk=self.case.pk).storage, [])
+
+    def test_price_changes_and_filter_expression(self):
+        Product.objects.filter(pk=self.phones[0].pk).update(stock=0)
+        self.update(filter='brand=Acme&in_stock=true&min_price=50', price_percent='-15')
+        prices = dict(Product.objects.values_list('name', 'price'))
+        self.assertEqual(prices['Phone 0'], Decimal('100.00'))
+        self.assertEqual(prices['Phone 1'], Decimal('85.00'))
+        self.assertEqual((prices['Case'], prices['Other']), (Decimal('10.00'), Decimal('100.00')))
+        # Rows leaving the selection once updated do not make the next batches skip others
+        self.update(filter='in_stock=true', stock=0, batch_size=2)
+        self.assertFalse(Product.objects.filter(stock__gt=0).exists())
+
+    def test_restock_updates_the_variants(self):
+        sold_out = make_product(name='Sold Out', brand='Acme', stock=0, colors=[{'color': 'Black', 'in_stock': True}])
+        self.update(filter='in_stock=false', stock=10)
+        self.assertEqual(list(sold_out.variants.values_list('color', 'stock')), [('Black', 10)])
+        self.assertEqual(Product.objects.get(pk=self.other.pk).stock, 10)
+
+    def test_dry_run_and_invalid_arguments(self):
+        with self.assertNumQueries(1):
+            self.assertIn('Would update 7 products', self.update(price='5', dry_run=True))
+        self.assertFalse(Product.objects.filter(price=5).exists())
+        for options in [{}, {'colors': '[{"color": "Pink", "in_stock": true}]'}, {'stock': -1},
+                        {'price': 'x'}, {'price': '1', 'price_percent': '5'}, {'filter': 'ordering=size', 'stock': 1},
+                        {'batch_size': 0, 'stock': 1}]:
+            with self.assertRaises(CommandError):
+                self.update(**options)
+
+
+class OrderExportTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.staff = CustomUser.objects.create_user('finance', 'finance@example.com', 'password', is_staff=True)
+        self.buyer = CustomUser.objects.create_user('buyer', 'buyer@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+        self.phone = make_product(name='Phone, "Pro"', price=Decimal('300.00'))
+        self.case = make_product(name='Case', price=Decimal('15.50'))
+        self.orders = []
+        for day, status in [(1, 'Order placed'), (2, 'Shipped'), (3, 'Order placed')]:
+            order = Order.objects.create(user=self.buyer, shipping_address='x', billing_address='x',
+                                         payment_method='paypal', status=status, total=Decimal('331.00'))
+            OrderItem.objects.create(order=order, product=self.phone, quantity=1, unit_price=Decimal('300.00'))
+            OrderItem.objects.create(order=order, product=self.case, quantity=2, unit_price=Decimal('15.50'), color='Black')
+            Order.objects.filter(pk=order.pk).update(placed_at=f'2025-01-0{day}T12:00:00Z')
+            self.orders.append(order)
+
+    def export(self, query=''):
+        response = self.client.get(f'/api/orders/export/{query}')
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_orders_as_csv(self):
+        response, content = self.export('?placed_after=2025-01-02')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('attachment; filename="orders-', response['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0], ['order_id', 'placed_at', 'status', 'user_id', 'email', 'payment_method', 'total'])
+        self.assertEqual([row[0] for row in rows[1:]], [str(order.pk) for order in self.orders[1:]])
+        self.assertEqual(rows[1][1:], ['2025-01-02T12:00:00+00:00', 'Shipped', str(self.buyer.pk),
+                                       'buyer@example.com', 'paypal', '331.00'])
+
+    def test_order_lines_as_jsonl_in_one_query(self):
+        with self.assertNumQueries(1):
+            response, content = self.export('?lines=true&output=jsonl&status=Order placed&placed_before=2025-01-03')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        lines = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([line['order_id'] for line in lines], [self.orders[0].pk] * 2)
+        self.assertEqual(lines[0]['product'], 'Phone, "Pro"')
+        self.assertEqual((lines[1]['quantity'], lines[1]['unit_price'], lines[1]['total'], lines[1]['color']),
+                         (2, '15.50', '31.00', 'Black'))
+        self.assertEqual(lines[1]['order_status'], 'Order placed')
+
+    def test_staff_only_and_invalid_parameters(self):
+        self.assertEqual(self.client.get('/api/orders/export/?placed_after=yesterday').status_code, 400)
+        self.assertEqual(self.client.get('/api/orders/export/?output=xml').status_code, 400)
+        self.client.force_authenticate(self.buyer)
+        self.assertEqual(self.client.get('/api/orders/export/').status_code, 403)
+
+    def test_command(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'lines.csv')
+        out = io.StringIO()
+        call_command('orders_export', path, lines=True, chunk_size=2, placed_after='2025-01-02', stdout=out)
+        self.assertIn('4 order lines exported', out.getvalue())
+        with open(path, newline='') as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual([row['total'] for row in rows], ['300.00', '31.00'] * 2)
+        with self.assertRaises(CommandError):
+            call_command('orders_export', path, placed_before='soon', stdout=out)
+
+
+class SalesAnalyticsTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.staff = CustomUser.objects.create_user('finance', 'finance@example.com', 'password', is_staff=True)
+        self.buyer = CustomUser.objects.create_user('buyer', 'buyer@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+        self.phone = make_product(name='Phone', brand='Acme', category='Flagship Phones')
+        self.case = make_product(name='Case', brand='Zeta', category='Phone Cases')
+        self.place('2025-01-01T10:00:00Z', [(self.phone, 1, '300.00'), (self.case, 2, '15.50')])
+        self.place('2025-01-02T09:00:00Z', [(self.phone, 2, '280.00')])
+
+    def place(self, placed_at, lines):
+        order = Order.objects.create(user=self.buyer, shipping_address='x', billing_address='x', payment_method='paypal')
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=quantity, unit_price=Decimal(price))
+            for product, quantity, price in lines
+        ])
+        Order.objects.filter(pk=order.pk).update(placed_at=placed_at)
+
+    def sales(self, model, **filters):
+        return list(model.objects.filter(**filters).order_by('day').values_list('day', 'revenue', 'units', 'orders'))
+
+    def test_refresh_counts_the_orders_since_the_watermark(self):
+        self.assertEqual(refresh_sales(until=parse_datetime('2025-01-02T12:00:00Z'))[2], 11)
+        self.assertEqual(self.sales(DailySales), [
+            (date(2025, 1, 1), Decimal('331.00'), 3, 1),
+            (date(2025, 1, 2), Decimal('560.00'), 2, 1),
+        ])
+        self.assertEqual(self.sales(DailyCategorySales, category='Phone Cases'), [(date(2025, 1, 1), Decimal('31.00'), 2, 1)])
+        self.assertEqual(self.sales(DailyBrandSales, brand='Acme', day=date(2025, 1, 2)), [(date(2025, 1, 2), Decimal('560.00'), 2, 1)])
+        self.assertEqual(DailyProductSales.objects.get(product=self.case).category, 'Phone Cases')
+
+        # Only the days from the watermark on are recomputed, in a fixed number of queries
+        self.place('2025-01-02T15:00:00Z', [(self.case, 1, '15.50'), (self.phone, 1, '280.00')])
+        self.place('2025-01-03T08:00:00Z', [(self.case, 4, '15.00')])
+        with self.assertNumQueries(18):
+            first, last, _ = refresh_sales(until=parse_datetime('2025-01-03T12:00:00Z'))
+        self.assertEqual((first, last), (date(2025, 1, 2), date(2025, 1, 3)))
+        self.assertEqual(self.sales(DailySales, day__gte=date(2025, 1, 2)), [
+            (date(2025, 1, 2), Decimal('855.50'), 4, 2),
+            (date(2025, 1, 3), Decimal('60.00'), 4, 1),
+        ])
+        self.assertIsNone(refresh_sales(until=parse_datetime('2025-01-03T11:00:00Z')))
+
+        # Orders added before the watermark need a rebuild from their day
+        self.place('2025-01-01T20:00:00Z', [(self.phone, 1, '300.00')])
+        refresh_sales(until=parse_datetime('2025-01-03T13:00:00Z'))
+        self.assertEqual(self.sales(DailySales, day=date(2025, 1, 1))[0][3], 1)
+        rebuild_sales(since=date(2025, 1, 1), until=parse_datetime('2025-01-03T14:00:00Z'), chunk_days=1)
+        self.assertEqual(self.sales(DailySales, day=date(2025, 1, 1))[0][1:], (Decimal('631.00'), 4, 2))
+        self.assertEqual(SalesWatermark.objects.get().placed_at, parse_datetime('2025-01-03T14:00:00Z'))
+
+    def test_failed_full_rebuild_keeps_the_rollups(self):
+        refresh_sales(until=parse_datetime('2025-01-03T00:00:00Z'))
+        before = self.sales(DailySales)
+        with mock.patch('core.analytics.refresh_days', side_effect=RuntimeError('interrupted')), \
+                self.assertRaises(RuntimeError):
+            rebuild_sales(until=parse_datetime('2025-01-04T00:00:00Z'))
+        self.assertEqual(self.sales(DailySales), before)
+        self.assertEqual(DailyProductSales.objects.count(), 3)
+        self.assertEqual(SalesWatermark.objects.get().placed_at, parse_datetime('2025-01-03T00:00:00Z'))
+
+    def test_dashboard_api(self):
+        refresh_sales(until=parse_datetime('2025-01-03T00:00:00Z'))
+        params = {'start': '2025-01-01', 'end': '2025-01-31'}
+        with self.assertNumQueries(3):
+            data = self.client.get('/api/analytics/sales/', {**params, 'by': 'category'}).data
+        self.assertEqual(data['totals'], {'revenue': '891.00', 'units': 5, 'orders': 2})
+        self.assertEqual(data['results'], [
+            {'category': 'Flagship Phones', 'revenue': '860.00', 'units': 3, 'orders': 2},
+            {'category': 'Phone Cases', 'revenue': '31.00', 'units': 2, 'orders': 1},
+        ])
+        self.assertEqual(data['refreshed_until'], parse_datetime('2025-01-03T00:00:00Z'))
+        # Served from the cache until the next refresh
+        with self.assertNumQueries(0):
+            self.client.get('/api/analytics/sales/', {**params, 'by': 'category'})
+
+        products = self.client.get('/api/analytics/sales/', {**params, 'by': 'product', 'limit': 1}).data['results']
+        self.assertEqual(products, [{'product_id': self.phone.pk, 'name': 'Phone', 'category': 'Flagship Phones',
+                                     'brand': 'Acme', 'revenue': '860.00', 'units': 3, 'orders': 2}])
+        days = self.client.get('/api/analytics/sales/', params).data['results']
+        self.assertEqual([(day['day'], day['revenue']) for day in days],
+                         [(date(2025, 1, 1), '331.00'), (date(2025, 1, 2), '560.00')])
+
+        for query in [{'by': 'color'}, {'start': 'soon'}, {'start': '2025-02-01', 'end': '2025-01-01'}, {'limit': 'x'}]:
+            self.assertEqual(self.client.get('/api/analytics/sales/', query).status_code, 400)
+        self.client.force_authenticate(self.buyer)
+        self.assertEqual(self.client.get('/api/analytics/sales/').status_code, 403)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('refresh_sales_rollups', stdout=out)
+        self.assertIn('2025-01-01 to 2025-01-31: 11 rows', out.getvalue())
+        self.assertEqual(DailySales.objects.count(), 2)
+        call_command('refresh_sales_rollups', stdout=out)
+        call_command('refresh_sales_rollups', since='2025-01-02', stdout=out)
+        self.assertEqual(DailySales.objects.count(), 2)
+        with self.assertRaises(CommandError):
+            call_command('refresh_sales_rollups', since='yesterday', stdout=out)
+
+
+class CartMutationTest(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = make_product()
+
+    def add(self, **extra):
+        return self.client.post('/api/cart-item/', {'productId': self.product.id, **extra}, format='json')
+
+    def test_adding_same_variant_increments_quantity(self):
+        self.add()
+        self.add(color='')
+        self.add(color='Black', size='128GB')
+        response = self.add(color='Black', size='128GB')
+        quantities = sorted((item['color'] or '', item['quantity']) for item in response.data['items'])
+        self.assertEqual(quantities, [('', 2), ('Black', 2)])
+
+    def test_decrement_deletes_item_at_zero(self):
+        self.add()
+        item = CartItem.objects.get()
+        self.client.patch(f'/api/cart-item/{item.id}/', {'action': 'increment'}, format='json')
+        self.client.patch(f'/api/cart-item/{item.id}/', {'action': 'decrement'}, format='json')
+        item.refresh_from_db()
+        self.assertEqual(item.quantity, 1)
+        response = self.client.patch(f'/api/cart-item/{item.id}/', {'action': 'decrement'}, format='json')
+        self.assertEqual(response.data['items'], [])
+
+    def test_items_of_other_users_cannot_be_changed(self):
+        other = CustomUser.objects.create_user('other', 'other@example.com', 'password')
+        item = CartItem.objects.create(cart=Cart.objects.create(user=other), product=self.product)
+        response = self.client.patch(f'/api/cart-item/{item.id}/', {'action': 'increment'}, format='json')
+        self.assertEqual(response.status_code, 404)
+        item.refresh_from_db()
+        self.assertEqual(item.quantity, 1)
+
+    def test_invalid_product_is_rejected(self):
+        self.assertEqual(self.client.post('/api/cart-item/', {'productId': 999}, format='json').status_code, 400)
+        self.assertEqual(self.client.post('/api/cart-item/', {}, format='json').status_code, 400)
+
+
+class ConcurrentCartUpdateTest(TransactionTestCase):
+    # Concurrent taps on the same cart item must all be counted
+
+    def run_in_threads(self, func, count):
+        barrier = threading.Barrier(count)
+
+        def run(index):
+            barrier.wait()
+            try:
+                return func(index)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=count) as pool:
+            return list(pool.map(run, range(count)))
+
+    def test_parallel_cart_item_updates_are_not_lost(self):
+        user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        product = make_product()
+        Cart.objects.create(user=user)
+
+        def add(index):
+            client = APIClient()
+            client.force_authenticate(user)
+            return client.post('/api/cart-item/', {'productId': product.id, 'color': 'Black'}, format='json').status_code
+
+        self.assertEqual(self.run_in_threads(add, 10), [200] * 10)
+        item = CartItem.objects.get()
+        self.assertEqual(item.quantity, 10)
+
+        def increment(index):
+            client = APIClient()
+            client.force_authenticate(user)
+            return client.patch(f'/api/cart-item/{item.id}/', {'action': 'increment'}, format='json').status_code
+
+        self.assertEqual(self.run_in_threads(increment, 10), [200] * 10)
+        item.refresh_from_db()
+        self.assertEqual(item.quantity, 20)
+
+        def decrement(index):
+            client = APIClient()
+            client.force_authenticate(user)
+            return client.patch(f'/api/cart-item/{item.id}/', {'action': 'decrement'}, format='json').status_code
+
+        self.assertEqual(self.run_in_threads(decrement, 18), [200] * 18)
+        item.refresh_from_db()
+        self.assertEqual(item.quantity, 2)
+        # The last units go together with the item
+        self.assertEqual(self.run_in_threads(decrement, 2), [200] * 2)
+        self.assertFalse(CartItem.objects.exists())
+
+
+class CartBatchTest(TestCase):
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.phone = make_product(name='Phone', price=Decimal('300.00'))
+        self.case = make_product(name='Case', price=Decimal('20.00'))
+
+    def batch(self, operations, **params):
+        url = '/api/cart/batch/' + ('?return=delta' if params.get('delta') else '')
+        return self.client.post(url, {'operations': operations}, format='json')
+
+    def test_operations_are_applied_in_order(self):
+        response = self.batch([
+            {'op': 'add', 'product': self.phone.id, 'color': 'Black', 'size': '128GB'},
+            {'op': 'add', 'product': self.phone.id, 'color': 'Black', 'size': '128GB', 'quantity': 2},
+            {'op': 'add', 'product': self.case.id, 'quantity': 5},
+            {'op': 'set', 'product': self.case.id, 'quantity': 2},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_price'], Decimal('940.00'))
+        response = self.batch([
+            {'op': 'remove', 'product': self.phone.id, 'color': 'Black', 'size': '128GB'},
+            {'op': 'set', 'product': self.case.id, 'quantity': 0},
+        ])
+        self.assertEqual(response.data['items'], [])
+
+    def test_delta_returns_changed_lines_and_total(self):
+        CartItem.objects.create(cart=Cart.objects.create(user=self.user), product=self.case, quantity=1)
+        response = self.batch([
+            {'op': 'set', 'product': self.phone.id, 'quantity': 2},
+            {'op': 'remove', 'product': self.case.id},
+        ], delta=True)
+        self.assertEqual([item['product_id'] for item in response.data['items']], [self.phone.id])
+        self.assertEqual(response.data['removed'], [{'product_id': self.case.id, 'color': None, 'size': None}])
+        self.assertEqual(response.data['total_price'], Decimal('600.00'))
+
+    def test_invalid_batch_changes_nothing(self):
+        response = self.batch([
+            {'op': 'add', 'product': self.phone.id},
+            {'op': 'add', 'product': 999},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(self.batch([{'op': 'set', 'product': self.phone.id}]).status_code, 400)
+        self.assertEqual(self.batch([{'op': 'explode', 'product': self.phone.id}]).status_code, 400)
+
+
+class ConditionalGetTest(TestCase):
+    # Polling an unchanged resource returns 304 without serializing it
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = make_product()
+
+    def assertRevalidates(self, url, change):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        change()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_products(self):
+        def change():
+            self.product.price = Decimal('1.00')
+            self.product.save()
+        self.assertRevalidates('/api/products/', change)
+        self.assertRevalidates(f'/api/products/{self.product.id}/', change)
+        # Deleting an older product does not move the latest update
+        older = make_product(name='Older')
+        Product.objects.filter(pk=older.pk).update(updated_at=self.product.updated_at.replace(year=2000))
+        self.assertRevalidates('/api/products/', lambda: older.delete())
+        self.assertEqual(self.client.get('/api/products/abc/').status_code, 404)
+
+    def test_cart(self):
+        self.client.post('/api/cart-item/', {'productId': self.product.id}, format='json')
+        item = CartItem.objects.get()
+        self.assertRevalidates('/api/cart/me/', lambda: self.client.patch(
+            f'/api/cart-item/{item.id}/', {'action': 'increment'}, format='json'
+        ))
+        # A price change changes the cart total
+        self.assertRevalidates('/api/cart/me/', lambda: Product.objects.filter(pk=self.product.pk).update(
+            price=Decimal('5.00'), updated_at=self.product.updated_at.replace(year=2100)
+        ))
+
+    def test_profile(self):
+        self.client.get('/api/user-profile/me/')
+        profile = UserProfile.objects.get()
+
+        def change():
+            profile.phone_number = '555'
+            profile.save()
+        self.assertRevalidates('/api/user-profile/me/', change)
+
+    def test_orders(self):
+        payload = order_payload([{'product': self.product.id, 'quantity': 1}])
+        self.client.post('/api/orders/', payload, format='json')
+        self.assertRevalidates('/api/orders/me/', lambda: self.client.post('/api/orders/', payload, format='json'))
+        item = OrderItem.objects.first()
+
+        def change():
+            item.status = 'Shipped'
+            item.save()
+        self.assertRevalidates('/api/orders/me/', change)
+
+
+class LocalCacheTest(SimpleTestCase):
+
+    def test_least_recently_used_entries_are_evicted(self):
+        local = LocalCache(max_entries=2)
+        local.set('a', 1, 60)
+        local.set('b', 2, 60)
+        local.get('a')
+        self.assertEqual(local.set('c', 3, 60), 1)
+        self.assertEqual((local.get('a'), local.get('b'), local.get('c')), (1, None, 3))
+
+    def test_entries_expire(self):
+        local = LocalCache()
+        local.set('a', 1, -1)
+        self.assertIsNone(local.get('a'))
+        self.assertEqual(len(local), 0)
+
+
+class ResponseCacheTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = make_product(stock=5)
+
+    def test_local_tier_serves_repeated_reads(self):
+        url = f'/api/products/{self.product.id}/'
+        self.client.get(url)
+        cache.clear()
+        # The shared cache lost the entry and the version, the local copy
+        # is stored under the old version and must not be served
+        with self.assertNumQueries(3):  # the ETag lookup, the product and its variants
+            self.client.get(url)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data['id'], self.product.id)
+
+    def test_order_history_is_cached_until_an_order_changes(self):
+        payload = order_payload([{'product': self.product.id, 'quantity': 1}])
+        self.client.post('/api/orders/', payload, format='json')
+        self.client.get('/api/orders/me/')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/orders/me/')
+        self.assertEqual(len(response.data['results']), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/orders/', payload, format='json')
+        self.assertEqual(len(self.client.get('/api/orders/me/').data['results']), 2)
+
+    def test_order_history_follows_its_products(self):
+        self.client.post('/api/orders/', order_payload([{'product': self.product.id, 'quantity': 1}]), format='json')
+        self.client.get('/api/orders/me/')
+        # A product change moves the ETag of the order history without invalidating its namespace
+        self.product.name = 'Renamed Phone'
+        self.product.save()
+        response = self.client.get('/api/orders/me/')
+        self.assertEqual(response.data['results'][0]['items'][0]['product_name'], 'Renamed Phone')
+        response = self.client.get('/api/orders/me/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_invalidated_once_the_change_is_committed(self):
+        version = get_namespace_version('catalog')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Renamed'
+            self.product.save()
+            self.assertEqual(get_namespace_version('catalog'), version)
+        self.assertNotEqual(get_namespace_version('catalog'), version)
+
+    def test_placing_an_order_refreshes_cached_stock(self):
+        self.client.get(f'/api/products/{self.product.id}/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/orders/', order_payload([{'product': self.product.id, 'quantity': 2}]), format='json')
+        self.assertEqual(self.client.get(f'/api/products/{self.product.id}/').data['stock'], 3)
+
+    def test_stats_are_staff_only(self):
+        self.assertEqual(self.client.get('/api/cache/stats/').status_code, 403)
+        self.client.get('/api/products/')
+        self.client.get('/api/products/')
+        self.user.is_staff = True
+        self.user.save()
+        stats = self.client.get('/api/cache/stats/').data
+        self.assertEqual(stats['policies']['products-list']['sets'], 1)
+        self.assertEqual(stats['policies']['products-list']['local_hits'], 1)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(TransactionTestCase):
+
+    # A second SQLite file stands in for the replica. Nothing replicates to it,
+    # so where a row can be read from tells which database served the read.
+    # The alias only exists while the class runs, so it is added to databases here
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.settings['replica'] = {
+            **connections['default'].settings_dict,
+            'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3'),
+        }
+        call_command('migrate', database='replica', verbosity=0)
+        cls.databases = {'default', 'replica'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        shutil.rmtree(cls.replica_dir)
+
+    def setUp(self):
+        clear_caches()
+        _lag_checks.clear()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def product_names(self):
+        return [product['name'] for product in self.client.get('/api/products/').data]
+
+    def test_reads_go_to_the_replica(self):
+        make_product(name='Primary Phone')
+        Product.objects.using('replica').create(name='Replica Phone', brand='Acme', price=Decimal('100.00'), stock=10)
+        # As if the replica had caught up with the new product
+        clear_caches()
+        self.assertEqual(self.product_names(), ['Replica Phone'])
+
+    def test_writes_pin_the_user_to_the_primary(self):
+        product = make_product()
+        self.assertEqual(self.client.post('/api/cart-item/', {'productId': product.id}, format='json').status_code, 200)
+        response = self.client.get('/api/cart/me/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['items']), 1)
+        # Once the pin expires the cart is read from the replica, which never got it
+        cache.delete(pin_key(self.user.pk))
+        self.assertEqual(self.client.get('/api/cart/me/').status_code, 404)
+
+    def test_lagging_or_unreachable_replica_falls_back_to_the_primary(self):
+        make_product(name='Primary Phone')
+        for lag in (60.0, None):
+            clear_caches()
+            with mock.patch('core.db_routers.replica_lag', return_value=lag):
+                self.assertEqual(self.product_names(), ['Primary Phone'])
+
+    def test_responses_are_built_on_the_primary_after_a_change(self):
+        make_product(name='Primary Phone')
+        Product.objects.using('replica').create(name='Replica Phone', brand='Acme', price=Decimal('100.00'), stock=10)
+        # As if the replica had caught up with the new product
+        clear_caches()
+        self.assertEqual(self.product_names(), ['Replica Phone'])
+        # The replica may not have the change yet, the new version is cached from the primary
+        invalidate_namespace('catalog')
+        self.assertEqual(self.product_names(), ['Primary Phone'])
+        self.assertEqual(self.product_names(), ['Primary Phone'])
+
+    def test_search_and_facets_read_the_replica(self):
+        make_product(name='Primary Phone', brand='Primary')
+        Product.objects.using('replica').create(name='Replica Phone', brand='Acme', price=Decimal('100.00'), stock=10)
+        clear_caches()
+        response = self.client.get('/api/products/search/', {'q': 'phone'})
+        self.assertEqual([product['name'] for product in response.data['results']], ['Replica Phone'])
+        response = self.client.get('/api/products/facets/')
+        self.assertEqual(response.data['brand'], [{'value': 'Acme', 'count': 1}])
+
+    def test_session_authenticated_reads(self):
+        make_product(name='Primary Phone')
+        Product.objects.using('replica').create(name='Replica Phone', brand='Acme', price=Decimal('100.00'), stock=10)
+        # As if the replica had caught up with the new product
+        clear_caches()
+        client = APIClient()
+        client.force_login(self.user)
+        # The session and the user are looked up on the primary, the replica has neither
+        response = client.get('/api/products/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([product['name'] for product in response.data], ['Replica Phone'])
+
+    def test_reads_in_a_transaction_use_the_primary(self):
+        request = RequestFactory().get('/api/products/')
+        request.user = AnonymousUser()
+        router = PrimaryReplicaRouter()
+        token = current_request.set(request)
+        try:
+            self.assertEqual(router.db_for_read(Product), 'replica')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Product), 'default')
+        finally:
+            current_request.reset(token)
+        # Outside of a request, e.g. in management commands
+        self.assertEqual(router.db_for_read(Product), 'default')
+
+
+class AsyncViewsTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = make_product()
+        make_product(name='Other Phone', brand='Other')
+        self.client.post('/api/cart-item/', {'productId': self.product.id}, format='json')
+        self.client.post('/api/orders/', order_payload([{'product': self.product.id, 'quantity': 1}]), format='json')
+        self.headers = {'Authorization': f'JWT {AccessToken.for_user(self.user)}'}
+
+    async def test_async_endpoints_answer_like_the_sync_ones(self):
+        paths = ['products/', 'products/?limit=1&ordering=name', f'products/{self.product.id}/', 'cart/me/', 'orders/me/']
+        for path in paths:
+            with self.subTest(path=path):
+                expected = await sync_to_async(self.client.get)(f'/api/{path}')
+                await sync_to_async(clear_caches)()
+                response = await self.async_client.get(f'/api/async/{path}', headers=self.headers)
+                self.assertEqual(response.status_code, 200)
+                # Pagination links point back to the endpoint that was called
+                self.assertEqual(response.content.replace(b'/api/async/', b'/api/'), expected.content)
+
+    async def test_unchanged_resource_is_not_modified(self):
+        response = await self.async_client.get('/api/async/cart/me/', headers=self.headers)
+        response = await self.async_client.get(
+            '/api/async/cart/me/', headers={**self.headers, 'If-None-Match': response['ETag']}
+        )
+        self.assertEqual(response.status_code, 304)
+
+    async def test_errors(self):
+        response = await self.async_client.get('/api/async/products/')
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('JWT', response['WWW-Authenticate'])
+        response = await self.async_client.get('/api/async/products/', headers={'Authorization': 'JWT nonsense'})
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.get('/api/async/products/0/', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+        expected = await sync_to_async(self.client.get)('/api/products/?min_price=abc')
+        response = await self.async_client.get('/api/async/products/?min_price=abc', headers=self.headers)
+        self.assertEqual((response.status_code, response.content), (400, expected.content))
+
+
+class StatelessAuthenticationTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.login()
+        self.client.post('/api/cart-item/', {'productId': make_product().id}, format='json')
+
+    def login(self, password='password'):
+        response = self.client.post('/auth/login/', {'email': 'shopper@example.com', 'password': password})
+        self.client.credentials(HTTP_AUTHORIZATION=f"JWT {response.data['access']}")
+
+    def test_requests_do_not_load_the_user(self):
+        # Same as with a forced authentication: the ETag query and two for the cart
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get('/api/cart/me/').status_code, 200)
+
+    def test_tokens_without_claims_still_work(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'JWT {AccessToken.for_user(self.user)}')
+        with self.assertNumQueries(4):
+            self.assertEqual(self.client.get('/api/cart/me/').status_code, 200)
+
+    def test_changes_revoke_the_tokens(self):
+        # Password to log in with before each change
+        changes = [
+            ('password', lambda user: setattr(user, 'is_staff', True)),
+            ('password', lambda user: user.set_password('new password')),
+            ('new password', lambda user: setattr(user, 'is_active', False)),
+        ]
+        for password, change in changes:
+            self.login(password)
+            self.assertEqual(self.client.get('/api/cart/me/').status_code, 200)
+            user = CustomUser.objects.get(pk=self.user.pk)
+            change(user)
+            user.save()
+            self.assertEqual(self.client.get('/api/cart/me/').status_code, 401)
+
+    def test_password_hash_upgrade_keeps_the_tokens_valid(self):
+        outdated = PBKDF2PasswordHasher().encode('password', 'salt', iterations=1000)
+        CustomUser.objects.filter(pk=self.user.pk).update(password=outdated)
+        # Logging in upgrades the hash, the new token version must reach the database too
+        self.login()
+        self.user.refresh_from_db()
+        self.assertNotEqual(self.user.password, outdated)
+        clear_caches()
+        self.assertEqual(self.client.get('/api/cart/me/').status_code, 200)
+
+    def test_revoke_and_delete(self):
+        self.user.revoke_tokens()
+        self.assertEqual(self.client.get('/api/cart/me/').data['code'], 'token_revoked')
+        self.login()
+        self.user.refresh_from_db()
+        self.user.delete()
+        self.assertEqual(self.client.get('/api/cart/me/').data['code'], 'user_not_found')
+
+    def test_claims_user_loads_the_other_fields_at_once(self):
+        user = user_from_claims(self.user.pk, {'is_active': True, 'is_staff': False, 'token_version': 1})
+        with self.assertNumQueries(0):
+            self.assertTrue(user.is_authenticated)
+            self.assertFalse(user.is_staff)
+        with self.assertNumQueries(1):
+            self.assertEqual((user.email, user.username), ('shopper@example.com', 'shopper'))
+
+
+class BenchmarkSuiteTest(TestCase):
+
+    def test_every_route_has_a_scenario(self):
+        seed(products=20, users=5, carts=5, orders=20)
+        command = BenchmarkApiCommand()
+        scenarios = command.scenarios(command.benchmark_user())
+        self.assertEqual(command.uncovered_routes(scenarios), [])
+
+    def test_regressions_against_the_baseline(self):
+        baseline = {'GET a': {'p95': 10.0, 'queries': 3}, 'GET b': {'p95': 10.0, 'queries': 3}}
+        results = {'GET a': {'p95': 12.0, 'queries': 3}, 'GET b': {'p95': 13.0, 'queries': 4}}
+        regressions = compare_to_baseline(results, baseline, threshold=0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(regression.startswith('GET b') for regression in regressions))
+        self.assertEqual(compare_to_baseline({}, baseline, threshold=0.25), [])
+
+
+class PerformanceMiddlewareTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        reset_metrics()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.client.post('/api/cart-item/', {'productId': make_product().id}, format='json')
+
+    def test_server_timing_counts_the_queries(self):
+        response = self.client.get('/api/cart/me/')
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+        self.assertIn('render;dur=', response['Server-Timing'])
+        serialize = re.search(r'serialize;dur=([\d.]+)', response['Server-Timing'])
+        self.assertGreater(float(serialize.group(1)), 0)
+
+    def test_requests_are_logged_with_their_view(self):
+        item = CartItem.objects.get()
+        with self.assertLogs('core.performance', 'INFO') as logs:
+            self.client.patch(f'/api/cart-item/{item.id}/', {'action': 'increment'}, format='json')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['view'], record['method'], record['status']), ('CartItemViewSet.partial_update', 'PATCH', 200))
+        self.assertEqual(record['queries'], 4)
+        self.assertIn('serialize_ms', record)
+
+    async def test_async_views_are_measured(self):
+        headers = {'Authorization': f'JWT {AccessToken.for_user(self.user)}'}
+        response = await self.async_client.get('/api/async/cart/me/', headers=headers)
+        # The user lookup of a token without claims, the ETag query and two for the cart
+        self.assertIn('desc="4 queries"', response['Server-Timing'])
+
+    def test_metrics(self):
+        self.client.get('/api/cart/me/')
+        self.client.get('/api/products/')
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            metrics = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').content.decode()
+        self.assertIn('superlian_request_db_queries_count{view="CartViewSet.get_my_cart",method="GET"} 1', metrics)
+        self.assertIn('superlian_request_duration_seconds_bucket{view="CartItemViewSet.create",method="POST",status="2xx",le="+Inf"} 1', metrics)
+        self.assertIn('superlian_response_cache_events_total{policy="products-list",event="misses"} 1', metrics)
+        # Without a token, only while developing
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        with override_settings(DEBUG=True):
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class NPlusOneDetectionTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = CustomUser.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        products = [make_product(name=f'Phone {index}') for index in range(3)]
+        for product in products:
+            self.client.post('/api/cart-item/', {'productId': product.id}, format='json')
+            self.client.post('/api/orders/', order_payload([{'product': product.id, 'quantity': 1}]), format='json')
+
+    def test_query_per_row_is_reported_with_its_field(self):
+        with self.assertRaisesMessage(NPlusOneQueries, 'CartItemSerializer.product_name ran 3 times'):
+            with detect_nplusone():
+                CartSerializer(Cart.objects.prefetch_related('items').get()).data
+        with self.settings(NPLUSONE_MODE='log'), self.assertLogs('core.nplusone', 'WARNING') as logs:
+            with detect_nplusone('cart'):
+                CartSerializer(Cart.objects.prefetch_related('items').get()).data
+        self.assertEqual(json.loads(logs.records[0].getMessage())['field'], 'CartItemSerializer.product_name')
+
+    def test_prefetched_serializers_pass(self):
+        with detect_nplusone():
+            CartSerializer(Cart.objects.with_items().get()).data
+
+    def test_list_endpoints_have_no_n_plus_one(self):
+        for path in ['/api/cart/', '/api/cart-item/', '/api/orders/', '/api/order-item/', '/api/orders/me/']:
+            with self.subTest(path=path):
+                self.assertEqual(self.client.get(path).status_code, 200)
@@ -1,16 +1,98 @@
+import secrets
+from datetime import timedelta
+
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework.response import Response
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
+from rest_framework.views import APIView
+from rest_framework.exceptions import APIException, ValidationError
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db.models import F, Q, Sum, Count, Max, Value, DecimalField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
+from .conditional import conditional
+from .cache import response_cache_key, get_cached_response, cache_response, invalidate_namespace, cache_stats
+from .analytics import GROUPS, sales_report
+from .exports import ENCODERS, FORMATS, order_rows
+from .facets import product_facets
+from .filters import filter_products, parse_day, TRUE_VALUES
+from .metrics import render_metrics
+from .pagination import OrderHistoryPagination, CatalogPagination, SearchPagination
+from .search import SearchResults
 from .serializers import (
-    CustomTokenObtainPairSerializer, UserProfileSerializer, UserSerializer, ProductSerializer, CartSerializer, CartItemSerializer,
-    OrderSerializer, OrderItemSerializer
+    CustomTokenObtainPairSerializer, UserProfileSerializer, UserSerializer, ProductSerializer, ProductListSerializer,
+    CartSerializer, CartItemSerializer, CartBatchSerializer, OrderSerializer, OrderItemSerializer
     )
 from .models import (
-    UserProfile, Product, Cart, CartItem,
-    Order, OrderItem, CardDetails
+    UserProfile, Product, ProductVariant, Cart, CartItem,
+    Order, OrderItem, CardDetails, variant_filter
+    )
+
+
+# (product, storage, color) of the variant an order line asks for
+def variant_key(product_id, item):
+    return product_id, item.get("size") or '', item.get("color") or ''
+
+
+# Raised when an order asks for more units of a product than are in stock
+class OutOfStock(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Not enough stock for this order.'
+    default_code = 'out_of_stock'
+
+
+# Validators for the conditional GETs, each one is a single indexed query
+# that never loads the rows that make up the response
+
+def profile_validators(view, request, *args, **kwargs):
+    updated_at = UserProfile.objects.filter(user=request.user).values_list('updated_at', flat=True).first()
+    if updated_at is None:
+        return None
+    return (updated_at,), updated_at
+
+
+# The cart changes with its items and with the prices of the products in it
+def cart_validators(view, request, *args, **kwargs):
+    cart = Cart.objects.filter(user=request.user).annotate(
+        items_count=Count('items'), products_updated_at=Max('items__product__updated_at')
+    ).values('id', 'updated_at', 'items_count', 'products_updated_at').first()
+    if cart is None:
+        return None
+    last_modified = max(filter(None, [cart['updated_at'], cart['products_updated_at']]))
+    return tuple(cart.values()), last_modified
+
+
+# Order history changes with the orders and with the products they show
+def order_history_validators(view, request, *args, **kwargs):
+    orders = Order.objects.filter(user=request.user).aggregate(
+        count=Count('id', distinct=True), updated_at=Max('updated_at'),
+        products_updated_at=Max('items__product__updated_at')
     )
+    if not orders['count']:
+        return None
+    last_modified = max(filter(None, [orders['updated_at'], orders['products_updated_at']]))
+    return tuple(orders.values()), last_modified
+
+
+# Deleting a product does not move the latest update, so the count is part of the validator
+def catalog_validators(view, request, *args, **kwargs):
+    catalog = Product.objects.aggregate(count=Count('id'), updated_at=Max('updated_at'))
+    return tuple(catalog.values()), catalog['updated_at']
+
+
+def product_validators(view, request, *args, **kwargs):
+    try:
+        updated_at = Product.objects.filter(pk=kwargs.get('pk')).values_list('updated_at', flat=True).first()
+    except (ValueError, TypeError):
+        # Not an id, the lookup of the view answers 404
+        return None
+    if updated_at is None:
+        return None
+    return (updated_at,), updated_at
 
 
 class CustomTokenObtainPairView(TokenObtainPairView):
@@ -24,15 +106,14 @@ class UserProfileViewSet(viewsets.ModelViewSet):
     # This action will be called when the user wants to get their profile
     # It will return the profile of the authenticated user or create one if it doesn't exist
     @action(detail=False, methods=['get'], url_path='me')
+    @conditional(profile_validators)
     def get_my_profile(self, request):
         user = request.user
-        profile = UserProfile.objects.filter(user=user).first()
-        if not profile:
-            profile = UserProfile.objects.create(
-                user=user,
-                first_name=user.first_name,
-                last_name=user.last_name
-            )
+        # get_or_create reads from the primary, a replica may not have the profile yet
+        profile, _ = UserProfile.objects.get_or_create(
+            user=user,
+            defaults={'first_name': user.first_name, 'last_name': user.last_name},
+        )
         serializer = self.get_serializer(profile)
         return Response(serializer.data)
     
@@ -49,6 +130,82 @@ class ProductViewSet(viewsets.ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CatalogPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'search', 'facets'):
+            # Filter and order the catalog from the query parameters
+            queryset = filter_products(queryset, self.request.query_params)
+        else:
+            # The full representation lists the variants
+            queryset = queryset.prefetch_related('variants')
+        return queryset
+
+    # List the catalog, paginated requests get the slim list representation
+    # Responses are cached until a product changes
+    @conditional(catalog_validators)
+    def list(self, request, *args, **kwargs):
+        cache_key = response_cache_key('products-list', 'catalog', request)
+        data = get_cached_response('products-list', cache_key)
+        if data is not None:
+            return Response(data)
+
+        queryset = self.get_queryset()
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = ProductListSerializer(page, many=True, context=self.get_serializer_context())
+            data = self.get_paginated_response(serializer.data).data
+        else:
+            data = self.get_serializer(queryset.prefetch_related('variants'), many=True).data
+
+        cache_response('products-list', cache_key, data)
+        return Response(data)
+
+    @conditional(product_validators)
+    def retrieve(self, request, *args, **kwargs):
+        cache_key = response_cache_key('products-detail', 'catalog', request, kwargs.get('pk'))
+        data = get_cached_response('products-detail', cache_key)
+        if data is None:
+            data = super().retrieve(request, *args, **kwargs).data
+            cache_response('products-detail', cache_key, data)
+        return Response(data)
+
+    # Full-text search of the catalog: ?q= matches the name, brand, category and description,
+    # every word as a prefix so it works for typeahead. Best matches come first, the catalog
+    # filters narrow the results down and the results are paginated with ?limit= and ?page=
+    @action(detail=False, methods=['get'], url_path='search')
+    @conditional(catalog_validators)
+    def search(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'Enter a search term.'})
+
+        cache_key = response_cache_key('products-search', 'catalog', request)
+        data = get_cached_response('products-search', cache_key)
+        if data is not None:
+            return Response(data)
+
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(SearchResults(query, self.get_queryset()), request, view=self)
+        serializer = ProductListSerializer(page, many=True, context=self.get_serializer_context())
+        data = paginator.get_paginated_response(serializer.data).data
+
+        cache_response('products-search', cache_key, data)
+        return Response(data)
+
+    # Counts by category, brand, price bucket and storage/color option in stock of the products
+    # matching the catalog filters (and ?q= when given), so category pages can show their
+    # filters without loading the products
+    @action(detail=False, methods=['get'], url_path='facets')
+    @conditional(catalog_validators)
+    def facets(self, request):
+        cache_key = response_cache_key('products-facets', 'catalog', request)
+        data = get_cached_response('products-facets', cache_key)
+        if data is None:
+            data = product_facets(self.get_queryset(), request.query_params.get('q'))
+            cache_response('products-facets', cache_key, data)
+        return Response(data)
     
 class CartViewSet(viewsets.ModelViewSet):
     queryset = Cart.objects.all()
@@ -56,19 +213,15 @@ class CartViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        # Get the cart for the authenticated user
-        cart = Cart.objects.filter(user=self.request.user).first()
-
-        if not cart:
-            return Cart.objects.none()
-        
-        return [cart]  # Return the cart object in a list
+        # Only the cart of the authenticated user, as a queryset so detail lookups work
+        return Cart.objects.with_items().filter(user=self.request.user)
     
     # This action will be called when the user wants to get their cart
     @action(detail=False, methods=['get'], url_path='me')
+    @conditional(cart_validators)
     def get_my_cart(self, request):
-        # Get the cart for the authenticated user
-        cart = Cart.objects.filter(user=request.user).first()
+        # Get the cart for the authenticated user along with its items
+        cart = Cart.objects.with_items().filter(user=request.user).first()
 
         if not cart:
             return Response({"detail": "No cart found for this user"}, status=404)
@@ -82,66 +235,132 @@ class CartViewSet(viewsets.ModelViewSet):
     # It will delete all items in the cart and return a success message
     @action(detail=False, methods=['post'], url_path='clear')
     def clear_cart(self, request):
-        cart = Cart.objects.filter(user=request.user).first()
+        cart = Cart.objects.filter(user=request.user).only('id').first()
         if not cart:
             return Response({"detail": "No cart found."}, status=status.HTTP_404_NOT_FOUND)
         
-        cart.items.all().delete()
+        # Delete the items in a single query without loading them first
+        CartItem.objects.filter(cart=cart).delete()
+        Cart.objects.touch(request.user)
         return Response({"detail": "Cart cleared."})
 
+    # This action applies a list of add/set/remove operations to the cart in one transaction
+    # It returns the full cart, or with ?return=delta only the changed lines and the new total
+    @action(detail=False, methods=['post'], url_path='batch')
+    def batch(self, request):
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        operations = serializer.validated_data['operations']
+
+        # Check all the products at once
+        product_ids = {operation['product'] for operation in operations}
+        missing = product_ids - set(Product.objects.filter(pk__in=product_ids).values_list('id', flat=True))
+        if missing:
+            raise ValidationError({"operations": f"Unknown product(s): {sorted(missing)}"})
+
+        with transaction.atomic():
+            cart, _ = Cart.objects.get_or_create(user=request.user)
+            for operation in operations:
+                self._apply_operation(cart, operation)
+            Cart.objects.touch(request.user)
+
+        if request.query_params.get('return') == 'delta':
+            return Response(self._cart_delta(cart, operations))
+        cart = Cart.objects.with_items().get(pk=cart.pk)
+        return Response(CartSerializer(cart).data)
+
+    def _apply_operation(self, cart, operation):
+        color, size = operation['color'], operation['size']
+        if operation['op'] == 'add':
+            CartItem.objects.add_to_cart(cart, operation['product'], color, size, operation['quantity'])
+            return
+        items = CartItem.objects.filter(cart=cart, product_id=operation['product']).filter(variant_filter(color, size))
+        if operation['op'] == 'remove':
+            items.delete()
+        elif not items.set_quantity(operation['quantity']) and operation['quantity'] > 0:
+            # Setting the quantity of a line that is not in the cart yet adds it
+            CartItem.objects.add_to_cart(cart, operation['product'], color, size, operation['quantity'])
+
+    # The lines touched by the operations as they are now, the ones that are gone and the cart total
+    def _cart_delta(self, cart, operations):
+        touched = {}
+        for operation in operations:
+            key = (operation['product'], operation['color'] or None, operation['size'] or None)
+            touched[key] = Q(product_id=key[0]) & variant_filter(key[1], key[2])
+        lines = Q()
+        for line in touched.values():
+            lines |= line
+
+        items = list(CartItem.objects.filter(cart=cart).filter(lines).select_related('product', 'variant'))
+        present = {(item.product_id, item.color or None, item.size or None) for item in items}
+        total = CartItem.objects.filter(cart=cart).aggregate(
+            total=Sum(
+                F('quantity') * (F('product__price') + Coalesce('variant__price_delta', Value(0))),
+                output_field=DecimalField(max_digits=12, decimal_places=2),
+            )
+        )['total'] or 0
+        return {
+            "items": CartItemSerializer(items, many=True).data,
+            "removed": [
+                {"product_id": product_id, "color": color, "size": size}
+                for product_id, color, size in touched if (product_id, color, size) not in present
+            ],
+            "total_price": total,
+        }
+
     
 class CartItemViewSet(viewsets.ModelViewSet):
     queryset = CartItem.objects.all()
     serializer_class = CartItemSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    # Users can only see and change the items in their own cart
+    def get_queryset(self):
+        return CartItem.objects.filter(cart__user=self.request.user).select_related('product', 'variant')
+
+    # Each action is a single statement on the item, so concurrent taps never lose an update
     def partial_update(self, request, *args, **kwargs):
-        cart_item = self.get_object()
+        items = self.get_queryset().filter(pk=kwargs['pk'])
         action_type = request.data.get("action")
 
         if action_type == "increment":
-            cart_item.quantity += 1
-            cart_item.save()
+            changed = items.increment()
         elif action_type == "decrement":
-            cart_item.quantity -= 1
-            if cart_item.quantity <= 0:
-                cart_item.delete()
-                return self._return_full_cart()
-            cart_item.save()
+            changed = items.decrement()
         elif action_type == "remove":
-            cart_item.delete()
-            return self._return_full_cart()
+            changed, _ = items.delete()
         else:
             return Response({"detail": "Invalid action"}, status=status.HTTP_400_BAD_REQUEST)
 
+        if not changed:
+            return Response({"detail": "No cart item found."}, status=status.HTTP_404_NOT_FOUND)
+        Cart.objects.touch(request.user)
         return self._return_full_cart()
 
     def create(self, request, *args, **kwargs):
+        try:
+            product_id = int(request.data.get('productId'))
+        except (TypeError, ValueError):
+            return Response({"detail": "Invalid product."}, status=status.HTTP_400_BAD_REQUEST)
         cart, _ = Cart.objects.get_or_create(user=request.user)
-        product_id = request.data.get('productId')
-
-        # Check if the product exists
-        existing_item = CartItem.objects.filter(cart=cart, product_id=product_id).first()
 
-        # Increment quantity if item exists
-        if existing_item:
-            existing_item.quantity += 1
-            existing_item.save()
-        else:
-            # Create new cart item if it doesn't exist
-            CartItem.objects.create(
-                cart=cart,
+        # Add the product to the cart, or one more unit if the same color and size is already in it
+        try:
+            CartItem.objects.add_to_cart(
+                cart,
                 product_id=product_id,
-                quantity=1,
                 color=request.data.get('color'),
                 size=request.data.get('size')
             )
+        except Product.DoesNotExist:
+            return Response({"detail": "Invalid product."}, status=status.HTTP_400_BAD_REQUEST)
 
+        Cart.objects.touch(request.user)
         return self._return_full_cart()
 
     # This method returns the full cart details after any operation
     def _return_full_cart(self):
-        cart = Cart.objects.filter(user=self.request.user).first()
+        cart = Cart.objects.with_items().filter(user=self.request.user).first()
         if not cart:
             return Response({"items": [], "totalQuantity": 0}, status=status.HTTP_200_OK)
 
@@ -152,68 +371,203 @@ class CartItemViewSet(viewsets.ModelViewSet):
     def perform_destroy(self, instance):
         # Delete the cart item
         instance.delete()
+        Cart.objects.touch(self.request.user)
         # Return a response indicating success
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     
 class OrderViewSet(viewsets.ModelViewSet):
-    queryset = Order.objects.all()
+    queryset = Order.objects.with_items()
     serializer_class = OrderSerializer
     
+    # This action returns the order history of the authenticated user one page at a time
     @action(detail=False, methods=['get'], url_path='me')
+    @conditional(order_history_validators)
     def get_my_orders(self, request):
-        # Get all orders for the authenticated user
-        orders = Order.objects.filter(user=request.user)
-        if not orders:
+        # Pages are cached until one of the user's orders changes
+        cache_key = response_cache_key('orders-history', f'orders:{request.user.pk}', request)
+        data = get_cached_response('orders-history', cache_key)
+        if data is not None:
+            return Response(data)
+
+        # Get a page of orders for the authenticated user along with their items
+        orders = Order.objects.with_items().filter(user=request.user)
+        paginator = OrderHistoryPagination()
+        page = paginator.paginate_queryset(orders, request, view=self)
+        if not page and not request.query_params.get(paginator.cursor_query_param):
             return Response({"detail": "No orders found for this user"}, status=404)
 
         # Serialize the orders using the OrderSerializer
-        serializer = OrderSerializer(orders, many=True)
-        return Response(serializer.data)
+        serializer = OrderSerializer(page, many=True)
+        data = paginator.get_paginated_response(serializer.data).data
+        cache_response('orders-history', cache_key, data)
+        return Response(data)
   
+    # Staff export of the orders, or of their lines with lines=true, for reporting: CSV or
+    # JSON lines (output=jsonl) filtered by placed_after, placed_before and status, streamed
+    # as it is read so memory stays flat whatever the number of orders
+    @action(detail=False, methods=['get'], url_path='export', permission_classes=[permissions.IsAdminUser])
+    def export(self, request):
+        output = request.query_params.get('output', 'csv')
+        if output not in FORMATS:
+            raise ValidationError({'output': f'Choose one of {sorted(FORMATS)}.'})
+        lines = request.query_params.get('lines', '').lower() in TRUE_VALUES
+        columns, rows = order_rows(request.query_params, lines=lines)
+        response = StreamingHttpResponse(
+            ENCODERS[output](columns, rows), content_type=f'{FORMATS[output]}; charset=utf-8'
+        )
+        filename = f"{'order-lines' if lines else 'orders'}-{timezone.now():%Y%m%d-%H%M%S}.{output}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
     def create(self, request, *args, **kwargs):
         data = request.data.copy()
-        print("data", data)
         items = data.pop("items", [])
         card_data = data.pop("card", None)
         payment_method = data.get("payment_method")
 
-        # Create card if card data exists
-        card = None
-        if payment_method == "card" and card_data:
-            card = CardDetails.objects.create(
-                card_number=card_data.get("cardNumber"),
-                expiry=card_data.get("expiry"),
-                cvv=card_data.get("cvv")
-            )
+        # Add up the quantities requested for each product, and for each variant
+        quantities, variant_quantities = {}, {}
+        for item in items:
+            try:
+                product_id = int(item.get("product"))
+                quantity = int(item.get("quantity"))
+            except (TypeError, ValueError):
+                raise ValidationError({"items": "Each item needs a valid product and quantity."})
+            if quantity <= 0:
+                raise ValidationError({"items": "Quantity must be greater than zero."})
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+            key = variant_key(product_id, item)
+            variant_quantities[key] = variant_quantities.get(key, 0) + quantity
 
-        # Create order
-        order = Order.objects.create(
-            user=request.user,
-            shipping_address=data.get("shipping_address"),
-            billing_address=data.get("billing_address"),
-            payment_method=payment_method,
-            card=card,
-        )
+        # Everything below either succeeds as a whole or leaves no trace
+        with transaction.atomic():
+            # Fetch all the ordered products in one query
+            products = Product.objects.in_bulk(quantities.keys())
+            missing = sorted(set(quantities) - set(products))
+            if missing:
+                raise ValidationError({"items": f"Unknown product(s): {missing}"})
 
-        # Create order items
-        for item in items:
-            product_id = item.get("product")
-            print("product id", product_id)
-            product = Product.objects.get(id=product_id)
-            OrderItem.objects.create(
-                order=order,
-                product=product,
-                quantity=item["quantity"],
-                color=item.get("color"),
-                size=item.get("size")
+            # Reserve the stock, the update only matches when enough stock is left
+            # so concurrent checkouts can never take the stock below zero
+            for product_id, quantity in quantities.items():
+                reserved = Product.objects.filter(id=product_id, stock__gte=quantity).update(
+                    stock=F("stock") - quantity, updated_at=timezone.now()
+                )
+                if not reserved:
+                    raise OutOfStock(f"Not enough stock for {products[product_id].name}.")
+
+            # And the stock of the variants ordered, lines without a matching variant only take product stock
+            # (lines without a color or size never have one)
+            variant_products = {product_id for product_id, storage, color in variant_quantities if storage or color}
+            variants = {
+                (variant.product_id, variant.storage, variant.color): variant
+                for variant in ProductVariant.objects.filter(product_id__in=variant_products)
+            } if variant_products else {}
+            for key, quantity in variant_quantities.items():
+                variant = variants.get(key)
+                if variant is None:
+                    continue
+                if not ProductVariant.objects.filter(pk=variant.pk, stock__gte=quantity).update(stock=F("stock") - quantity):
+                    variant.product = products[key[0]]
+                    raise OutOfStock(f"Not enough stock for {variant}.")
+            # The stock is part of the cached catalog
+            transaction.on_commit(lambda: invalidate_namespace('catalog'))
+
+            # Create card if card data exists
+            card = None
+            if payment_method == "card" and card_data:
+                card = CardDetails.objects.create(
+                    card_number=card_data.get("cardNumber"),
+                    expiry=card_data.get("expiry"),
+                    cvv=card_data.get("cvv")
+                )
+
+            # Capture the prices the items are sold at
+            order_items = []
+            for item in items:
+                product = products[int(item.get("product"))]
+                variant = variants.get(variant_key(product.pk, item))
+                order_items.append(OrderItem(
+                    product=product,
+                    variant=variant,
+                    quantity=int(item.get("quantity")),
+                    unit_price=product.price + (variant.price_delta if variant else 0),
+                    color=item.get("color"),
+                    size=item.get("size")
+                ))
+
+            # Create order
+            order = Order.objects.create(
+                user=request.user,
+                shipping_address=data.get("shipping_address"),
+                billing_address=data.get("billing_address"),
+                payment_method=payment_method,
+                card=card,
+                total=sum(order_item.get_total_price() for order_item in order_items),
             )
 
+            # Create order items in one query
+            for order_item in order_items:
+                order_item.order = order
+            OrderItem.objects.bulk_create(order_items)
+
+        # Read the order back with its items for the response
+        order = Order.objects.with_items().get(pk=order.pk)
         serializer = self.get_serializer(order)
         return Response(serializer.data, status=status.HTTP_201_CREATED)  
     
     
 
 class OrderItemViewSet(viewsets.ModelViewSet):
-    queryset = OrderItem.objects.all()
-    serializer_class = OrderItemSerializer
\ No newline at end of file
+    queryset = OrderItem.objects.select_related('product')
+    serializer_class = OrderItemSerializer
+
+
+# Hit, miss and eviction counters of the response cache of this process
+class CacheStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(cache_stats())
+
+
+# Sales dashboards for staff, served from the daily rollups (see analytics.py)
+# Parameters: by (day, product, category or brand), start and end (dates, included, the last
+# 30 days by default) and limit (best sellers returned when grouping by product, category or brand)
+class SalesAnalyticsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        params = request.query_params
+        by = params.get('by', 'day')
+        if by not in GROUPS:
+            raise ValidationError({'by': f'Choose one of {sorted(GROUPS)}.'})
+        end = parse_day(params, 'end') or timezone.localdate()
+        start = parse_day(params, 'start') or end - timedelta(days=29)
+        if start > end:
+            raise ValidationError({'start': 'The start must not be after the end.'})
+        try:
+            limit = min(max(int(params.get('limit', 20)), 1), 100)
+        except ValueError:
+            raise ValidationError({'limit': 'Enter a number.'})
+
+        # Cached until the next refresh of the rollups
+        cache_key = response_cache_key('sales-analytics', 'analytics', request, str(start), str(end))
+        data = get_cached_response('sales-analytics', cache_key)
+        if data is None:
+            data = sales_report(by, start, end, limit)
+            cache_response('sales-analytics', cache_key, data)
+        return Response(data)
+
+
+# Request and response cache metrics of this process in the Prometheus text format
+# They show the traffic of every route, so they need METRICS_TOKEN, except while developing
+def metrics_view(request):
+    if settings.METRICS_TOKEN:
+        allowed = secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}')
+    else:
+        allowed = settings.DEBUG
+    if not allowed:
+        return HttpResponse(status=401)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 from pathlib import Path
 from datetime import timedelta
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -53,12 +54,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it measures everything the other middlewares do too
+    'core.middleware.PerformanceMiddleware',
+    'core.middleware.NPlusOneMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -87,12 +92,86 @@ WSGI_APPLICATION = 'superlian.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE selects the backend: "sqlite" (default) or "postgresql"
+DB_ENGINE = os.getenv("DB_ENGINE", "sqlite").lower()
+
+# Seconds a connection is kept open between requests (0 closes it after every request)
+DB_CONN_MAX_AGE = int(os.getenv("DB_CONN_MAX_AGE", "60"))
+
+if DB_ENGINE in ("postgres", "postgresql"):
+    # Needs psycopg: pip install "psycopg[binary,pool]"
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv("DB_NAME", "superlian"),
+            'USER': os.getenv("DB_USER", "postgres"),
+            'PASSWORD': os.getenv("DB_PASSWORD", ""),
+            'HOST': os.getenv("DB_HOST", "localhost"),
+            'PORT': os.getenv("DB_PORT", "5432"),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            # Check that a reused connection is still alive before handing it out
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+    # Pooled mode: each worker process keeps a psycopg pool of connections
+    # The pool replaces persistent connections, so CONN_MAX_AGE must be 0
+    if os.getenv("DB_POOL", "False").lower() in ("true", "1", "yes"):
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+            'max_size': int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+            'timeout': int(os.getenv("DB_POOL_TIMEOUT", "10")),
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv("DB_NAME", BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'OPTIONS': {
+                # Take the write lock when a transaction starts so concurrent checkouts
+                # queue up behind each other instead of failing to upgrade their lock
+                'transaction_mode': 'IMMEDIATE',
+                # Seconds to wait for the write lock (busy timeout)
+                'timeout': int(os.getenv("DB_SQLITE_TIMEOUT", "20")),
+                # WAL lets readers carry on while a write is in progress, and with it
+                # synchronous=NORMAL is still safe against corruption
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA cache_size=-20000;'
+                ),
+            },
+            # Use a file for the test database so tests can use several connections at once
+            'TEST': {
+                'NAME': BASE_DIR / 'test_db.sqlite3',
+            },
+        }
     }
-}
+
+# Read replicas: DB_REPLICAS is a comma separated list of replica hosts for PostgreSQL,
+# or of database files for SQLite (files standing in for replicas, e.g. in tests)
+# Each replica gets an alias replica_1, replica_2, ... with the settings of the primary
+DATABASE_REPLICAS = []
+for number, replica in enumerate(filter(None, os.getenv("DB_REPLICAS", "").split(",")), start=1):
+    alias = f'replica_{number}'
+    DATABASES[alias] = {**DATABASES['default'], 'OPTIONS': dict(DATABASES['default']['OPTIONS'])}
+    if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+        DATABASES[alias]['NAME'] = replica.strip()
+        DATABASES[alias]['TEST'] = {'NAME': BASE_DIR / f'test_{alias}.sqlite3'}
+    else:
+        host, _, port = replica.strip().partition(':')
+        DATABASES[alias].update(HOST=host, PORT=port or DATABASES['default']['PORT'])
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['core.db_routers.PrimaryReplicaRouter']
+# Replicas further behind the primary than this many seconds are skipped
+DATABASE_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+# Seconds the lag of a replica is remembered before checking it again
+DATABASE_REPLICA_LAG_CHECK_SECONDS = float(os.getenv("DB_REPLICA_LAG_CHECK_SECONDS", "2"))
+# Seconds a user's reads go to the primary after they write (read-your-writes)
+DATABASE_REPLICA_PIN_SECONDS = int(os.getenv("DB_REPLICA_PIN_SECONDS", "5"))
 
 
 # Password validation
@@ -144,6 +223,15 @@ else:
     MEDIA_URL = "/media/"
     MEDIA_ROOT = "/var/www/superlian/media"
 
+# Responsive renditions of the product images (core/images.py): widths in pixels and
+# the WebP/AVIF quality. AVIF is generated too when Pillow can write it
+PRODUCT_IMAGE_WIDTHS = [int(width) for width in os.getenv("PRODUCT_IMAGE_WIDTHS", "160,320,640,1280").split(",")]
+PRODUCT_IMAGE_QUALITY = int(os.getenv("PRODUCT_IMAGE_QUALITY", "75"))
+
+# Sales rollups (core/analytics.py): refreshes count the orders placed up to this many seconds
+# ago, so orders of checkouts still in their transaction are counted by the next refresh
+SALES_ROLLUP_LAG = int(os.getenv("SALES_ROLLUP_LAG", "60"))
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
@@ -154,25 +242,102 @@ AUTH_USER_MODEL = 'core.CustomUser'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Trusts the signed claims of the token, no user query per request
+        'core.authentication.StatelessJWTAuthentication',
+        # For the admin and the browsable API
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.BasicAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'core.renderers.TimedJSONRenderer',
     ],
 }
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# Shared cache: Redis when REDIS_URL is set (e.g. redis://localhost:6379/0, needs the
+# redis package), otherwise an in-memory cache local to each process
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Response cache of the read endpoints (see core/cache.py)
+RESPONSE_CACHE_ALIAS = 'default'
+# Entries of the in-process LRU in front of the shared cache
+RESPONSE_CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_LOCAL_MAX_ENTRIES", "1000"))
+# Seconds a response stays in the shared cache and in the in-process LRU
+# Changes to the underlying rows invalidate the cached responses right away
+RESPONSE_CACHE_POLICIES = {
+    'products-list': {'timeout': int(os.getenv("CATALOG_CACHE_TIMEOUT", "300")), 'local_timeout': 30},
+    'products-detail': {'timeout': int(os.getenv("CATALOG_CACHE_TIMEOUT", "300")), 'local_timeout': 30},
+    'products-search': {'timeout': int(os.getenv("CATALOG_CACHE_TIMEOUT", "300")), 'local_timeout': 30},
+    'products-facets': {'timeout': int(os.getenv("CATALOG_CACHE_TIMEOUT", "300")), 'local_timeout': 30},
+    'orders-history': {'timeout': 120, 'local_timeout': 0},
+    'sales-analytics': {'timeout': 300, 'local_timeout': 30},
+}
+
 SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('JWT',),
     'ACCESS_TOKEN_LIFETIME': timedelta(days=30),  
     'REFRESH_TOKEN_LIFETIME': timedelta(days=90),
     "AUTH_TOKEN_CLASSES": ("rest_framework_simplejwt.tokens.AccessToken",),
+    # Tokens from /auth/jwt/create carry the same claims as the ones from /auth/login
+    "TOKEN_OBTAIN_SERIALIZER": "core.serializers.CustomTokenObtainPairSerializer",
 }
 
+# Performance instrumentation (core.middleware.PerformanceMiddleware)
+# Add a Server-Timing header with the database, serialization, render and total times to every response
+PERFORMANCE_SERVER_TIMING = os.getenv("PERFORMANCE_SERVER_TIMING", "True").lower() in ("true", "1", "yes")
+# Requests slower than this are logged as warnings, the others at the info level
+PERFORMANCE_SLOW_REQUEST_MS = float(os.getenv("PERFORMANCE_SLOW_REQUEST_MS", "500"))
+# /metrics requires the header "Authorization: Bearer <METRICS_TOKEN>", without a token it is
+# only served when DEBUG is on
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# N+1 query detection in the serializers (core.nplusone): "raise", "log" or "off"
+# The test suite raises, so a missing select_related / prefetch_related fails the tests
+TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
+NPLUSONE_MODE = os.getenv("NPLUSONE_MODE", "raise" if TESTING else "off")
+# Times the same serializer field may run the same query in one request
+NPLUSONE_THRESHOLD = int(os.getenv("NPLUSONE_THRESHOLD", "2"))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'core.nplusone': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        # One JSON line per request, PERFORMANCE_LOG_LEVEL=INFO logs all of them
+        'core.performance': {
+            'handlers': ['console'],
+            'level': os.getenv("PERFORMANCE_LOG_LEVEL", "WARNING"),
+            'propagate': False,
+        },
+    },
+}
+
+# Seconds the token version of a user is cached for, it is refreshed whenever the user is saved
+AUTH_TOKEN_VERSION_CACHE_TIMEOUT = int(os.getenv("AUTH_TOKEN_VERSION_CACHE_TIMEOUT", "300"))
+
 ######### CORS Header Settings ###############
 
 # CORS_ORIGIN_ALLOW_ALL = True
@@ -1,13 +1,19 @@
 import { Link } from "react-router-dom";
-import { useGetOrdersByUserQuery } from "../../services/productApi";
+import { useGetOrdersByUserInfiniteQuery } from "../../services/productApi";
 import { setOrders } from "@/store/slices/productSlice";
-import { useEffect, useState } from "react";
+import { useEffect, useMemo, useState } from "react";
 import { useDispatch } from "react-redux";
 import { OrderType } from "@/utils/types";
 import ReactPaginate from "react-paginate";
 
 const Orders: React.FC = () => {
-  const { data: orders = [], isLoading, error } = useGetOrdersByUserQuery({});
+  const { data, isLoading, error, hasNextPage, fetchNextPage, isFetchingNextPage } =
+    useGetOrdersByUserInfiniteQuery();
+  // The orders of the pages loaded so far
+  const orders = useMemo(
+    () => data?.pages.flatMap((page) => page.results) ?? [],
+    [data],
+  );
   const dispatch = useDispatch();
 
   // Pagination state
@@ -66,6 +72,20 @@ const Orders: React.FC = () => {
         ))}
       </ul>
 
+      {/* Load the next page of the order history */}
+      {hasNextPage && (
+        <div className="mt-4 flex justify-center">
+          <button
+            type="button"
+            onClick={() => fetchNextPage()}
+            disabled={isFetchingNextPage}
+            className="rounded border px-4 py-2 text-sm text-cyan-600 hover:bg-gray-100 disabled:opacity-50"
+          >
+            {isFetchingNextPage ? "Loading..." : "Load more orders"}
+          </button>
+        </div>
+      )}
+
       {/* Pagination buttons */}
       <div className="mt-6 flex justify-center">
         <ReactPaginate
@@ -1,4 +1,5 @@
 import { getHeaderAuthorization } from "../utils/functions";
+import { OrderPageType } from "../utils/types";
 import baseApi from "./baseApi";
 
 export const productApi = baseApi.injectEndpoints({
@@ -73,10 +74,18 @@ export const productApi = baseApi.injectEndpoints({
       invalidatesTags: ["Cart"],
     }),
     // Fetch orders for the current user
-    getOrdersByUser: builder.query({
-      query: () => ({
+    // Order history is paginated with a cursor, each page is loaded on demand from the
+    // `next` link of the previous one
+    getOrdersByUser: builder.infiniteQuery<OrderPageType, void, string | null>({
+      infiniteQueryOptions: {
+        initialPageParam: null,
+        getNextPageParam: (lastPage) =>
+          lastPage.next ? new URL(lastPage.next).searchParams.get("cursor") : undefined,
+      },
+      query: ({ pageParam }) => ({
         url: "/api/orders/me",
         method: "GET",
+        params: pageParam ? { page_size: 100, cursor: pageParam } : { page_size: 100 },
         headers: getHeaderAuthorization(),
       }),
       providesTags: ["Orders"],
@@ -112,7 +121,7 @@ export const {
   useUpdateCartItemMutation,
   useDeleteCartItemMutation,
   useCreateCartItemMutation,
-  useGetOrdersByUserQuery,
+  useGetOrdersByUserInfiniteQuery,
   useGetOrderByIdQuery,
   useCreateOrderMutation,
 } = productApi;
@@ -103,6 +103,13 @@ export interface OrderType {
   items: CartItemType[];
 }
 
+// A page of the order history, `next` links to the following one (null on the last page)
+export interface OrderPageType {
+  next: string | null;
+  previous: string | null;
+  results: OrderType[];
+}
+
 export type CartSummaryProps = {
   totalPrice: number;
 };